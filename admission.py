@@ -0,0 +1,326 @@
+'''
+admission.py
+admission control for the expensive and write endpoints: token buckets,
+concurrency caps and load shedding
+
+every route in ROUTE_LIMITS has a token bucket per signed-in user, per client IP
+and (for login) per account name being tried; a request spends one token from
+each of its buckets, and when one is empty it is turned away with 429 and a
+Retry-After header saying when a token will be back. buckets refill at the
+route's rate up to its burst, so a client can click quickly for a moment but
+can not keep it up
+
+each limited route also has a cap on the requests it has in progress in this
+process, and the routes that write are shed while the write queue is deeper than
+MAX_WRITE_BACKLOG; excess traffic waits in front of the app (and is told when
+to come back) instead of inside it, so the requests that are admitted still
+finish in predictable time
+
+bucket state lives in a store: MemoryStore (the default) keeps it in this
+process, SQLiteStore keeps it in a small SQLite database of its own so every
+worker process of a deployment shares the same buckets (QUAD_RATELIMIT_STORE=sqlite);
+set_store() plugs in anything else with the same take() and refund() methods
+'''
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, jsonify, request, session
+
+import db
+import writequeue
+
+# Set QUAD_ADMISSION=0 to turn admission control off (e.g. for load tests of the app itself)
+ADMISSION_ENABLED = os.environ.get('QUAD_ADMISSION', '1') != '0'
+# 'memory' for buckets in this process, 'sqlite' for buckets shared by all processes
+RATELIMIT_STORE = os.environ.get('QUAD_RATELIMIT_STORE', 'memory')
+# Database file of the shared buckets (QUAD_RATELIMIT_DB); by default ratelimit.db next to users.db
+RATELIMIT_DB = os.environ.get('QUAD_RATELIMIT_DB')
+# Write routes are shed while more writes than this are waiting for the writer
+MAX_WRITE_BACKLOG = 1000
+# Retry-After (seconds) given to requests turned away by a concurrency cap or load shedding
+BUSY_RETRY_AFTER = 1
+# Buckets kept by MemoryStore; the least recently used are dropped (i.e. refilled) beyond this
+MEMORY_MAX_KEYS = 100_000
+# How long SQLiteStore waits for the bucket database before letting the request through (seconds)
+STORE_TIMEOUT = 0.05
+# SQLiteStore deletes buckets idle for longer than this (seconds), every PRUNE_EVERY requests
+STALE_AFTER = 3600
+PRUNE_EVERY = 10_000
+
+# Limits per route, keyed like instrument's route names:
+#   user / account / ip - (tokens per second, burst) for the signed-in user, the
+#     username being logged in to and the client IP
+#   concurrency - requests in progress at once in this process
+#   writes - shed while the write queue is backed up
+#   json - the route answers fetch() calls, so rejections are JSON too
+ROUTE_LIMITS = {
+    # called on every keystroke of the signup form
+    'POST /check_username': {'ip': (5, 30), 'concurrency': 16, 'json': True},
+    # login and signup run bcrypt; per-IP limits stay loose enough for a campus behind NAT
+    'POST /home': {'ip': (2, 30), 'account': (0.2, 5), 'concurrency': 8},
+    'POST /signup': {'ip': (0.5, 20), 'concurrency': 4},
+    'POST /like_post': {'user': (5, 30), 'ip': (20, 100), 'concurrency': 32, 'writes': True, 'json': True},
+    'POST /add_comment': {'user': (1, 10), 'ip': (5, 30), 'concurrency': 16, 'writes': True, 'json': True},
+    'POST /addfriend': {'user': (0.5, 10), 'ip': (2, 20), 'concurrency': 8, 'writes': True},
+    'POST /post': {'user': (0.2, 10), 'ip': (1, 20), 'concurrency': 8, 'writes': True},
+    'POST /notifications/mark_read': {'user': (2, 20), 'concurrency': 8, 'writes': True, 'json': True},
+    'POST /profile/avatar': {'user': (0.05, 3), 'ip': (0.2, 10), 'concurrency': 4},
+    # type-ahead search
+    'GET /search/users': {'user': (10, 30), 'ip': (20, 60), 'concurrency': 16, 'json': True},
+    'GET /search/posts': {'user': (2, 10), 'concurrency': 8, 'json': True},
+}
+
+_lock = threading.Lock()
+_in_progress = {}
+_stats = {'admitted': 0, 'rate_limited': 0, 'busy': 0, 'shed': 0, 'store_errors': 0}
+_store = None
+
+
+class Rejected(Exception):
+    """Raised when a request is not admitted; retry_after is in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class MemoryStore:
+    """Token buckets in this process, the least recently used dropped beyond max_keys."""
+
+    def __init__(self, max_keys=MEMORY_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        """Spend [cost] tokens from [key]'s bucket; returns 0, or the seconds until there are enough."""
+        now = time.monotonic()
+        with self._lock:
+            # Popped and put back, so the dict stays in least recently used order
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            self._buckets[key] = (tokens - cost if not wait else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                del self._buckets[next(iter(self._buckets))]
+        return wait
+
+    def refund(self, key, rate, burst, cost=1):
+        """Give back [cost] tokens taken from [key]'s bucket by a request that was then turned away."""
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + cost), updated)
+
+
+class SQLiteStore:
+    """Token buckets in a SQLite database that every process on the host shares."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit: every take() is one atomic statement
+            conn = sqlite3.connect(self.path, timeout=STORE_TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.executescript('''
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID;
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, cost=1):
+        """Spend [cost] tokens from [key]'s bucket; returns 0, or the seconds until there are enough."""
+        conn = self._connect()
+        now = time.time()
+        params = {'key': key, 'rate': rate, 'burst': burst, 'cost': cost, 'now': now}
+        # Refill and spend in one statement, so two processes can not spend the same token
+        spent = conn.execute('''
+            INSERT INTO buckets (key, tokens, updated) VALUES (:key, :burst - :cost, :now)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = MIN(:burst, tokens + (:now - updated) * :rate) - :cost,
+                updated = :now
+            WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= :cost
+            RETURNING tokens
+        ''', params).fetchall()
+        self._calls += 1
+        if self._calls % PRUNE_EVERY == 0:
+            conn.execute('DELETE FROM buckets WHERE updated < ?', (now - STALE_AFTER,))
+        if spent:
+            return 0
+        tokens, updated = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+        return (cost - min(burst, tokens + (now - updated) * rate)) / rate
+
+    def refund(self, key, rate, burst, cost=1):
+        """Give back [cost] tokens taken from [key]'s bucket by a request that was then turned away."""
+        self._connect().execute('UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE key = ?', (burst, cost, key))
+
+
+'''
+set_store(store):
+replaces the bucket store; [store] needs a take(key, rate, burst, cost=1) method
+returning 0 when the tokens were spent, or the seconds until there are enough,
+and a refund(key, rate, burst, cost=1) method giving spent tokens back
+'''
+def set_store(store):
+    global _store
+    _store = store
+
+
+def _get_store():
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                if RATELIMIT_STORE == 'sqlite':
+                    path = RATELIMIT_DB or os.path.join(os.path.dirname(os.path.abspath(db.DATABASE_PATH)), 'ratelimit.db')
+                    _store = SQLiteStore(path)
+                else:
+                    _store = MemoryStore()
+    return _store
+
+
+def _release(route):
+    with _lock:
+        _in_progress[route] -= 1
+
+
+'''
+admit(route, user_id=None, ip=None, account=None):
+decides whether a request may run: sheds write routes while the write queue is
+backed up, takes one of the route's concurrency slots and spends a token from
+each of the request's buckets; a request turned away spends nothing
+
+params:
+route - the route, e.g. 'POST /like_post' (routes not in ROUTE_LIMITS are always admitted)
+user_id - the signed-in user, if any
+ip - the client's IP address
+account - the username a login is for, if any
+returns:
+a function to call once the request has finished (frees its slot), or None
+raises:
+Rejected if the request should be turned away
+'''
+def admit(route, user_id=None, ip=None, account=None):
+    limits = ROUTE_LIMITS.get(route)
+    if limits is None or not ADMISSION_ENABLED:
+        return None
+    if limits.get('writes') and writequeue.metrics()['queued'] > MAX_WRITE_BACKLOG:
+        _count('shed')
+        raise Rejected('overloaded', BUSY_RETRY_AFTER)
+
+    with _lock:
+        if _in_progress.get(route, 0) >= limits.get('concurrency', math.inf):
+            _stats['busy'] += 1
+            raise Rejected('busy', BUSY_RETRY_AFTER)
+        _in_progress[route] = _in_progress.get(route, 0) + 1
+
+    store = _get_store()
+    spent = []
+    for kind, key in (('user', user_id), ('account', account.lower() if account else None), ('ip', ip)):
+        if kind not in limits or key is None:
+            continue
+        rate, burst = limits[kind]
+        key = f'{route}|{kind}:{key}'
+        try:
+            wait = store.take(key, rate, burst)
+        except sqlite3.Error:
+            # A busy or broken bucket database must not take the app down with it: let it through
+            _count('store_errors')
+            continue
+        if wait:
+            # Tokens already spent from the other buckets go back, e.g. an IP
+            # that is over its limit does not use up the account's login attempts
+            for spent_key, spent_rate, spent_burst in spent:
+                try:
+                    store.refund(spent_key, spent_rate, spent_burst)
+                except sqlite3.Error:
+                    _count('store_errors')
+            _release(route)
+            _count('rate_limited')
+            raise Rejected('rate limited', wait)
+        spent.append((key, rate, burst))
+
+    _count('admitted')
+    return lambda: _release(route)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+'''
+retry_after(rejected):
+returns the seconds a Rejected request should wait, rounded up to a whole second
+as the Retry-After header needs
+'''
+def retry_after(rejected):
+    return max(1, math.ceil(rejected.retry_after))
+
+
+'''
+is_json(route):
+returns whether rejections of [route] should be JSON (the route answers fetch() calls)
+'''
+def is_json(route):
+    return ROUTE_LIMITS.get(route, {}).get('json', False)
+
+
+'''
+init_app(app):
+admits every request to a route in ROUTE_LIMITS before its view runs, and
+answers the ones turned away with 429 and Retry-After
+'''
+def init_app(app):
+    @app.before_request
+    def admit_request():
+        if request.url_rule is None:
+            return None
+        route = f'{request.method} {request.url_rule.rule}'
+        if route not in ROUTE_LIMITS:
+            return None
+        account = request.form.get('username') if 'account' in ROUTE_LIMITS[route] else None
+        try:
+            g._admission = admit(route, session.get('user_id'), request.remote_addr, account)
+        except Rejected as rejected:
+            seconds = retry_after(rejected)
+            message = f'Too many requests. Please try again in {seconds} second(s).'
+            if is_json(route):
+                response = jsonify({'error': message, 'retry_after': seconds})
+            else:
+                response = app.response_class(message, mimetype='text/plain')
+            response.status_code = 429
+            response.headers['Retry-After'] = str(seconds)
+            return response
+        return None
+
+    @app.teardown_request
+    def release_request(error=None):
+        release = g.pop('_admission', None)
+        if release is not None:
+            release()
+
+
+'''
+metrics():
+returns admission counters and the number of limited requests in progress
+'''
+def metrics():
+    with _lock:
+        result = dict(_stats)
+        result['in_progress'] = sum(_in_progress.values())
+    return result
@@ -0,0 +1,83 @@
+'''
+aiodb.py
+async access to the users.db database for the ASGI server (asgi.py)
+
+sqlite3 calls block, so they run on a small pool of DB_WORKERS threads, each
+with its own connection opened by db.create_connection(); coroutines await the
+result instead of holding a thread while SQLite works, so the number of open
+client connections is not tied to the number of threads
+'''
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# Threads (and so SQLite connections) serving async database calls
+DB_WORKERS = int(os.environ.get('QUAD_DB_WORKERS', 4))
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='quad-db')
+_local = threading.local()
+
+
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != db.DATABASE_PATH:
+        if conn is not None:
+            conn.close()
+        conn = db.create_connection()
+        _local.conn, _local.path = conn, db.DATABASE_PATH
+    return conn
+
+
+def _call(func, args):
+    conn = _connection()
+    try:
+        return func(conn, *args)
+    finally:
+        # Never leave a read transaction open between calls
+        if conn.in_transaction:
+            conn.rollback()
+
+
+'''
+run(func, *args):
+runs func(conn, *args) on a database thread
+
+params:
+func - a blocking function taking a sqlite3 connection and [args]; it must not
+       rely on the connection staying in a transaction after it returns
+returns:
+func's return value
+'''
+async def run(func, *args):
+    # Carry the caller's context over so the statements count towards its request (see instrument)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, context.run, _call, func, args)
+
+
+'''
+fetchall(sql, params=()):
+runs a query on a database thread and returns all of its rows
+'''
+async def fetchall(sql, params=()):
+    return await run(lambda conn: conn.execute(sql, params).fetchall())
+
+
+'''
+fetchone(sql, params=()):
+runs a query on a database thread and returns its first row, or None
+'''
+async def fetchone(sql, params=()):
+    return await run(lambda conn: conn.execute(sql, params).fetchone())
+
+
+'''
+close():
+waits for running database calls and stops the database threads; their
+connections are closed as the threads exit
+'''
+def close():
+    _executor.shutdown(wait=True)
@@ -1,202 +1,155 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-import bcrypt
+from flask import Flask, Response, render_template, stream_template, request, redirect, url_for, session, jsonify, send_from_directory
 import sqlite3
 import os
-
-app = Flask(__name__)
-
-# Define the path to the SQLite database file
-DATABASE_PATH = os.path.join(os.getcwd(), 'users.db')
+import time
+
+import db
+import migrations
+from db import get_db
+from identity import lookup_user, invalidate_user
+import friends as friend_graph
+import timeline
+import passwords
+import writequeue
+import fulltext
+import inbox
+import pushhub
+import httpcache
+import profiles
+import instrument
+import archive
+import avatars
+import comment_lists
+import admission
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+db.init_app(app)
+instrument.init_app(app)
+# Rate limits, concurrency caps and load shedding for the expensive and write routes
+admission.init_app(app)
+# Templates build avatar URLs from users.pfp
+app.jinja_env.globals['avatar_url'] = avatars.url
+# Let a fronting web server send avatar files itself (X-Sendfile) instead of this process
+app.config['USE_X_SENDFILE'] = os.environ.get('QUAD_X_SENDFILE') == '1'
+
+# Number of posts shown per page of the home feed
+FEED_PAGE_SIZE = 50
+# Posts fetched from the database (and rendered) at a time while a feed page streams
+FEED_CHUNK_SIZE = 10
 
 '''
-create_connection()
-function to create a connection to the users.db database
+iter_friends_posts(user_id, before_id=None, limit=FEED_PAGE_SIZE):
+yields one page of posts from the mutual friends of a user, newest first,
+fetching them FEED_CHUNK_SIZE rows at a time so a page can be streamed
 
+params:
+user_id - the id of a user that is in the user.db database
+before_id - optional id of the last post on the previous page; only posts older than it are returned
+limit - the maximum number of posts to return
 returns:
-conn - a connection to the users.db database
+a generator of post dicts (id, username, post_content, timestamp, like_count,
+comment_count, liked, avatar)
 '''
-def create_connection():
-    """Create a connection to the SQLite database."""
-    conn = None
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-    except sqlite3.Error as e:
-        print(e)
-    return conn
+def iter_friends_posts(user_id, before_id=None, limit=FEED_PAGE_SIZE):
+    conn = get_db()
+    cursor = conn.cursor()
+
+    if timeline.FANOUT_ENABLED:
+        # Fan-out mode: the page of post ids comes from the user's own timeline
+        page_ids_sql, page_params = timeline.page_query(user_id, before_id, limit)
+        page_sql = f'''
+            SELECT p.id, p.author_id, p.post_content, p.created_at, p.like_count, p.comment_count
+            FROM ({page_ids_sql}) t JOIN posts p ON p.id = t.post_id
+        '''
+    else:
+        # Pull mode: mutual friends' posts, with keyset pagination on (created_at, id)
+        keyset = ''
+        page_params = [user_id]
+        if before_id is not None:
+            keyset = 'AND (p.created_at, p.id) < (SELECT created_at, id FROM posts WHERE id = ?)'
+            page_params.append(before_id)
+        page_params.append(limit)
+        page_sql = f'''
+            SELECT p.id, p.author_id, p.post_content, p.created_at, p.like_count, p.comment_count
+            FROM friends f
+            JOIN posts p ON p.author_id = f.friend_id
+            WHERE f.user_id = ? {keyset}
+            ORDER BY p.created_at DESC, p.id DESC
+            LIMIT ?
+        '''
+
+    # The page of posts, their authors, stored like/comment counts and liked-by-me in one statement
+    cursor.execute(f'''
+        WITH page AS ({page_sql})
+        SELECT page.id, au.username, page.post_content, datetime(page.created_at, 'unixepoch'),
+               page.like_count, page.comment_count, ml.user_id IS NOT NULL, au.pfp
+        FROM page
+        LEFT JOIN likes ml ON ml.post_id = page.id AND ml.user_id = ?
+        LEFT JOIN users au ON au.id = page.author_id
+        ORDER BY page.created_at DESC, page.id DESC
+    ''', page_params + [user_id])
+    while True:
+        rows = cursor.fetchmany(FEED_CHUNK_SIZE)
+        if not rows:
+            return
+        for post in rows:
+            yield {
+                'id': post[0],
+                'username': post[1],
+                'post_content': post[2],
+                'timestamp': post[3],
+                'like_count': post[4],
+                'comment_count': post[5],
+                'liked': bool(post[6]),
+                'avatar': avatars.url(post[7], 64)
+            }
 
 
 '''
-create_table():
-creates a users table in the database if one does not exist
-'''
-def create_table():
-    """Create a table to store user information."""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        username TEXT UNIQUE COLLATE NOCASE,
-        password TEXT,
-        age INTEGER,
-        college TEXT,
-        pfp TEXT DEFAULT ''
-    )
-''')
-
-    conn.commit()
-    conn.close()
+get_friends_posts(user_id, before_id=None, limit=FEED_PAGE_SIZE):
+retrieves one page of posts from the mutual friends of a user, newest first
 
+returns:
+all_posts - a list of posts from friends of [user_id], see iter_friends_posts()
 '''
-create_post_table():
-creates a posts table in the users.db database if one does not exist
-'''
-def create_post_table():
-    """Create a table to store the posts of users"""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS posts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT,
-        post_content TEXT,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    conn.commit()
-    conn.close()
+def get_friends_posts(user_id, before_id=None, limit=FEED_PAGE_SIZE):
+    return list(iter_friends_posts(user_id, before_id, limit))
 
 
 '''
-create_friend_table():
-creates a friendships table in the users.db database if one does not exist
-'''
-def create_friend_table():
-    """Create a table to store friend relationships"""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS friendships (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user1_id INTEGER,
-        user2_id INTEGER,
-        status TEXT DEFAULT 'pending',
-        FOREIGN KEY(user1_id) REFERENCES users(id),
-        FOREIGN KEY(user2_id) REFERENCES users(id)
-    )
-''')
-    conn.commit()
-    conn.close()
-    
-'''
-create_notifications_table():
-creates a notifications table in the users.db database if one does not exist
+current_user_id():
+returns the id of the logged-in user, stored in the session at login
+sessions created before the id was stored are resolved once and upgraded
+
+returns:
+the user id, or None if the session user no longer exists
 '''
-def create_notifications_table():
-    """Create a table to store notifications for users"""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS notifications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        type TEXT,
-        message TEXT,
-        is_read INTEGER DEFAULT 0,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    ''')
-    conn.commit()
-    conn.close()
-
-def create_likes_table():
-    """Create a table to store likes on posts"""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS likes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        post_id INTEGER NOT NULL,
-        UNIQUE(user_id, post_id),
-        FOREIGN KEY(user_id) REFERENCES users(id),
-        FOREIGN KEY(post_id) REFERENCES posts(id)
-    )
-    ''')
-    conn.commit()
-    conn.close()
-
-def create_comments_table():
-    """Create a table to store comments on posts"""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS comments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        post_id INTEGER NOT NULL,
-        user_id INTEGER NOT NULL,
-        content TEXT,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(id),
-        FOREIGN KEY(post_id) REFERENCES posts(id)
-    )
-    ''')
-    conn.commit()
-    conn.close()
+def current_user_id():
+    if 'user_id' not in session:
+        user = lookup_user(get_db(), session.get('username'))
+        if user is None:
+            return None
+        session['user_id'] = user['id']
+    return session['user_id']
+
 
 '''
-get_friends_posts(username):
-retrieves all posts of frineds from the user.db database
+render_feed(user_id, before_id=None):
+renders one page of the home feed for a user as a stream: the page starts
+going out once the first chunk of posts is fetched, and the rest are fetched
+and rendered as the client reads
 
 params:
-username - a string of a username that is in the user.db database
+user_id - the id of a user that is in the user.db database
+before_id - optional keyset cursor, see iter_friends_posts()
 returns:
-all_posts - a list of all posts from friends of [username] in the users.db data
+an iterator of the rendered home.html page, in chunks
 '''
-def get_friends_posts(username):
-    all_posts = []
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (username,))
-    user_id = cursor.fetchone()[0]
-    # Find mutual friends: both users have added each other
-    cursor.execute('''
-        SELECT u.username FROM users u
-        WHERE u.id != ? AND EXISTS (
-            SELECT 1 FROM friendships f1 WHERE f1.user1_id = ? AND f1.user2_id = u.id
-        ) AND EXISTS (
-            SELECT 1 FROM friendships f2 WHERE f2.user1_id = u.id AND f2.user2_id = ?
-        )
-    ''', (user_id, user_id, user_id))
-    mutual_friends = cursor.fetchall()
-    for friend in mutual_friends:
-        friend_username = friend[0]
-        cursor.execute('SELECT * FROM posts WHERE username = ? ORDER BY timestamp DESC', (friend_username,))
-        posts = cursor.fetchall()
-        for post in posts:
-            post_id = post[0]
-            cursor.execute('SELECT COUNT(*) FROM likes WHERE post_id = ?', (post_id,))
-            like_count = cursor.fetchone()[0]
-            cursor.execute('SELECT COUNT(*) FROM comments WHERE post_id = ?', (post_id,))
-            comment_count = cursor.fetchone()[0]
-            cursor.execute('SELECT 1 FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
-            liked = cursor.fetchone() is not None
-            all_posts.append({
-                'id': post[0],
-                'username': post[1],
-                'post_content': post[2],
-                'timestamp': post[3],
-                'like_count': like_count,
-                'comment_count': comment_count,
-                'liked': liked
-            })
-    conn.close()
-    return all_posts
+def render_feed(user_id, before_id=None):
+    # Nothing is queried until the template reaches the posts; stream_template keeps the
+    # request context (and so g.db from get_db()) open until the response is closed
+    return stream_template('home.html', posts=iter_friends_posts(user_id, before_id), page_size=FEED_PAGE_SIZE)
 
 
 @app.route('/')
@@ -238,20 +191,22 @@ def signup():
             return render_template('signup.html', errors=errors)
 
         # Hash the password before storing
-        hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        try:
+            hashed_pw = passwords.hash_password(password, request.remote_addr, username)
+        except passwords.PasswordBusy:
+            return render_template('signup.html', error="Too many sign ups right now. Please try again in a moment."), 429
 
-        conn = create_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         try:
             cursor.execute('INSERT INTO users (name, username, password, age, college, pfp) VALUES (?, ?, ?, ?, ?, ?)',
                            (name, username, hashed_pw, age, college, pfp))
             conn.commit()
-            conn.close()
+            invalidate_user(username)
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             conn.rollback()
-            conn.close()
             return render_template('signup.html', error="Username already exists. Please choose a different one.")
 
     return render_template('signup.html')
@@ -263,174 +218,208 @@ def home():
         username = request.form['username']
         password = request.form['password']
 
-        conn = create_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         # Perform case-insensitive lookup for login
         cursor.execute('SELECT * FROM users WHERE username = ? COLLATE NOCASE', (username,))
         user = cursor.fetchone()
-        if user and bcrypt.checkpw(password.encode('utf-8'), user[3]):
+        try:
+            valid = user is not None and passwords.check_password(password, user[3], request.remote_addr, username)
+        except passwords.PasswordBusy:
+            return render_template('login.html', error="Too many login attempts right now. Please try again in a moment.", username=username), 429
+        if valid and passwords.needs_rehash(user[3]):
+            # The cost factor changed since this hash was made; if hashing is busy the
+            # login still goes through and the next one tries again
+            try:
+                passwords.rehash_password(cursor, user[0], password, request.remote_addr)
+                conn.commit()
+            except passwords.PasswordBusy:
+                pass
+        if valid:
             # Successful login - set the session to the stored username (preserve original casing)
             stored_username = user[2]
             stored_pfp = user[6] if len(user) > 6 else ''
             session['username'] = stored_username
+            session['user_id'] = user[0]
             session['pfp'] = stored_pfp
-            all_posts = get_friends_posts(stored_username)
-            return render_template('home.html', posts=all_posts)
+            return render_feed(user[0])
         else:
             # Failed login - show error on login page
-            conn.close()
             return render_template('login.html', error="Invalid username or password.", username=username)
 
-        
-
-        if user:
-            all_posts = get_friends_posts(username)
-            # Successful login - set the session and redirect to home page
-            session['username'] = username
-            return render_template('home.html', posts=all_posts)
-        else:
-            # Failed login - handle appropriately (redirect to login page, display error, etc.)
-            return "Login failed. Invalid username or password."
-
     # Check if the user is logged in using the session
     if 'username' in session:
         username = session['username']
         # ensure pfp is available in session
         if 'pfp' not in session:
-            conn = create_connection()
-            cur = conn.cursor()
-            cur.execute('SELECT pfp FROM users WHERE username = ? COLLATE NOCASE', (username,))
-            row = cur.fetchone()
-            if row:
-                session['pfp'] = row[0]
-            conn.close()
-        all_posts = get_friends_posts(username)
-        return render_template('home.html', posts=all_posts)
+            user = lookup_user(get_db(), username)
+            if user:
+                session['pfp'] = user['pfp']
+        user_id = current_user_id()
+        if user_id is None:
+            return redirect(url_for('login'))
+        before_id = request.args.get('before', type=int)
+        # Repeat views are answered from the ETag / fragment cache
+        return httpcache.respond(httpcache.feed_tag(get_db(), user_id, before_id),
+                                 lambda: render_feed(user_id, before_id))
     else:
         return redirect(url_for('login'))
 
+@app.route('/feed', methods=['GET'])
+def feed():
+    """Return one page of the home feed as JSON (?before=<post id>), for infinite scroll"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': 'User not found'}), 404
+    before_id = request.args.get('before', type=int)
+
+    def render():
+        posts = get_friends_posts(user_id, before_id)
+        next_before = posts[-1]['id'] if len(posts) == FEED_PAGE_SIZE else None
+        return jsonify({'posts': posts, 'next_before': next_before}).get_data()
+
+    # Same versions as the HTML page, kept apart from it in the fragment cache
+    tag = httpcache.etag('feed.json', httpcache.feed_tag(get_db(), user_id, before_id))
+    return httpcache.respond(tag, render, 'application/json')
+
 #@app.route('/profile/<username>', methods=['GET'])
 @app.route('/profile/<username>', methods=['GET'])
 def profile(username):
-    print("Username parameter:", username)
     if 'username' in session:
         if username:
-            # Fetch user profile information from the database and pass it to the template
-            conn = create_connection()
-            cursor = conn.cursor()
-
-            # Case-insensitive profile lookup
-            cursor.execute('SELECT * FROM users WHERE username = ? COLLATE NOCASE', (username,))
-            user_data = cursor.fetchone()
-            print(user_data)
-            # Get the count of followed users for the logged-in user
-            
-            # Fetch mutual friends only
-            cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (username,))
-            user_id = cursor.fetchone()[0]
-            cursor.execute('''
-                SELECT u.* FROM users u
-                WHERE u.id != ? AND EXISTS (
-                    SELECT 1 FROM friendships f1 WHERE f1.user1_id = ? AND f1.user2_id = u.id
-                ) AND EXISTS (
-                    SELECT 1 FROM friendships f2 WHERE f2.user1_id = u.id AND f2.user2_id = ?
-                )
-            ''', (user_id, user_id, user_id))
-            friends = cursor.fetchall()
-
-            # Only show posts if friendship is accepted
-            posts = []
-            my_username = session['username']
-            cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (my_username,))
-            my_id_row = cursor.fetchone()
-            cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (username,))
-            other_id_row = cursor.fetchone()
-            is_friend = False
-            if my_id_row and other_id_row:
-                my_id = my_id_row[0]
-                other_id = other_id_row[0]
-                cursor.execute('SELECT status FROM friendships WHERE ((user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)) AND status = "accepted"', (my_id, other_id, other_id, my_id))
-                if cursor.fetchone():
-                    is_friend = True
-            if user_data:
-                if is_friend or my_username == username:
-                    cursor.execute('SELECT * FROM posts WHERE username = ? ORDER BY timestamp DESC', (user_data[2],))
-                    posts_raw = cursor.fetchall()
-                    posts = []
-                    for post in posts_raw:
-                        post_id = post[0]
-                        cursor.execute('SELECT COUNT(*) FROM likes WHERE post_id = ?', (post_id,))
-                        like_count = cursor.fetchone()[0]
-                        cursor.execute('SELECT COUNT(*) FROM comments WHERE post_id = ?', (post_id,))
-                        comment_count = cursor.fetchone()[0]
-                        posts.append((post[0], post[1], post[2], post[3], like_count))
-                    conn.close()
-                    # convert posts to include comment count
-                    posts_with_counts = []
-                    for p in posts:
-                        # p is (id, username, content, timestamp, like_count)
-                        cursor_conn = create_connection()
-                        cur = cursor_conn.cursor()
-                        cur.execute('SELECT COUNT(*) FROM comments WHERE post_id = ?', (p[0],))
-                        cc = cur.fetchone()[0]
-                        cursor_conn.close()
-                        posts_with_counts.append((p[0], p[1], p[2], p[3], p[4], cc))
-                    return render_template('profile.html', user=user_data, posts=posts_with_counts, friends=friends)
-                else:
-                    conn.close()
-                    return render_template('profile.html', user=user_data, posts=None, friends=friends, not_friends=True)
-            else:
-                conn.close()
+            conn = get_db()
+
+            # Case-insensitive profile lookup (served from the identity cache)
+            user_data = lookup_user(conn, username)
+            if not user_data:
                 return "User data not found."
+            user_id = user_data['id']
+            my_id = current_user_id()
+            before_id = request.args.get('before', type=int)
+
+            def render():
+                data = profiles.load_profile(conn, username, my_id, before_id)
+                if data['posts'] is None:
+                    return render_template('profile.html', user=data['user'], posts=None, friends=data['friends'],
+                                           not_friends=True)
+                return render_template('profile.html', user=data['user'], posts=data['posts'],
+                                       friends=data['friends'], next_before=data['next_before'])
+
+            # The profile changes with its user's version (posts, counts, friendships) and with
+            # the versions of the friends it lists (names and avatars)
+            tag = httpcache.profile_tag(conn, my_id, user_id, before_id)
+            return httpcache.respond(tag, render)
         else:
             return "Username not provided."
     else:
         return redirect(url_for('login'))
-    
-    
+
+
+'''
+write_avatar(cursor, user_id, username, pfp):
+sets a user's avatar and invalidates every cached page that shows it (runs on the writer thread)
+
+params:
+cursor - a cursor on the users.db database
+user_id, username - the user
+pfp - the avatar key returned by avatars.save_upload()
+'''
+def write_avatar(cursor, user_id, username, pfp):
+    cursor.execute('UPDATE users SET pfp = ? WHERE id = ?', (pfp, user_id))
+    # Their feed items and profile are covered by their own version, their comments by each post's
+    cursor.execute('SELECT DISTINCT post_id FROM comments WHERE user_id = ?', (user_id,))
+    commented = [f'post:{row[0]}' for row in cursor.fetchall()]
+    writequeue.on_commit(invalidate_user, username)
+    writequeue.on_commit(httpcache.bump, f'user:{user_id}', *commented)
+
+
+@app.route('/profile/avatar', methods=['POST'])
+def upload_avatar():
+    """Store an uploaded profile picture as thumbnails and make it the user's avatar"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    if not avatars.available():
+        return jsonify({'error': 'Picture uploads are not available'}), 503
+    if request.content_length and request.content_length > avatars.MAX_UPLOAD_BYTES + 64 * 1024:
+        return jsonify({'error': 'Picture is too large'}), 413
+    upload = request.files.get('avatar')
+    if upload is None:
+        return jsonify({'error': 'avatar is required'}), 400
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': 'User not found'}), 404
+    try:
+        pfp = avatars.save_upload(upload.read(avatars.MAX_UPLOAD_BYTES + 1))
+    except avatars.InvalidImage:
+        return jsonify({'error': 'Not a supported picture'}), 400
+    except avatars.AvatarBusy:
+        return jsonify({'error': 'Too many uploads right now. Please try again in a moment.'}), 429
+    writequeue.write(write_avatar, user_id, session['username'], pfp)
+    session['pfp'] = pfp
+    return redirect(url_for('profile', username=session['username']))
+
+
+@app.route('/avatars/<name>', methods=['GET'])
+def avatar_file(name):
+    """Serve a thumbnail; its name is its content hash, so it can be cached forever"""
+    if not avatars.filename_ok(name):
+        return 'Not found', 404
+    response = send_from_directory(avatars.AVATAR_DIR, name, max_age=avatars.CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={avatars.CACHE_MAX_AGE}, immutable'
+    return response
+
+
 @app.route('/search', methods=['GET'])
 def search():
     if 'username' in session:
         search_username = request.args.get('search_username')
 
-        conn = create_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         # Case-insensitive search lookup (but return stored-case username/display info)
-        cursor.execute('SELECT * FROM users WHERE username = ? COLLATE NOCASE', (search_username,))
-        user_data = cursor.fetchone()
+        user_data = lookup_user(conn, search_username)
 
         friend_status = None
         if user_data:
-            # Get IDs (case-insensitive)
-            cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (session['username'],))
-            my_id_row = cursor.fetchone()
-            cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (search_username,))
-            other_id_row = cursor.fetchone()
-            if my_id_row and other_id_row:
-                my_id = my_id_row[0]
-                other_id = other_id_row[0]
-                # Check if current user has added searched user
-                cursor.execute('SELECT * FROM friendships WHERE user1_id = ? AND user2_id = ?', (my_id, other_id))
-                added = cursor.fetchone()
-                # Check if searched user has added current user
-                cursor.execute('SELECT * FROM friendships WHERE user1_id = ? AND user2_id = ?', (other_id, my_id))
-                added_back = cursor.fetchone()
-                if added and added_back:
-                    friend_status = 'friends'
-                elif added:
-                    friend_status = 'pending'
-                else:
-                    friend_status = None
-            conn.close()
+            my_id = current_user_id()
+            other_id = user_data['id']
+            if my_id:
+                friend_status = friend_graph.friend_status(cursor, my_id, other_id)
             return render_template('search.html', user_data=user_data, friend_status=friend_status)
         else:
-            conn.close()
             return render_template('search.html', user_not_found=True)
     return redirect(url_for('login'))
 
 
+@app.route('/search/users', methods=['GET'])
+def search_users():
+    """Return ranked, paginated JSON user matches for as-you-type search"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 0, type=int), 0)
+    results, has_more = fulltext.search_users(get_db().cursor(), query, page)
+    return jsonify({'results': results, 'next_page': page + 1 if has_more else None})
+
+
+@app.route('/search/posts', methods=['GET'])
+def search_posts():
+    """Return ranked, paginated JSON post matches (with snippets) visible to the current user"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': 'User not found'}), 404
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 0, type=int), 0)
+    results, has_more = fulltext.search_posts(get_db().cursor(), user_id, query, page)
+    return jsonify({'results': results, 'next_page': page + 1 if has_more else None})
+
+
 @app.route('/makepost', methods=['GET'])
 def make_post():
     return render_template('makepost.html')
@@ -439,7 +428,7 @@ def make_post():
 def create_post():
     post = request.form.get('post')
     username = request.form.get('username')
-    conn = create_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     # conn2 = create_connection()
@@ -449,65 +438,90 @@ def create_post():
     # user_data = cursor2.fetchone()
 
     # conn2.close()
-    print("username:")
-    print(username)
-    print("post:")
-    print(post)
+    user = lookup_user(conn, username)
+    if not user:
+        return redirect(url_for('login'))
     try:
-        cursor.execute('INSERT INTO posts (username, post_content) VALUES (?, ?)', 
-                        (username, post))
+        # timestamp is the legacy text column; NULL instead of its DEFAULT keeps the row small
+        cursor.execute('INSERT INTO posts (author_id, post_content, created_at, timestamp) VALUES (?, ?, ?, NULL)',
+                       (user['id'], post, int(time.time())))
+        # Push the new post into friends' timelines (no-op unless fan-out is enabled)
+        timeline.fan_out(cursor, user['id'], cursor.lastrowid)
 
         conn.commit()
-        conn.close()
+        httpcache.bump(f"user:{user['id']}")
 
-        all_posts = get_friends_posts(username)
-
-        return render_template('home.html', posts=all_posts)
+        return redirect(url_for('home'))
     except sqlite3.IntegrityError:
             conn.rollback()
-            conn.close()
             return "Post could not be posted at this time"
     
 
 
+'''
+push_after_commit(topic, event, data):
+publishes an event to /events streams once the current queued write commits
+'''
+def push_after_commit(topic, event, data):
+    writequeue.on_commit(pushhub.publish, topic, event, data)
+
+
+'''
+push_notification(cursor, user_id, type, message):
+tells [user_id]'s open pages about a new notification and their unread count
+'''
+def push_notification(cursor, user_id, type, message):
+    push_after_commit(f'user:{user_id}', 'notification',
+                      {'type': type, 'message': message, 'unread': inbox.unread_count(cursor, user_id)})
+
+
+'''
+write_friend_request(cursor, user_id, friend_id, username):
+records a friend request and notifies the user being added (runs on the writer thread)
+
+params:
+cursor - a cursor on the users.db database
+user_id - id of the user adding a friend
+friend_id - id of the user being added
+username - username of the user adding a friend, for the notification message
+returns:
+the status from friends.add_friend_request()
+'''
+def write_friend_request(cursor, user_id, friend_id, username):
+    status = friend_graph.add_friend_request(cursor, user_id, friend_id)
+    if status == 'exists':
+        return status
+    if status == 'friends':
+        timeline.on_new_friendship(cursor, user_id, friend_id)
+    # Add notification for the user being added
+    writequeue.on_commit(httpcache.bump, f'user:{user_id}', f'user:{friend_id}')
+    message = f"{username} added you as a friend."
+    inbox.notify(cursor, friend_id, 'friend_request', user_id, message)
+    push_notification(cursor, friend_id, 'friend_request', message)
+    return status
+
+
 @app.route('/addfriend', methods=['POST'])
 def add_friend():
     if 'username' in session:
         friend_username = request.form.get('username')
 
-        conn = create_connection()
-        cursor = conn.cursor()
+        conn = get_db()
 
         # Get the IDs of the logged-in user and the user to be added as a friend (case-insensitive)
-        cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (session['username'],))
-        user1_row = cursor.fetchone()
-        if not user1_row:
-            conn.close()
+        user1_id = current_user_id()
+        if not user1_id:
             return "Current user not found."
-        user1_id = user1_row[0]
 
-        cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (friend_username,))
-        user2_row = cursor.fetchone()
+        user2_row = lookup_user(conn, friend_username)
         if not user2_row:
-            conn.close()
             return "User to add not found."
-        user2_id = user2_row[0]
-
-        # Only prevent duplicate adds in the same direction
-        cursor.execute('SELECT * FROM friendships WHERE user1_id = ? AND user2_id = ?', (user1_id, user2_id))
-        existing_friendship = cursor.fetchone()
+        user2_id = user2_row['id']
 
-        if existing_friendship:
-            conn.close()
+        # Add the friendship to the database (only duplicate adds in the same direction are refused)
+        status = writequeue.write(write_friend_request, user1_id, user2_id, session['username'])
+        if status == 'exists':
             return "Friend already added."
-
-        # Add the friendship to the database
-        cursor.execute('INSERT INTO friendships (user1_id, user2_id) VALUES (?, ?)', (user1_id, user2_id))
-        # Add notification for the user being added
-        cursor.execute('INSERT INTO notifications (user_id, type, message) VALUES (?, ?, ?)',
-                       (user2_id, 'friend_request', f"{session['username']} added you as a friend."))
-        conn.commit()
-        conn.close()
         return "Friend added successfully."
     return redirect(url_for('login'))
 
@@ -515,143 +529,259 @@ def add_friend():
 @app.route('/logout')
 def logout():
     session.pop('username', None)
+    session.pop('user_id', None)
     return redirect(url_for('login'))
 
 @app.route('/notifications')
 def notifications():
     if 'username' in session:
-        conn = create_connection()
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (session['username'],))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
+        user_id = current_user_id()
+        if not user_id:
             return redirect(url_for('login'))
-        user_id = row[0]
-        cursor.execute('SELECT * FROM notifications WHERE user_id = ? ORDER BY timestamp DESC', (user_id,))
-        notifications = cursor.fetchall()
-        conn.close()
-        return render_template('notifications.html', notifications=notifications)
+        notifications = inbox.list_notifications(cursor, user_id, request.args.get('before', type=int))
+        next_before = notifications[-1]['id'] if len(notifications) == inbox.NOTIFICATIONS_PAGE_SIZE else None
+        return render_template('notifications.html', notifications=notifications, next_before=next_before,
+                               unread=inbox.unread_count(cursor, user_id))
     return redirect(url_for('login'))
 
+@app.route('/notifications/mark_read', methods=['POST'])
+def mark_notifications_read():
+    """Mark a comma separated list of notification ids, everything up to an id, or everything as read"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        ids = [int(i) for i in request.form.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'Invalid notification id'}), 400
+    unread = writequeue.write(inbox.mark_read, user_id, ids, request.form.get('up_to', type=int))
+    # Other open pages of this user update their badge
+    pushhub.publish(f'user:{user_id}', 'unread', {'unread': unread})
+    return jsonify({'unread': unread})
+
+@app.route('/events')
+def events():
+    """Server-Sent Events stream of notifications for the user and of likes and comments on ?posts=1,2,3"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': 'Not logged in'}), 401
+    post_ids = [p for p in request.args.get('posts', '').split(',') if p.isdigit()]
+    topics = [f'user:{user_id}'] + [f'post:{int(p)}' for p in post_ids[:pushhub.MAX_POST_TOPICS]]
+    try:
+        # A page re-opening its stream (to follow more posts) passes ?last_event_id= itself
+        sub = pushhub.subscribe(topics, request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    except pushhub.HubFull:
+        return jsonify({'error': 'Too many open streams'}), 503
+    initial = [('unread', {'unread': inbox.unread_count(get_db().cursor(), user_id)})]
+    return Response(pushhub.stream(sub, initial), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics/passwords')
+def password_metrics():
+    """Return password hashing latency and queue depth as JSON"""
+    return jsonify(passwords.metrics())
+
+@app.route('/metrics/cache')
+def cache_metrics():
+    """Return ETag / fragment cache counters as JSON"""
+    return jsonify(httpcache.metrics())
+
+@app.route('/metrics/push')
+def push_metrics():
+    """Return event hub counters and the number of open streams as JSON"""
+    return jsonify(pushhub.metrics())
+
+@app.route('/metrics/admission')
+def admission_metrics():
+    """Return admitted / rejected request counters and limited requests in progress as JSON"""
+    return jsonify(admission.metrics())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Return per-route latency histograms, SQL counters and the other metrics for Prometheus"""
+    gauges = {
+        'passwords': passwords.metrics(),
+        'writequeue': writequeue.metrics(),
+        'push': pushhub.metrics(),
+        'cache': httpcache.metrics(),
+        'avatars': avatars.metrics(),
+        'archive': archive.metrics(),
+        'admission': admission.metrics(),
+    }
+    return Response(instrument.prometheus(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/check_username', methods=['POST'])
 def check_username():
     username = request.form.get('username')
-    conn = create_connection()
-    cursor = conn.cursor()
     # Check existence case-insensitively
-    cursor.execute('SELECT 1 FROM users WHERE username = ? COLLATE NOCASE', (username,))
-    exists = cursor.fetchone() is not None
-    conn.close()
+    exists = lookup_user(get_db(), username) is not None
     return jsonify({'available': not exists})
 
 
 @app.route('/comments/<int:post_id>', methods=['GET'])
 def get_comments(post_id):
-    """Return JSON list of comments for a given post id"""
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT c.id, u.username, c.content, c.timestamp, u.pfp
-        FROM comments c
-        JOIN users u ON u.id = c.user_id
-        WHERE c.post_id = ?
-        ORDER BY c.timestamp DESC
-    ''', (post_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    comments = []
-    for r in rows:
-        comments.append({'id': r[0], 'username': r[1], 'content': r[2], 'timestamp': r[3], 'pfp': r[4]})
-    return jsonify({'comments': comments})
+    """Return one page of a post's comments as JSON, newest first (?before=<comment id> for older ones)"""
+    before_id = request.args.get('before', type=int)
+
+    def render():
+        return jsonify(comment_lists.comment_page(get_db(), post_id, before_id)).get_data()
+
+    tag = httpcache.etag('comments', post_id, before_id, httpcache.version(f'post:{post_id}'))
+    return httpcache.respond(tag, render, 'application/json')
+
+
+@app.route('/comments/preview', methods=['GET'])
+def comment_previews():
+    """Return the newest comments and comment count of each post in ?posts=1,2,3 as JSON"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    post_ids = [int(p) for p in request.args.get('posts', '').split(',') if p.isdigit()]
+    post_ids = list(dict.fromkeys(post_ids))[:comment_lists.MAX_PREVIEW_POSTS]
+
+    def render():
+        found = comment_lists.previews(get_db().cursor(), post_ids)
+        return jsonify({'posts': {str(post_id): preview for post_id, preview in found.items()}}).get_data()
+
+    # Changes when any of the posts' comment lists does
+    tag = httpcache.etag('previews', tuple(post_ids), tuple(httpcache.version(f'post:{p}') for p in post_ids))
+    return httpcache.respond(tag, render, 'application/json')
+
+
+'''
+write_comment(cursor, post_id, user_id, username, content):
+adds a comment, notifies the post author and pushes the comment to pages showing the post
+(runs on the writer thread)
+
+params:
+cursor - a cursor on the users.db database
+post_id - id of the post being commented on
+user_id, username - the commenting user
+content - the comment text
+returns:
+False if there is no such post in users.db (archived posts are read-only), True otherwise
+'''
+def write_comment(cursor, post_id, user_id, username, content):
+    cursor.execute('SELECT 1 FROM posts WHERE id = ?', (post_id,))
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute('INSERT INTO comments (post_id, user_id, content) VALUES (?, ?, ?)', (post_id, user_id, content))
+    comment_id = cursor.lastrowid
+    # optional: add notification to post author
+    cursor.execute('SELECT author_id, comment_count FROM posts WHERE id = ?', (post_id,))
+    post_author_row = cursor.fetchone()
+    if post_author_row:
+        author_id = post_author_row[0]
+        # The post's comment list, and its author's feed and profile (comment count), changed
+        writequeue.on_commit(httpcache.bump, f'post:{post_id}', *([f'user:{author_id}'] if author_id else []))
+        if author_id and author_id != user_id:
+            message = f"{username} commented on your post."
+            inbox.notify(cursor, author_id, 'comment', user_id, message, post_id)
+            push_notification(cursor, author_id, 'comment', message)
+        cursor.execute('SELECT timestamp FROM comments WHERE id = ?', (comment_id,))
+        commenter = lookup_user(cursor.connection, username)
+        push_after_commit(f'post:{post_id}', 'comment', {
+            'post_id': post_id, 'id': comment_id, 'username': username, 'content': content,
+            'timestamp': cursor.fetchone()[0], 'pfp': commenter['pfp'] if commenter else None,
+            'avatar': avatars.url(commenter['pfp'], 64) if commenter else None,
+            'comment_count': post_author_row[1],
+        })
+    return True
 
 
 @app.route('/add_comment', methods=['POST'])
 def add_comment():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
-    post_id = request.form.get('post_id')
+    post_id = request.form.get('post_id', type=int)
     content = request.form.get('content')
     if not post_id or not content:
         return jsonify({'error': 'post_id and content are required'}), 400
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (session['username'],))
-    user_row = cursor.fetchone()
-    if not user_row:
-        conn.close()
+    user_id = current_user_id()
+    if not user_id:
         return jsonify({'error': 'User not found'}), 404
-    user_id = user_row[0]
     try:
-        cursor.execute('INSERT INTO comments (post_id, user_id, content) VALUES (?, ?, ?)', (post_id, user_id, content))
-        # optional: add notification to post author
-        cursor.execute('SELECT username FROM posts WHERE id = ?', (post_id,))
-        post_author_row = cursor.fetchone()
-        if post_author_row:
-            post_author = post_author_row[0]
-            if post_author != session['username']:
-                cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (post_author,))
-                author_id_row = cursor.fetchone()
-                if author_id_row:
-                    author_id = author_id_row[0]
-                    cursor.execute('INSERT INTO notifications (user_id, type, message) VALUES (?, ?, ?)',
-                                   (author_id, 'comment', f"{session['username']} commented on your post."))
-        conn.commit()
-        conn.close()
+        if not writequeue.write(write_comment, post_id, user_id, session['username'], content):
+            return jsonify({'error': 'Post not found'}), 404
         return jsonify({'success': True})
     except sqlite3.IntegrityError:
-        conn.rollback()
-        conn.close()
         return jsonify({'error': 'Could not add comment'}), 500
 
+
+'''
+write_like(cursor, post_id, user_id, username, action, author_id):
+likes or unlikes a post, counts a first like in its author's notification and pushes the new
+like count to pages showing the post (runs on the writer thread)
+
+params:
+cursor - a cursor on the users.db database
+post_id - id of the post
+user_id, username - the user liking the post
+action - 'like' or 'unlike'
+author_id - id of the post's author, or None if the author no longer exists
+returns:
+the post's like count after the write, or None if there is no such post in users.db
+(it may have been archived since the caller looked it up)
+'''
+def write_like(cursor, post_id, user_id, username, action, author_id):
+    delta = 0
+    if action == 'like':
+        try:
+            # Only while the post is still in users.db, so no like is left behind for an archived one
+            cursor.execute('INSERT INTO likes (user_id, post_id) SELECT ?, ? WHERE EXISTS (SELECT 1 FROM posts WHERE id = ?)',
+                           (user_id, post_id, post_id))
+            if cursor.rowcount == 0:
+                return None
+            delta = 1
+            # Count the like in the author's notification for this post
+            message = inbox.notify_like(cursor, author_id, post_id, user_id, username)
+            if message:
+                push_notification(cursor, author_id, 'like', message)
+        except sqlite3.IntegrityError:
+            pass  # Already liked
+    elif action == 'unlike':
+        cursor.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
+        delta = -cursor.rowcount
+    # Get updated like count (read inside the same transaction, so it includes this write)
+    cursor.execute('SELECT like_count FROM posts WHERE id = ?', (post_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    like_count = row[0]
+    if delta:
+        writequeue.on_commit(httpcache.bump, f'user:{author_id}')
+        push_after_commit(f'post:{post_id}', 'like', {'post_id': post_id, 'delta': delta, 'like_count': like_count})
+    return like_count
+
+
 @app.route('/like_post', methods=['POST'])
 def like_post():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
-    post_id = request.form.get('post_id')
+    post_id = request.form.get('post_id', type=int)
     action = request.form.get('action')  # 'like' or 'unlike'
-    conn = create_connection()
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (session['username'],))
-    user_id = cursor.fetchone()[0]
-    cursor.execute('SELECT username FROM posts WHERE id = ?', (post_id,))
+    user_id = current_user_id()
+    # Checked here so an IntegrityError in write_like only ever means an existing like
+    if not user_id:
+        return jsonify({'error': 'User not found'}), 404
+    cursor.execute('SELECT author_id FROM posts WHERE id = ?', (post_id,))
     post_author_row = cursor.fetchone()
     if not post_author_row:
-        conn.close()
         return jsonify({'error': 'Post not found'}), 404
-    post_author = post_author_row[0]
-    if action == 'like':
-        # Check if this user has ever liked this post before
-        cursor.execute('SELECT 1 FROM notifications WHERE user_id = (SELECT id FROM users WHERE username = ? COLLATE NOCASE) AND type = "like" AND message = ? LIMIT 1',
-                       (post_author, f"{session['username']} liked your post."))
-        already_notified = cursor.fetchone() is not None
-        try:
-            cursor.execute('INSERT INTO likes (user_id, post_id) VALUES (?, ?)', (user_id, post_id))
-            # Add notification for post author if not self and not already notified
-            if post_author != session['username'] and not already_notified:
-                cursor.execute('SELECT id FROM users WHERE username = ? COLLATE NOCASE', (post_author,))
-                author_id = cursor.fetchone()[0]
-                cursor.execute('INSERT INTO notifications (user_id, type, message) VALUES (?, ?, ?)',
-                               (author_id, 'like', f"{session['username']} liked your post."))
-            conn.commit()
-        except sqlite3.IntegrityError:
-            pass  # Already liked
-    elif action == 'unlike':
-        cursor.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
-        conn.commit()
-    # Get updated like count
-    cursor.execute('SELECT COUNT(*) FROM likes WHERE post_id = ?', (post_id,))
-    like_count = cursor.fetchone()[0]
-    conn.close()
+    like_count = writequeue.write(write_like, post_id, user_id, session['username'], action, post_author_row[0])
+    if like_count is None:
+        return jsonify({'error': 'Post not found'}), 404
     return jsonify({'like_count': like_count})
 
 if __name__ == '__main__':
-    create_table()  # Create the table when the app starts
-    create_post_table() # Create the table for the posts
-    create_friend_table()
-    create_notifications_table()
-    create_likes_table()
-    create_comments_table()
+    migrations.migrate()  # Create or upgrade the tables when the app starts
     app.run(debug=True)
     #app.run(host='10.6.8.167', port=5000, debug=True)
 
@@ -0,0 +1,590 @@
+'''
+archive.py
+moves old posts, their likes and comments, and old read notifications out of
+users.db into one archive database per year
+
+users.db only keeps the last ARCHIVE_AFTER_DAYS days of activity, so the pages
+every request reads stay in the page cache and the mmap window; older rows are
+copied into ARCHIVE_DIR/<year>.db and then deleted from users.db, at most
+ARCHIVE_BATCH_SIZE rows per transaction
+
+an archive database is only ATTACHed when a profile, a post search or a comment
+list goes past what is left in users.db; archive_periods and archive_authors in
+users.db record which years hold whose posts, so a profile only opens the years
+its user actually posted in. archived posts are read-only: they can not be liked
+or commented on. unread notifications are never archived, so the notifications
+page and the unread count, which only read users.db, still show them
+
+archiving runs in its own process, so it can not bump a running server's cache
+versions; instead every run that moves posts rewrites ARCHIVE_DIR/epoch, which
+the server reads back (epoch()) into every ETag, so cached pages still showing
+the moved posts stop matching within EPOCH_CHECK_SECONDS
+
+export() writes users.db and every archive to one stream of JSON lines, a row per
+line, and import_backup() loads such a stream into an empty database, so a full
+backup never has to fit in memory
+
+usage:
+python archive.py run [--vacuum]   archive everything older than ARCHIVE_AFTER_DAYS
+python archive.py status           list the archive databases
+python archive.py export <file>    write a full backup of users.db and the archives (.gz to compress)
+python archive.py import <file>    restore a backup into an empty users.db
+'''
+import base64
+import calendar
+import gzip
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+import db
+import migrations
+from db import create_connection
+
+# Posts (with their likes and comments) and notifications older than this many days are archived
+ARCHIVE_AFTER_DAYS = int(os.environ.get('QUAD_ARCHIVE_AFTER_DAYS', 365))
+# Directory of the archive databases (QUAD_ARCHIVE_DIR points it elsewhere);
+# by default an archive/ directory next to users.db
+ARCHIVE_DIR = os.environ.get('QUAD_ARCHIVE_DIR')
+# Rows moved per transaction
+ARCHIVE_BATCH_SIZE = 500
+# Rows written per transaction when importing a backup
+IMPORT_BATCH_SIZE = 1000
+# Version of the backup format written by export()
+BACKUP_FORMAT = 1
+# Rewritten whenever posts are archived; see epoch()
+EPOCH_FILE = 'epoch'
+# Seconds a running server keeps using the epoch it last read
+EPOCH_CHECK_SECONDS = 1.0
+
+_PERIOD = re.compile(r'^\d{4}$')
+_epoch = {'value': '', 'checked': float('-inf')}
+
+# Archive databases hold the posts' own columns (not the legacy username/timestamp),
+# with the indexes the profile, search and comment queries need
+ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS {schema}.posts (
+        id INTEGER PRIMARY KEY,
+        author_id INTEGER,
+        post_content TEXT,
+        created_at INTEGER,
+        like_count INTEGER NOT NULL DEFAULT 0,
+        comment_count INTEGER NOT NULL DEFAULT 0
+    )''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_posts_author_created ON posts(author_id, created_at, id)',
+    '''CREATE TABLE IF NOT EXISTS {schema}.likes (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_likes_post ON likes(post_id, user_id)',
+    '''CREATE TABLE IF NOT EXISTS {schema}.comments (
+        id INTEGER PRIMARY KEY,
+        post_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        content TEXT,
+        timestamp DATETIME
+    )''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_comments_post_timestamp ON comments(post_id, timestamp)',
+    '''CREATE TABLE IF NOT EXISTS {schema}.notifications (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        type TEXT,
+        message TEXT,
+        is_read INTEGER,
+        timestamp DATETIME,
+        actor_id INTEGER,
+        post_id INTEGER,
+        actor_count INTEGER
+    )''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_notifications_user_timestamp ON notifications(user_id, timestamp)',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.posts_fts USING fts5(
+        post_content,
+        content='posts', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )''',
+)
+
+POST_COLUMNS = 'id, author_id, post_content, created_at, like_count, comment_count'
+LIKE_COLUMNS = 'id, user_id, post_id'
+COMMENT_COLUMNS = 'id, post_id, user_id, content, timestamp'
+NOTIFICATION_COLUMNS = 'id, user_id, type, message, is_read, timestamp, actor_id, post_id, actor_count'
+
+
+'''
+archive_path(period):
+returns the path of the archive database for [period] (a year, e.g. '2024')
+'''
+def archive_path(period):
+    return os.path.join(_archive_dir(), f'{period}.db')
+
+
+def _archive_dir():
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(db.DATABASE_PATH)), 'archive')
+
+
+'''
+period_start(period):
+returns the epoch time at which [period] starts; every post in it is at least this old
+'''
+def period_start(period):
+    return calendar.timegm((int(period), 1, 1, 0, 0, 0))
+
+
+'''
+attached(conn, period, create=False):
+context manager that ATTACHes the archive database of [period] to [conn] and
+yields its schema name, detaching it again afterwards; the caller commits any
+writes before the block ends
+
+params:
+conn - a connection to the users.db database, not in a transaction
+period - the archive's year
+create - create the archive database and its tables if they do not exist
+'''
+@contextmanager
+def attached(conn, period, create=False):
+    schema = _attach(conn, period, create)
+    try:
+        yield schema
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.execute(f'DETACH DATABASE {schema}')
+
+
+def _attach(conn, period, create=False):
+    schema = f'archive_{period}'
+    if create:
+        os.makedirs(_archive_dir(), exist_ok=True)
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path(period),))
+    if create:
+        for statement in ARCHIVE_SCHEMA:
+            conn.execute(statement.format(schema=schema))
+        conn.commit()
+    return schema
+
+
+'''
+epoch():
+returns a token that changes every time posts are archived (empty before the
+first run), read from ARCHIVE_DIR at most every EPOCH_CHECK_SECONDS; httpcache
+puts it in every ETag, since the archive run can not bump the server's versions
+'''
+def epoch():
+    now = time.monotonic()
+    if now - _epoch['checked'] >= EPOCH_CHECK_SECONDS:
+        try:
+            with open(os.path.join(_archive_dir(), EPOCH_FILE)) as f:
+                _epoch['value'] = f.read().strip()
+        except OSError:
+            _epoch['value'] = ''
+        _epoch['checked'] = now
+    return _epoch['value']
+
+
+def _bump_epoch():
+    # Written to a temporary file and renamed, so a server never reads half of it
+    path = os.path.join(_archive_dir(), EPOCH_FILE)
+    temporary = f'{path}.{os.getpid()}'
+    with open(temporary, 'w') as f:
+        f.write(format(time.time_ns(), 'x'))
+    os.replace(temporary, path)
+    _epoch['checked'] = float('-inf')
+
+
+def _present(periods):
+    # A catalogued archive whose file has been removed is skipped rather than recreated empty
+    return [period for period in periods if os.path.exists(archive_path(period))]
+
+
+'''
+author_periods(conn, author_id):
+returns the periods holding archived posts of [author_id], newest first
+'''
+def author_periods(conn, author_id):
+    rows = conn.execute('SELECT period FROM archive_authors WHERE author_id = ? ORDER BY period DESC', (author_id,))
+    return _present(row[0] for row in rows)
+
+
+'''
+search_periods(conn, user_id):
+returns the periods holding archived posts of [user_id] or of their mutual friends,
+newest first (the posts a post search by [user_id] may return)
+'''
+def search_periods(conn, user_id):
+    rows = conn.execute('''
+        SELECT DISTINCT period FROM archive_authors
+        WHERE author_id = ? OR author_id IN (SELECT friend_id FROM friends WHERE user_id = ?)
+        ORDER BY period DESC
+    ''', (user_id, user_id))
+    return _present(row[0] for row in rows)
+
+
+'''
+locate(conn, post_id):
+returns the period of the archive holding post [post_id], or None if it is not archived
+'''
+def locate(conn, post_id):
+    rows = conn.execute('''
+        SELECT period FROM archive_periods WHERE ? BETWEEN first_post_id AND last_post_id ORDER BY period DESC
+    ''', (post_id,)).fetchall()
+    for period in _present(row[0] for row in rows):
+        with attached(conn, period) as schema:
+            # fetchall() finishes the statement, which DETACH needs
+            if conn.execute(f'SELECT 1 FROM {schema}.posts WHERE id = ?', (post_id,)).fetchall():
+                return period
+    return None
+
+
+'''
+position(conn, post_id):
+returns (created_at, id) of post [post_id], wherever it is, for keyset pagination
+across users.db and the archives, or None if there is no such post
+'''
+def position(conn, post_id):
+    row = conn.execute('SELECT created_at, id FROM posts WHERE id = ?', (post_id,)).fetchone()
+    if row:
+        return row
+    period = locate(conn, post_id)
+    if period is None:
+        return None
+    with attached(conn, period) as schema:
+        rows = conn.execute(f'SELECT created_at, id FROM {schema}.posts WHERE id = ?', (post_id,)).fetchall()
+    return rows[0] if rows else None
+
+
+def _move_posts(conn, period, ids):
+    marks = ', '.join('?' * len(ids))
+    with attached(conn, period, create=True) as schema:
+        # Copy and commit first, then delete: a crash in between leaves the rows in both
+        # databases (users.db in WAL mode does not make the two commits atomic), and the
+        # next run copies them over themselves; the catalog is counted from the archive
+        # itself, so such a rerun does not count them twice
+        conn.execute(f'''
+            INSERT INTO {schema}.posts_fts (rowid, post_content)
+            SELECT id, post_content FROM main.posts p
+            WHERE id IN ({marks}) AND NOT EXISTS (SELECT 1 FROM {schema}.posts a WHERE a.id = p.id)
+        ''', ids)
+        conn.execute(f'INSERT OR REPLACE INTO {schema}.posts ({POST_COLUMNS}) '
+                     f'SELECT {POST_COLUMNS} FROM main.posts WHERE id IN ({marks})', ids)
+        conn.execute(f'INSERT OR REPLACE INTO {schema}.likes ({LIKE_COLUMNS}) '
+                     f'SELECT {LIKE_COLUMNS} FROM main.likes WHERE post_id IN ({marks})', ids)
+        conn.execute(f'INSERT OR REPLACE INTO {schema}.comments ({COMMENT_COLUMNS}) '
+                     f'SELECT {COMMENT_COLUMNS} FROM main.comments WHERE post_id IN ({marks})', ids)
+        conn.commit()
+
+        conn.execute(f'''
+            INSERT INTO archive_periods (period, first_post_id, last_post_id, posts)
+            SELECT ?, MIN(id), MAX(id), COUNT(*) FROM {schema}.posts WHERE true
+            ON CONFLICT (period) DO UPDATE SET
+                first_post_id = excluded.first_post_id,
+                last_post_id = excluded.last_post_id,
+                posts = excluded.posts
+        ''', (period,))
+        conn.execute(f'''
+            INSERT INTO archive_authors (author_id, period, posts)
+            SELECT author_id, ?, COUNT(*) FROM {schema}.posts
+            WHERE author_id IN (SELECT author_id FROM main.posts WHERE id IN ({marks}))
+            GROUP BY author_id
+            ON CONFLICT (author_id, period) DO UPDATE SET posts = excluded.posts
+        ''', [period] + ids)
+        # Out of the fan-out timelines too, or the feed's JOIN posts drops them and pages come
+        # back short; only the author's friends' timelines hold a post, so this walks their
+        # primary keys rather than the whole table
+        conn.execute(f'''
+            DELETE FROM main.timeline WHERE (user_id, post_id) IN (
+                SELECT f.friend_id, p.id FROM main.posts p
+                JOIN main.friends f ON f.user_id = p.author_id
+                WHERE p.id IN ({marks})
+            )
+        ''', ids)
+        # Posts first, so the counter triggers on likes and comments find nothing to update
+        conn.execute(f'DELETE FROM main.posts WHERE id IN ({marks})', ids)
+        conn.execute(f'DELETE FROM main.likes WHERE post_id IN ({marks})', ids)
+        conn.execute(f'DELETE FROM main.comments WHERE post_id IN ({marks})', ids)
+        conn.execute(f'DELETE FROM main.notified_likes WHERE post_id IN ({marks})', ids)
+        conn.commit()
+    _bump_epoch()
+
+
+def _move_notifications(conn, period, ids):
+    marks = ', '.join('?' * len(ids))
+    with attached(conn, period, create=True) as schema:
+        conn.execute(f'INSERT OR REPLACE INTO {schema}.notifications ({NOTIFICATION_COLUMNS}) '
+                     f'SELECT {NOTIFICATION_COLUMNS} FROM main.notifications WHERE id IN ({marks})', ids)
+        conn.commit()
+        conn.execute(f'''
+            INSERT INTO archive_periods (period, notifications)
+            SELECT ?, COUNT(*) FROM {schema}.notifications WHERE true
+            ON CONFLICT (period) DO UPDATE SET notifications = excluded.notifications
+        ''', (period,))
+        conn.execute(f'DELETE FROM main.notifications WHERE id IN ({marks})', ids)
+        conn.commit()
+
+
+'''
+archive_old(conn, max_age_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+moves posts older than [max_age_days] days, with their likes and comments, and
+read notifications older than that into the archive database of their year
+
+params:
+conn - a connection to the users.db database
+max_age_days - rows older than this many days are archived
+batch_size - the most rows moved per transaction
+returns:
+a dict with the number of posts and notifications archived
+'''
+def archive_old(conn, max_age_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    cutoff = int(time.time()) - max_age_days * 86400
+    moved = {'posts': 0, 'notifications': 0}
+    while True:
+        oldest = conn.execute('SELECT MIN(created_at) FROM posts').fetchone()[0]
+        if oldest is None or oldest >= cutoff:
+            break
+        year = time.gmtime(oldest).tm_year
+        # A batch never spans two years, so it goes into a single archive
+        bound = min(cutoff, period_start(year + 1))
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM posts WHERE created_at < ? ORDER BY created_at, id LIMIT ?', (bound, batch_size))]
+        _move_posts(conn, str(year), ids)
+        moved['posts'] += len(ids)
+
+    # Notification ids do not follow their timestamps (like notifications are bumped in
+    # place), so they are walked in id order, one batch at a time
+    cutoff_text = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(cutoff))
+    last_id = 0
+    while True:
+        rows = conn.execute('SELECT id, timestamp, is_read FROM notifications WHERE id > ? ORDER BY id LIMIT ?',
+                            (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        by_period = {}
+        for notification_id, timestamp, is_read in rows:
+            # Unread ones stay where the notifications page and unread count can see them
+            if is_read and timestamp and timestamp < cutoff_text and _PERIOD.match(timestamp[:4]):
+                by_period.setdefault(timestamp[:4], []).append(notification_id)
+        for period, ids in by_period.items():
+            _move_notifications(conn, period, ids)
+            moved['notifications'] += len(ids)
+    return moved
+
+
+def _tables(conn, schema):
+    rows = conn.execute(f"SELECT name, sql FROM {schema}.sqlite_master WHERE type = 'table'").fetchall()
+    virtual = [name for name, sql in rows if sql.upper().startswith('CREATE VIRTUAL')]
+    # Full-text indexes (and their shadow tables) are rebuilt on import, not copied
+    return [name for name, _ in rows
+            if not name.startswith('sqlite_') and name != 'schema_migrations'
+            and name not in virtual and not any(name.startswith(v + '_') for v in virtual)]
+
+
+def _encode(value):
+    return {'b64': base64.b64encode(value).decode('ascii')} if isinstance(value, bytes) else value
+
+
+def _decode(value):
+    return base64.b64decode(value['b64']) if isinstance(value, dict) else value
+
+
+def _export_schema(conn, schema, name, write):
+    counts = {}
+    for table in _tables(conn, schema):
+        cursor = conn.execute(f'SELECT * FROM {schema}.{table}')
+        write({'db': name, 'table': table, 'columns': [d[0] for d in cursor.description]})
+        counts[table] = 0
+        for row in cursor:
+            write([_encode(value) for value in row])
+            counts[table] += 1
+    return counts
+
+
+'''
+export(conn, out):
+writes a full backup of users.db and every archive database to [out], as JSON
+lines: a header, then for each table a line with its name and columns followed by
+one line per row
+
+users.db is read in one transaction, so the backup is a consistent snapshot of it
+even while the app keeps writing; it is read before the archives, so rows an
+archive run moves in the meantime show up twice rather than not at all
+
+params:
+conn - a connection to the users.db database
+out - a text file to write to
+returns:
+{database: {table: rows}} for every table written
+'''
+def export(conn, out):
+    def write(item):
+        out.write(json.dumps(item, separators=(',', ':')) + '\n')
+
+    write({'format': BACKUP_FORMAT,
+           'schema_version': conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()[0]})
+    periods = [row[0] for row in conn.execute('SELECT period FROM archive_periods ORDER BY period')]
+    conn.execute('BEGIN')
+    try:
+        counts = {'main': _export_schema(conn, 'main', 'main', write)}
+    finally:
+        conn.rollback()
+    for period in _present(periods):
+        with attached(conn, period) as schema:
+            counts[period] = _export_schema(conn, schema, period, write)
+    return counts
+
+
+'''
+import_backup(conn, lines):
+restores a backup written by export() into users.db, which must be migrated and
+empty, recreating the archive databases it contains; counters are recomputed
+afterwards, since the triggers count the imported likes, comments and notifications again
+
+params:
+conn - a connection to the migrated, empty users.db database
+lines - an iterable of the backup's lines
+returns:
+the number of rows imported
+raises:
+ValueError if the backup is not usable or the database is not empty
+'''
+def import_backup(conn, lines):
+    lines = iter(lines)
+    header = json.loads(next(lines, 'null') or 'null')
+    if not isinstance(header, dict) or header.get('format') != BACKUP_FORMAT:
+        raise ValueError('not a backup written by archive.py export')
+    if header['schema_version'] > max(migrations.applied_versions(conn), default=0):
+        raise ValueError(f"backup needs schema version {header['schema_version']}; update and migrate first")
+    if conn.execute('SELECT EXISTS (SELECT 1 FROM users)').fetchone()[0]:
+        raise ValueError(f'{db.DATABASE_PATH} is not empty')
+
+    imported = 0
+    schemas = {'main': 'main'}
+    insert = None
+    batch = []
+    try:
+        for line in lines:
+            item = json.loads(line)
+            if isinstance(item, list):
+                batch.append([_decode(value) for value in item])
+                imported += 1
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    conn.executemany(insert, batch)
+                    conn.commit()
+                    batch.clear()
+                continue
+            if batch:
+                conn.executemany(insert, batch)
+                conn.commit()
+                batch.clear()
+            name = item['db']
+            if name not in schemas:
+                if not _PERIOD.match(name):
+                    raise ValueError(f'unknown database {name!r} in backup')
+                if os.path.exists(archive_path(name)):
+                    raise ValueError(f'{archive_path(name)} already exists')
+                schemas[name] = _attach(conn, name, create=True)
+            schema = schemas[name]
+            # Only tables and columns that exist here, so a backup can not inject SQL
+            if item['table'] not in _tables(conn, schema):
+                raise ValueError(f"unknown table {item['table']!r} in backup")
+            known = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({item['table']})")}
+            if not set(item['columns']) <= known:
+                raise ValueError(f"unknown columns in {item['table']} in backup")
+            insert = (f"INSERT INTO {schema}.{item['table']} ({', '.join(item['columns'])}) "
+                      f"VALUES ({', '.join('?' * len(item['columns']))})")
+        if batch:
+            conn.executemany(insert, batch)
+            conn.commit()
+        for schema in list(schemas.values())[1:]:
+            conn.execute(f"INSERT INTO {schema}.posts_fts (posts_fts) VALUES ('rebuild')")
+            conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        for schema in list(schemas.values())[1:]:
+            conn.execute(f'DETACH DATABASE {schema}')
+    migrations.reconcile_counters(conn.cursor())
+    migrations.reconcile_unread(conn.cursor())
+    migrations.reconcile_timelines(conn.cursor())
+    conn.commit()
+    return imported
+
+
+'''
+metrics():
+returns the sizes of users.db and the archive databases in bytes, and the mmap
+window users.db is meant to fit in
+'''
+def metrics():
+    directory = _archive_dir()
+    files = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith('.db')] if os.path.isdir(directory) else []
+    return {
+        'hot_bytes': sum(os.path.getsize(db.DATABASE_PATH + suffix) for suffix in ('', '-wal')
+                         if os.path.exists(db.DATABASE_PATH + suffix)),
+        'mmap_bytes': dict(db.PRAGMAS)['mmap_size'],
+        'archive_files': len(files),
+        'archive_bytes': sum(os.path.getsize(path) for path in files),
+    }
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdout if mode == 'w' else sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'run':
+        migrations.migrate()
+        conn = create_connection()
+        moved = archive_old(conn)
+        print(f"Archived {moved['posts']} post(s) and {moved['notifications']} notification(s)")
+        if '--vacuum' in sys.argv:
+            # Gives the freed pages back to the file system; rewrites users.db, so run it when quiet
+            conn.execute('VACUUM')
+        conn.close()
+    elif command == 'status':
+        conn = create_connection()
+        for period, posts, notifications in conn.execute(
+                'SELECT period, posts, notifications FROM archive_periods ORDER BY period'):
+            path = archive_path(period)
+            size = os.path.getsize(path) if os.path.exists(path) else None
+            print(f"{period}  {posts:>8} post(s)  {notifications:>8} notification(s)  "
+                  f"{f'{size / 1e6:.1f} MB' if size is not None else 'missing'}  {path}")
+        conn.close()
+    elif command == 'export' and len(sys.argv) > 2:
+        conn = create_connection()
+        out = _open(sys.argv[2], 'w')
+        try:
+            counts = export(conn, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        conn.close()
+        print(f"Exported {sum(sum(tables.values()) for tables in counts.values())} row(s) "
+              f"from {len(counts)} database(s)", file=sys.stderr)
+    elif command == 'import' and len(sys.argv) > 2:
+        migrations.migrate()
+        conn = create_connection()
+        source = _open(sys.argv[2], 'r')
+        try:
+            print(f"Imported {import_backup(conn, source)} row(s)")
+        except ValueError as e:
+            print(f"Import failed: {e}")
+            sys.exit(1)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            conn.close()
+    else:
+        print(__doc__)
+        sys.exit(1)
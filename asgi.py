@@ -0,0 +1,436 @@
+'''
+asgi.py
+asynchronous serving mode for Quad
+
+run with an ASGI server instead of app.run(), e.g.:
+uvicorn asgi:application --host 0.0.0.0 --port 8000
+
+the hot, high-concurrency routes are served natively on the event loop with
+their database work going through aiodb: /events (an idle stream costs no
+thread), /like_post, /comments/<id>, /comments/preview and /search/users, plus
+the /avatars/ files; every other route is the unchanged Flask app, run on a
+bounded pool of WSGI_WORKERS threads, so a thread is only held while a request
+is actually being handled, never for an idle keep-alive or event-stream
+connection
+
+use a single worker process: the write queue, event hub and caches are per process
+'''
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+import admission
+import aiodb
+import avatars
+import comment_lists
+import app as quad
+import fulltext
+import httpcache
+import inbox
+import instrument
+import migrations
+import pushhub
+import writequeue
+from identity import lookup_user
+
+# Threads running the Flask app for routes that are not served natively
+WSGI_WORKERS = int(os.environ.get('QUAD_WSGI_WORKERS', 16))
+# Chunks of a Flask response waiting for a slow client before its WSGI thread waits too
+WSGI_BUFFER_CHUNKS = 16
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_WORKERS, thread_name_prefix='quad-wsgi')
+
+
+def _headers(scope):
+    headers = {}
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').lower()
+        value = value.decode('latin-1')
+        headers[name] = headers[name] + ', ' + value if name in headers else value
+    return headers
+
+
+def _session(headers):
+    # Read the Flask session cookie the same way the Flask app does
+    cookie = parse_cookie(headers.get('cookie', '')).get(quad.app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    serializer = quad.app.session_interface.get_signing_serializer(quad.app)
+    try:
+        return serializer.loads(cookie, max_age=int(quad.app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def _user_id(session):
+    if 'username' not in session:
+        return None
+    if 'user_id' in session:
+        return session['user_id']
+    user = await aiodb.run(lookup_user, session['username'])
+    return user['id'] if user else None
+
+
+async def _body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+def _form(body):
+    return {k: v[0] for k, v in parse_qs(body.decode('utf-8'), keep_blank_values=True).items()}
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _profile_headers():
+    # The same profiling headers the Flask app adds (see instrument.init_app)
+    profile = instrument.current()
+    if profile is None:
+        return []
+    return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in instrument.headers(profile, time.perf_counter() - profile.started)]
+
+
+async def _json(send, data, status=200, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                + list(headers) + _profile_headers()})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+'''
+events(scope, receive, send, headers, query):
+async /events; same stream as the Flask route, without a thread per client
+'''
+async def events(scope, receive, send, headers, query):
+    user_id = await _user_id(_session(headers))
+    if not user_id:
+        return await _json(send, {'error': 'Not logged in'}, 401)
+    post_ids = [p for p in query.get('posts', [''])[0].split(',') if p.isdigit()]
+    topics = [f'user:{user_id}'] + [f'post:{int(p)}' for p in post_ids[:pushhub.MAX_POST_TOPICS]]
+    try:
+        sub = pushhub.subscribe(topics, headers.get('last-event-id') or query.get('last_event_id', [None])[0])
+    except pushhub.HubFull:
+        return await _json(send, {'error': 'Too many open streams'}, 503)
+    unread = await aiodb.run(lambda conn: inbox.unread_count(conn.cursor(), user_id))
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+
+    async def pump():
+        async for chunk in pushhub.astream(sub, [('unread', {'unread': unread})]):
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if tasks[0] in done:
+            # The stream ended on our side (client too far behind); close the response
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        for task in tasks:
+            task.cancel()
+        pushhub.unsubscribe(sub)
+
+
+'''
+like_post(scope, receive, send, headers, query):
+async /like_post; the write itself still goes through the write queue
+'''
+async def like_post(scope, receive, send, headers, query):
+    session = _session(headers)
+    if 'username' not in session:
+        return await _json(send, {'error': 'Not logged in'}, 401)
+    body = await _body(receive)
+    if body is None:
+        return
+    form = _form(body)
+    post_id = _int(form.get('post_id'))
+    user_id = await _user_id(session)
+    if not user_id:
+        return await _json(send, {'error': 'User not found'}, 404)
+
+    def author_of(conn):
+        return conn.execute('SELECT author_id FROM posts WHERE id = ?', (post_id,)).fetchone()
+
+    author = await aiodb.run(author_of)
+    if author is None:
+        return await _json(send, {'error': 'Post not found'}, 404)
+    like_count = await asyncio.wait_for(asyncio.wrap_future(writequeue.submit(
+        quad.write_like, post_id, user_id, session['username'], form.get('action'), author[0])),
+        writequeue.WRITE_TIMEOUT)
+    if like_count is None:
+        return await _json(send, {'error': 'Post not found'}, 404)
+    await _json(send, {'like_count': like_count})
+
+
+'''
+comments(scope, receive, send, headers, query, post_id):
+async /comments/<post_id>, answered from httpcache like the Flask route
+'''
+async def comments(scope, receive, send, headers, query, post_id):
+    before_id = _int(query.get('before', [None])[0])
+    tag = httpcache.etag('comments', post_id, before_id, httpcache.version(f'post:{post_id}'))
+    await _cached_json(send, headers, tag, lambda conn: comment_lists.comment_page(conn, post_id, before_id))
+
+
+'''
+comment_previews(scope, receive, send, headers, query):
+async /comments/preview, answered from httpcache like the Flask route
+'''
+async def comment_previews(scope, receive, send, headers, query):
+    if 'username' not in _session(headers):
+        return await _json(send, {'error': 'Not logged in'}, 401)
+    post_ids = [int(p) for p in query.get('posts', [''])[0].split(',') if p.isdigit()]
+    post_ids = list(dict.fromkeys(post_ids))[:comment_lists.MAX_PREVIEW_POSTS]
+    tag = httpcache.etag('previews', tuple(post_ids), tuple(httpcache.version(f'post:{p}') for p in post_ids))
+
+    def load(conn):
+        found = comment_lists.previews(conn.cursor(), post_ids)
+        return {'posts': {str(post_id): preview for post_id, preview in found.items()}}
+
+    await _cached_json(send, headers, tag, load)
+
+
+async def _cached_json(send, headers, tag, load):
+    # httpcache.respond() for the native routes; load(conn) runs on aiodb only on a cache miss
+    cache_headers = [(b'etag', f'"{tag}"'.encode()), (b'cache-control', b'private, no-cache')]
+    if f'"{tag}"' in headers.get('if-none-match', ''):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': cache_headers})
+        return await send({'type': 'http.response.body', 'body': b''})
+    body = httpcache.fragments.get(tag)
+    if body is None:
+        body = json.dumps(await aiodb.run(load)).encode('utf-8')
+        httpcache.fragments.put(tag, body)
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/json')] + cache_headers + _profile_headers()})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+'''
+avatar_file(scope, send, name):
+async /avatars/<name>; handed to the server as a zero-copy sendfile when it
+supports the ASGI zero-copy extension, otherwise read on a thread
+'''
+async def avatar_file(scope, send, name):
+    path = os.path.join(avatars.AVATAR_DIR, name)
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return await _json(send, {'error': 'Not found'}, 404)
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'image/webp' if name.endswith('.webp') else b'image/jpeg'),
+        (b'content-length', str(size).encode()),
+        (b'cache-control', f'public, max-age={avatars.CACHE_MAX_AGE}, immutable'.encode()),
+    ]})
+    if 'http.response.zerocopysend' in scope.get('extensions', {}):
+        with open(path, 'rb') as f:
+            return await send({'type': 'http.response.zerocopysend', 'file': f})
+
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+
+    await send({'type': 'http.response.body', 'body': await asyncio.get_running_loop().run_in_executor(None, read)})
+
+
+'''
+search_users(scope, receive, send, headers, query):
+async /search/users
+'''
+async def search_users(scope, receive, send, headers, query):
+    if 'username' not in _session(headers):
+        return await _json(send, {'error': 'Not logged in'}, 401)
+    page = max(_int(query.get('page', ['0'])[0]) or 0, 0)
+    q = query.get('q', [''])[0]
+    results, has_more = await aiodb.run(lambda conn: fulltext.search_users(conn.cursor(), q, page))
+    await _json(send, {'results': results, 'next_page': page + 1 if has_more else None})
+
+
+def _environ(scope, body):
+    # PEP 3333 environ for the Flask app
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in _headers(scope).items():
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+def _run_wsgi(environ, loop, out, abandoned):
+    # Runs on a WSGI thread; the whole response is produced on this one thread
+    # (Flask's request context is thread-bound) and handed to the loop chunk by chunk.
+    # [out] is bounded and put() waits for room, so a slow client slows the streamed
+    # page down instead of having all of it buffered; once the loop side gives up
+    # ([abandoned]) nothing more is queued and the response is closed
+    def put(item):
+        if not abandoned.is_set():
+            asyncio.run_coroutine_threadsafe(out.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put(('start', status, headers))
+        return lambda data: put(('body', data, None))
+
+    try:
+        result = quad.app(environ, start_response)
+        try:
+            for chunk in result:
+                if abandoned.is_set():
+                    break
+                if chunk:
+                    put(('body', chunk, None))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    finally:
+        put(('end', None, None))
+
+
+'''
+wsgi(scope, receive, send):
+serves a request with the Flask app on the WSGI thread pool
+'''
+async def wsgi(scope, receive, send):
+    body = await _body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    out = asyncio.Queue(maxsize=WSGI_BUFFER_CHUNKS)
+    abandoned = threading.Event()
+    done = loop.run_in_executor(_wsgi_executor, _run_wsgi, _environ(scope, body), loop, out, abandoned)
+    started = False
+    try:
+        while True:
+            kind, first, second = await out.get()
+            if kind == 'start':
+                status = int(first.split(' ', 1)[0])
+                headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in second]
+                await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                started = True
+            elif kind == 'body':
+                await send({'type': 'http.response.body', 'body': first, 'more_body': True})
+            else:
+                break
+    except BaseException:
+        # Sending failed or we were cancelled: stop the WSGI thread, and make room for a
+        # put() it may be waiting on, so it does not hold its thread forever
+        abandoned.set()
+        while not out.empty():
+            out.get_nowait()
+        raise
+    await done
+    if started:
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+_ROUTES = {
+    ('POST', '/like_post'): like_post,
+    ('GET', '/search/users'): search_users,
+    ('GET', '/comments/preview'): comment_previews,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Same as app.py's __main__: create or upgrade the tables
+            await asyncio.get_running_loop().run_in_executor(None, migrations.migrate)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            aiodb.close()
+            _wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+'''
+application(scope, receive, send):
+the ASGI entry point
+'''
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    path = scope['path']
+    if scope['method'] == 'GET' and path == '/events':
+        # Not profiled: the stream lasts as long as the client stays connected
+        return await events(scope, receive, send, _headers(scope), parse_qs(scope['query_string'].decode('latin-1')))
+    if scope['method'] == 'GET' and path.startswith('/avatars/') and avatars.filename_ok(path[len('/avatars/'):]):
+        return await avatar_file(scope, send, path[len('/avatars/'):])
+    handler = _ROUTES.get((scope['method'], path))
+    if handler is None and scope['method'] == 'GET' and path.startswith('/comments/') \
+            and path[len('/comments/'):].isdigit():
+        handler, path = comments, '/comments/<int:post_id>'
+    if handler is None:
+        # The Flask app profiles its own requests
+        return await wsgi(scope, receive, send)
+    profile, token = instrument.start()
+    release = None
+    try:
+        headers = _headers(scope)
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        # The same admission control as the Flask routes (admission.init_app)
+        try:
+            release = admission.admit(f"{scope['method']} {path}", _session(headers).get('user_id'),
+                                      scope['client'][0] if scope.get('client') else None)
+        except admission.Rejected as rejected:
+            seconds = admission.retry_after(rejected)
+            message = f'Too many requests. Please try again in {seconds} second(s).'
+            return await _json(send, {'error': message, 'retry_after': seconds}, 429,
+                               [(b'retry-after', str(seconds).encode())])
+        if handler is comments:
+            return await comments(scope, receive, send, headers, query, int(scope['path'][len('/comments/'):]))
+        return await handler(scope, receive, send, headers, query)
+    finally:
+        if release is not None:
+            release()
+        instrument.finish(profile, token, f"{scope['method']} {path}", time.perf_counter() - profile.started)
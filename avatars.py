@@ -0,0 +1,204 @@
+'''
+avatars.py
+profile picture uploads, thumbnails and content-addressed storage
+
+an upload is decoded once, off the request thread, in a small process pool, and
+cut into square thumbnails of every AVATAR_SIZES size (WebP when Pillow can
+write it, JPEG otherwise); the files are named after a hash of the uploaded
+bytes, so a file's content never changes under its name and it can be served
+with a year-long immutable cache lifetime, and re-uploading the same picture
+costs no decoding at all
+
+users.pfp stores the avatar key '<hash>.<ext>'; url() turns it into the URL of
+one size, anything else in the column (older free-text values) means no avatar
+
+Pillow is optional: without it available() is False and uploads are refused,
+every page still renders with initials
+'''
+import atexit
+import hashlib
+import io
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# Directory the thumbnails are written to (QUAD_AVATAR_DIR points it elsewhere)
+AVATAR_DIR = os.environ.get('QUAD_AVATAR_DIR', os.path.join(os.getcwd(), 'avatars'))
+# Square thumbnail sizes in pixels: 32/64 for comment and feed badges (1x/2x), 256 for profiles
+AVATAR_SIZES = (32, 64, 256)
+# Largest upload accepted, in bytes
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+# Largest decoded image accepted, in pixels (guards against decompression bombs)
+MAX_PIXELS = 40_000_000
+# Encoder quality for the thumbnails
+QUALITY = 80
+# Number of worker processes decoding uploads
+AVATAR_WORKERS = int(os.environ.get('QUAD_AVATAR_WORKERS', min(2, os.cpu_count() or 1)))
+# Maximum uploads being processed or waiting at once
+MAX_PENDING = AVATAR_WORKERS * 4
+# Seconds to wait for a worker before giving up
+PROCESS_TIMEOUT = 20
+# Cache lifetime of the served files; their names change whenever their content does
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+_key_re = re.compile(r'^([0-9a-f]{32})\.(webp|jpg)$')
+_file_re = re.compile(r'^[0-9a-f]{32}-[0-9]+\.(webp|jpg)$')
+
+
+class InvalidImage(Exception):
+    """Raised when an upload is not an image we can decode, or is too large."""
+
+
+class AvatarBusy(Exception):
+    """Raised when too many uploads are already being processed."""
+
+
+def _thumbnails(data, sizes, image_format):
+    # Runs in a worker process
+    with Image.open(io.BytesIO(data)) as im:
+        if im.width * im.height > MAX_PIXELS:
+            raise ValueError('image too large')
+        # Let the JPEG decoder scale down while decoding instead of after
+        im.draft('RGB', (max(sizes) * 2, max(sizes) * 2))
+        im = ImageOps.exif_transpose(im)
+        im = im.convert('RGBA' if image_format == 'WEBP' else 'RGB')
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        # Each size is cut from the previous, larger one
+        im = ImageOps.fit(im, (size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        im.save(buffer, image_format, quality=QUALITY, optimize=True)
+        thumbnails[size] = buffer.getvalue()
+    return thumbnails
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_state_lock = threading.Lock()
+_pending = 0
+_stats = {'uploads': 0, 'processed': 0, 'deduplicated': 0, 'invalid': 0, 'rejected': 0}
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=AVATAR_WORKERS)
+            atexit.register(_executor.shutdown, wait=False)
+        return _executor
+
+
+def _extension():
+    return 'webp' if features.check('webp') else 'jpg'
+
+
+def _path(digest, size, ext):
+    return os.path.join(AVATAR_DIR, f'{digest}-{size}.{ext}')
+
+
+def _write(path, data):
+    # Write to a temporary name first so a half-written file is never served
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+'''
+available():
+returns whether uploads can be processed (Pillow is installed)
+'''
+def available():
+    return Image is not None
+
+
+'''
+save_upload(data):
+turns uploaded image bytes into stored thumbnails
+
+params:
+data - the bytes of the uploaded file
+returns:
+the avatar key to store in users.pfp
+raises:
+InvalidImage - [data] is too large or not a decodable image
+AvatarBusy - too many uploads are already being processed
+'''
+def save_upload(data):
+    global _pending
+    if len(data) > MAX_UPLOAD_BYTES:
+        _stats['invalid'] += 1
+        raise InvalidImage('file too large')
+    ext = _extension()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    _stats['uploads'] += 1
+    if all(os.path.exists(_path(digest, size, ext)) for size in AVATAR_SIZES):
+        _stats['deduplicated'] += 1
+        return f'{digest}.{ext}'
+
+    with _state_lock:
+        if _pending >= MAX_PENDING:
+            _stats['rejected'] += 1
+            raise AvatarBusy()
+        _pending += 1
+    try:
+        future = _get_executor().submit(_thumbnails, data, AVATAR_SIZES, 'WEBP' if ext == 'webp' else 'JPEG')
+        try:
+            thumbnails = future.result(timeout=PROCESS_TIMEOUT)
+        except TimeoutError:
+            future.cancel()
+            raise AvatarBusy()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            _stats['invalid'] += 1
+            raise InvalidImage(str(e))
+    finally:
+        with _state_lock:
+            _pending -= 1
+
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    for size, thumbnail in thumbnails.items():
+        _write(_path(digest, size, ext), thumbnail)
+    _stats['processed'] += 1
+    return f'{digest}.{ext}'
+
+
+'''
+url(pfp, size):
+returns the URL of one size of a user's avatar
+
+params:
+pfp - the user's users.pfp value
+size - one of AVATAR_SIZES
+returns:
+the URL, or None if the user has no uploaded avatar
+'''
+def url(pfp, size):
+    match = _key_re.match(pfp or '')
+    if match is None:
+        return None
+    return f'/avatars/{match.group(1)}-{size}.{match.group(2)}'
+
+
+'''
+filename_ok(name):
+returns whether [name] is the name of a thumbnail file (and nothing else, e.g. no path)
+'''
+def filename_ok(name):
+    return _file_re.match(name) is not None
+
+
+'''
+metrics():
+returns upload counters and the number of uploads being processed
+'''
+def metrics():
+    result = dict(_stats)
+    result['pending'] = _pending
+    result['available'] = available()
+    return result
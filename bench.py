@@ -0,0 +1,493 @@
+'''
+bench.py
+synthetic data generator and benchmark harness
+
+generate builds a users.db of a chosen size: users, a power-law friendship graph
+(preferential attachment, so a few users have many friends and most have few),
+posts, likes, comments and the notifications they would have produced
+
+run drives the real routes through Flask's test client, counting the SQL
+statements each request runs; http drives a running server with concurrent
+clients; both report p50/p95/p99 latency, throughput and queries per request per
+route, write the results as JSON and, given a baseline, flag regressions
+
+usage:
+python bench.py generate [--users 2000] [--avg-friends 20] [--posts 10] [--out bench.db]
+python bench.py run [--db bench.db] [--requests 200] [--out results.json] [--baseline baseline.json]
+python bench.py http --url http://127.0.0.1:5000 [--concurrency 16] [--duration 30] [--db bench.db] ...
+python bench.py compare results.json baseline.json [--threshold 0.2]
+
+start the server for http against the generated database with QUAD_DATABASE=bench.db;
+every generated user's password is BENCH_PASSWORD. every client of http comes
+from one address, so start the server with QUAD_ADMISSION=0 as well to measure
+the app rather than its rate limits; requests it turns away with 429 are
+counted per route (throttled) and left out of the latency figures
+'''
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+
+import db
+import passwords
+
+BENCH_PASSWORD = 'Bench-password-1!'
+# Routes exercised by run and http
+ROUTES = ('home', 'profile', 'search', 'comments', 'like_post', 'add_comment')
+# A route is a regression when p95 latency grows by more than this fraction...
+DEFAULT_THRESHOLD = 0.2
+# ...or it runs more SQL statements per request than the baseline did
+QUERY_SLACK = 0.5
+# Times http retries a login the server turned away with 429
+LOGIN_ATTEMPTS = 5
+
+WORDS = ('exam', 'library', 'coffee', 'lecture', 'party', 'campus', 'study', 'game', 'weekend', 'project',
+         'lab', 'dorm', 'pizza', 'club', 'professor', 'deadline', 'gym', 'concert', 'trip', 'notes')
+
+
+def _sentence(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+
+def _epoch(rng, days):
+    return int(time.time()) - rng.randrange(days * 86400)
+
+
+def _datetime(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _powerlaw_friendships(rng, n_users, avg_friends):
+    # Preferential attachment: each new user befriends m existing users picked in
+    # proportion to how many friends they already have
+    m = max(1, avg_friends // 2)
+    edges = set()
+    endpoints = []
+    for user in range(1, n_users + 1):
+        targets = set()
+        if user <= m + 1:
+            targets = set(range(1, user))
+        else:
+            while len(targets) < m:
+                targets.add(rng.choice(endpoints))
+        for other in targets:
+            edges.add((min(user, other), max(user, other)))
+            endpoints += [user, other]
+    return edges
+
+
+'''
+generate(path, users=2000, avg_friends=20, posts_per_user=10, likes_per_post=3,
+         comments_per_post=1, days=90, seed=1):
+creates a synthetic users.db at [path] (replacing any existing file) with the
+current schema and realistic-looking data
+
+params:
+path - where to write the database
+users - number of users
+avg_friends - average number of mutual friends per user (power-law distributed)
+posts_per_user - average posts per user (exponentially distributed)
+likes_per_post, comments_per_post - average likes / comments per post, skewed so
+    a few posts get most of them; likers and commenters are the author's friends
+days - posts, likes and comments are spread over this many past days
+seed - random seed, so the same arguments give the same database
+returns:
+a dict of row counts
+'''
+def generate(path, users=2000, avg_friends=20, posts_per_user=10, likes_per_post=3,
+             comments_per_post=1, days=90, seed=1):
+    import migrations
+
+    rng = random.Random(seed)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    previous_path = db.DATABASE_PATH
+    db.DATABASE_PATH = path
+    try:
+        conn = db.create_connection()
+        migrations.migrate(conn)
+        hashed = passwords._hashpw(BENCH_PASSWORD.encode('utf-8'), passwords.BCRYPT_ROUNDS)
+        conn.executemany('INSERT INTO users (id, name, username, password, age, college, pfp) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         ((i, f'User {i}', f'user{i}', hashed, rng.randint(18, 25), f'College {rng.randint(1, 50)}', '')
+                          for i in range(1, users + 1)))
+
+        edges = _powerlaw_friendships(rng, users, avg_friends)
+        friends_of = {i: [] for i in range(1, users + 1)}
+        for a, b in edges:
+            friends_of[a].append(b)
+            friends_of[b].append(a)
+        conn.executemany("INSERT INTO friendships (user1_id, user2_id, status) VALUES (?, ?, 'accepted')",
+                         [e for a, b in edges for e in ((a, b), (b, a))])
+        conn.executemany('INSERT INTO friends (user_id, friend_id) VALUES (?, ?)',
+                         [e for a, b in edges for e in ((a, b), (b, a))])
+        conn.executemany("INSERT INTO notifications (user_id, type, actor_id, message, is_read) VALUES (?, 'friend_request', ?, ?, ?)",
+                         ((b, a, f'user{a} added you as a friend.', int(rng.random() < 0.8)) for a, b in edges))
+
+        posts = []
+        for user in range(1, users + 1):
+            for _ in range(int(rng.expovariate(1 / posts_per_user)) if posts_per_user else 0):
+                posts.append((user, _sentence(rng, rng.randint(3, 20)), _epoch(rng, days)))
+        posts.sort(key=lambda p: p[2])
+        conn.executemany('INSERT INTO posts (author_id, post_content, created_at, timestamp) VALUES (?, ?, ?, NULL)', posts)
+
+        likes, comments = [], []
+        for post_id, (author, _, ts) in enumerate(posts, start=1):
+            audience = friends_of[author]
+            if not audience:
+                continue
+            # Pareto-shaped engagement: most posts get little, a few get a lot
+            n_likes = min(len(audience), int(likes_per_post * rng.paretovariate(2) / 2))
+            for liker in rng.sample(audience, n_likes):
+                likes.append((liker, post_id))
+            for _ in range(int(comments_per_post * rng.paretovariate(2) / 2)):
+                comments.append((post_id, rng.choice(audience), _sentence(rng, rng.randint(2, 10)), _datetime(ts)))
+        conn.executemany('INSERT INTO likes (user_id, post_id) VALUES (?, ?)', likes)
+        conn.executemany('INSERT INTO comments (post_id, user_id, content, timestamp) VALUES (?, ?, ?, ?)', comments)
+        conn.execute('INSERT OR IGNORE INTO notified_likes (post_id, user_id) SELECT post_id, user_id FROM likes')
+        # One aggregated like notification per liked post, as inbox.notify_like() keeps them
+        conn.execute('''
+            INSERT INTO notifications (user_id, type, actor_id, post_id, actor_count, message, is_read, timestamp)
+            SELECT p.author_id, 'like', MAX(l.user_id), p.id, COUNT(*),
+                   'user' || MAX(l.user_id) || CASE WHEN COUNT(*) > 1 THEN ' and ' || (COUNT(*) - 1) || ' others' ELSE '' END
+                   || ' liked your post.',
+                   abs(random()) % 5 != 0, datetime(p.created_at, 'unixepoch')
+            FROM likes l JOIN posts p ON p.id = l.post_id
+            GROUP BY p.id
+        ''')
+        conn.execute('''
+            INSERT INTO notifications (user_id, type, actor_id, post_id, message, is_read, timestamp)
+            SELECT p.author_id, 'comment', c.user_id, c.post_id, 'user' || c.user_id || ' commented on your post.',
+                   abs(random()) % 5 != 0, c.timestamp
+            FROM comments c JOIN posts p ON p.id = c.post_id
+            WHERE p.author_id != c.user_id
+        ''')
+        conn.commit()
+        counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('users', 'friends', 'posts', 'likes', 'comments', 'notifications')}
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.close()
+    finally:
+        db.DATABASE_PATH = previous_path
+    return counts
+
+
+class Targets:
+    """Users, friendships and posts of a generated database, for picking realistic requests."""
+
+    def __init__(self, path, seed=1):
+        conn = sqlite3.connect(path)
+        self.rng = random.Random(seed)
+        self.users = [r[0] for r in conn.execute('SELECT id FROM users')]
+        self.usernames = dict(conn.execute('SELECT id, username FROM users'))
+        self.friends = {}
+        for user_id, friend_id in conn.execute('SELECT user_id, friend_id FROM friends'):
+            self.friends.setdefault(user_id, []).append(friend_id)
+        self.posts_by = {}
+        for post_id, user_id in conn.execute('SELECT id, author_id FROM posts'):
+            self.posts_by.setdefault(user_id, []).append(post_id)
+        conn.close()
+        # Active users are the ones with friends
+        self.active = [u for u in self.users if u in self.friends] or self.users
+
+    def user(self):
+        return self.rng.choice(self.active)
+
+    def visible_post(self, user_id):
+        authors = [f for f in self.friends.get(user_id, []) if f in self.posts_by] or list(self.posts_by)
+        return self.rng.choice(self.posts_by[self.rng.choice(authors)]) if authors else 1
+
+    def request(self, route, user_id):
+        """Return (method, path, form data) for one request to [route] as [user_id]."""
+        if route == 'home':
+            return 'GET', '/home', None
+        if route == 'profile':
+            other = self.rng.choice(self.friends.get(user_id, [user_id]))
+            return 'GET', f'/profile/{self.usernames[other]}', None
+        if route == 'search':
+            return 'GET', f'/search?search_username={self.usernames[self.rng.choice(self.users)]}', None
+        if route == 'comments':
+            return 'GET', f'/comments/{self.visible_post(user_id)}', None
+        if route == 'like_post':
+            return 'POST', '/like_post', {'post_id': self.visible_post(user_id),
+                                           'action': self.rng.choice(('like', 'unlike'))}
+        if route == 'add_comment':
+            return 'POST', '/add_comment', {'post_id': self.visible_post(user_id),
+                                             'content': _sentence(self.rng, 5)}
+        raise ValueError(route)
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def _summarise(samples, elapsed, throttled=None):
+    # samples: route -> list of (seconds, statements or None, ok); throttled: route -> 429s
+    # A route whose every request was throttled has no samples and no percentiles (None)
+    routes = {}
+    for route, rows in samples.items():
+        latencies = sorted(r[0] for r in rows)
+        queries = [r[1] for r in rows if r[1] is not None]
+        route_time = elapsed if elapsed else sum(latencies)
+        routes[route] = {
+            'requests': len(rows),
+            'errors': sum(1 for r in rows if not r[2]),
+            'p50_ms': _ms(_percentile(latencies, 0.50)),
+            'p95_ms': _ms(_percentile(latencies, 0.95)),
+            'p99_ms': _ms(_percentile(latencies, 0.99)),
+            'throughput_rps': round(len(rows) / route_time, 1) if route_time else None,
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+            'throttled': (throttled or {}).get(route, 0),
+        }
+    return routes
+
+
+'''
+run(path, requests=200, routes=ROUTES, seed=1):
+sends [requests] requests to each route through Flask's test client, one at a
+time, as random users of the database at [path]
+
+returns:
+a results dict: {'meta': {...}, 'routes': {route: {p50_ms, p95_ms, p99_ms,
+throughput_rps, queries_per_request, requests, errors, throttled}}}
+'''
+def run(path, requests=200, routes=ROUTES, seed=1):
+    db.DATABASE_PATH = os.path.abspath(path)
+    import admission
+    import app as quad
+
+    # Every test client request comes from 127.0.0.1; measure the routes, not the rate limits
+    admission.ADMISSION_ENABLED = False
+
+    targets = Targets(path, seed)
+    client = quad.app.test_client()
+    statements = []
+    db.TRACE_CALLBACK = statements.append
+    samples = {route: [] for route in routes}
+    try:
+        for route in routes:
+            for _ in range(requests):
+                user_id = targets.user()
+                with client.session_transaction() as sess:
+                    sess['username'] = targets.usernames[user_id]
+                    sess['user_id'] = user_id
+                method, url, data = targets.request(route, user_id)
+                statements.clear()
+                start = time.perf_counter()
+                response = client.open(url, method=method, data=data)
+                # Streamed pages (the home feed) only query as their body is read
+                response.get_data()
+                response.close()
+                elapsed = time.perf_counter() - start
+                # Writes run on the write queue's own connection, which is traced too
+                samples[route].append((elapsed, len(statements), response.status_code < 400))
+    finally:
+        db.TRACE_CALLBACK = None
+    return {'meta': {'mode': 'test_client', 'db': path, 'requests_per_route': requests,
+                     'time': datetime.now(timezone.utc).isoformat(timespec='seconds')},
+            'routes': _summarise(samples, None)}
+
+
+def _http_client(base_url, username):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({'username': username, 'password': BENCH_PASSWORD}).encode()
+    for attempt in range(LOGIN_ATTEMPTS):
+        try:
+            opener.open(base_url + '/home', form, timeout=30).read()
+            return opener
+        except urllib.error.HTTPError as e:
+            if e.code != 429 or attempt == LOGIN_ATTEMPTS - 1:
+                raise
+            # Login is rate limited per address; wait as long as the server asks
+            time.sleep(int(e.headers.get('Retry-After', 1)))
+
+
+'''
+run_http(base_url, path, concurrency=16, duration=30, routes=ROUTES, users=50, seed=1):
+drives a running server with [concurrency] client threads for [duration]
+seconds, each logged in as one of [users] generated users and cycling through
+[routes]; the server must be serving the database at [path]
+
+returns:
+a results dict like run(); queries_per_request comes from the server's
+X-Query-Count header when it sends one, and throttled counts the requests the
+server turned away with 429
+'''
+def run_http(base_url, path, concurrency=16, duration=30, routes=ROUTES, users=50, seed=1):
+    base_url = base_url.rstrip('/')
+    targets = Targets(path, seed)
+    accounts = [targets.user() for _ in range(users)]
+    openers = {u: _http_client(base_url, targets.usernames[u]) for u in set(accounts)}
+    samples = {route: [] for route in routes}
+    throttled = {route: 0 for route in routes}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        local = Targets.__new__(Targets)
+        local.__dict__.update(targets.__dict__)
+        local.rng = rng
+        while time.monotonic() < deadline:
+            user_id = rng.choice(accounts)
+            route = rng.choice(routes)
+            method, url, data = local.request(route, user_id)
+            body = urllib.parse.urlencode(data).encode() if data else None
+            start = time.perf_counter()
+            ok, queries = True, None
+            try:
+                with openers[user_id].open(base_url + url, body, timeout=30) as response:
+                    response.read()
+                    queries = response.headers.get('X-Query-Count')
+            except urllib.error.HTTPError as e:
+                if e.code == 429:
+                    with lock:
+                        throttled[route] += 1
+                    continue
+                ok = False
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples[route].append((elapsed, int(queries) if queries else None, ok))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    results = {'meta': {'mode': 'http', 'url': base_url, 'db': path, 'concurrency': concurrency,
+                        'duration': duration, 'time': datetime.now(timezone.utc).isoformat(timespec='seconds')},
+               'routes': _summarise(samples, elapsed, throttled)}
+    results['meta']['total_rps'] = round(sum(len(v) for v in samples.values()) / elapsed, 1)
+    return results
+
+
+'''
+compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+compares two results dicts route by route
+
+returns:
+a list of human-readable regressions: p95 latency up by more than [threshold],
+more queries per request, or new errors
+'''
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    regressions = []
+    for route, now in results['routes'].items():
+        before = baseline['routes'].get(route)
+        if not before:
+            continue
+        if before['p95_ms'] and now['p95_ms'] is not None and now['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            regressions.append(f"{route}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+        if before.get('queries_per_request') is not None and now.get('queries_per_request') is not None \
+                and now['queries_per_request'] > before['queries_per_request'] + QUERY_SLACK:
+            regressions.append(f"{route}: queries/request {before['queries_per_request']} -> {now['queries_per_request']}")
+        if now['errors'] > before['errors']:
+            regressions.append(f"{route}: errors {before['errors']} -> {now['errors']}")
+    return regressions
+
+
+def _report(results, out, baseline_path, threshold):
+    print(f"{'route':<12} {'reqs':>6} {'err':>4} {'429':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} "
+          f"{'queries':>8}")
+    for route, r in results['routes'].items():
+        if not r['requests'] and r.get('throttled'):
+            print(f"{route:<12} {0:>6} {0:>4} {r['throttled']:>5} all throttled")
+            continue
+        print(f"{route:<12} {r['requests']:>6} {r['errors']:>4} {r.get('throttled', 0):>5} {str(r['p50_ms']):>9} "
+              f"{str(r['p95_ms']):>9} {str(r['p99_ms']):>9} {str(r['throughput_rps']):>8} {str(r['queries_per_request']):>8}")
+    if out:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {out}")
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Quad synthetic data generator and benchmark harness')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='create a synthetic database')
+    gen.add_argument('--out', default='bench.db')
+    gen.add_argument('--users', type=int, default=2000)
+    gen.add_argument('--avg-friends', type=int, default=20)
+    gen.add_argument('--posts', type=int, default=10, help='average posts per user')
+    gen.add_argument('--likes', type=int, default=3, help='average likes per post')
+    gen.add_argument('--comments', type=int, default=1, help='average comments per post')
+    gen.add_argument('--days', type=int, default=90)
+    gen.add_argument('--seed', type=int, default=1)
+
+    for name, help_text in (('run', 'benchmark through the Flask test client'),
+                            ('http', 'load-test a running server')):
+        cmd = commands.add_parser(name, help=help_text)
+        cmd.add_argument('--db', default='bench.db')
+        cmd.add_argument('--routes', default=','.join(ROUTES))
+        cmd.add_argument('--out')
+        cmd.add_argument('--baseline')
+        cmd.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+        cmd.add_argument('--seed', type=int, default=1)
+        if name == 'run':
+            cmd.add_argument('--requests', type=int, default=200, help='requests per route')
+        else:
+            cmd.add_argument('--url', required=True)
+            cmd.add_argument('--concurrency', type=int, default=16)
+            cmd.add_argument('--duration', type=int, default=30)
+            cmd.add_argument('--users', type=int, default=50, help='distinct logged-in users')
+
+    cmp = commands.add_parser('compare', help='compare two results files')
+    cmp.add_argument('results')
+    cmp.add_argument('baseline')
+    cmp.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        start = time.perf_counter()
+        counts = generate(args.out, args.users, args.avg_friends, args.posts, args.likes, args.comments,
+                          args.days, args.seed)
+        print(f"Generated {args.out} in {time.perf_counter() - start:.1f}s: "
+              + ', '.join(f'{n} {t}' for t, n in counts.items()))
+    elif args.command == 'run':
+        results = run(args.db, args.requests, tuple(args.routes.split(',')), args.seed)
+        _report(results, args.out, args.baseline, args.threshold)
+    elif args.command == 'http':
+        results = run_http(args.url, args.db, args.concurrency, args.duration, tuple(args.routes.split(',')),
+                           args.users, args.seed)
+        _report(results, args.out, args.baseline, args.threshold)
+    else:
+        with open(args.results) as f, open(args.baseline) as g:
+            regressions = compare(json.load(f), json.load(g), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
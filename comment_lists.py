@@ -0,0 +1,127 @@
+'''
+comment_lists.py
+pages of a post's comments and comment previews for many posts at once
+
+a post's comments are returned newest first, COMMENTS_PAGE_SIZE at a time,
+with keyset pagination on (timestamp, id) over idx_comments_post_timestamp,
+so a post with thousands of comments costs the same per page as one with ten
+
+previews() returns the newest few comments and the stored comment count of up
+to MAX_PREVIEW_POSTS posts in a single statement; each post's comments come
+from a LIMITed probe of the same index, so a viral post in the batch does not
+make the whole batch read all of its comments
+
+the comments of an archived post are read from its archive database (see archive.py)
+'''
+import archive
+import avatars
+
+# Comments returned per page of a post's comment list
+COMMENTS_PAGE_SIZE = 50
+# Comments shown per post in a preview
+PREVIEW_SIZE = 3
+# Maximum number of posts in one preview request
+MAX_PREVIEW_POSTS = 100
+
+
+def _comment(row):
+    return {'id': row[0], 'username': row[1], 'content': row[2], 'timestamp': row[3], 'pfp': row[4],
+            'avatar': avatars.url(row[4], 64)}
+
+
+'''
+list_comments(cursor, post_id, before_id=None, limit=COMMENTS_PAGE_SIZE, schema='main'):
+returns one page of a post's comments, newest first
+
+params:
+cursor - a cursor on the users.db database
+post_id - the id of the post
+before_id - optional id of the last comment on the previous page
+limit - the maximum number of comments to return
+schema - 'main', or the schema of the attached archive holding the post
+returns:
+(comments, next_before) - the comments as dicts with id, username, content,
+timestamp, pfp and avatar, and the cursor for the next page (None on the last page)
+'''
+def list_comments(cursor, post_id, before_id=None, limit=COMMENTS_PAGE_SIZE, schema='main'):
+    keyset = ''
+    params = [post_id]
+    # Unqualified in users.db, so the statements read the same as everywhere else
+    prefix = '' if schema == 'main' else f'{schema}.'
+    if before_id is not None:
+        keyset = f'AND (c.timestamp, c.id) < (SELECT timestamp, id FROM {prefix}comments WHERE id = ?)'
+        params.append(before_id)
+    params.append(limit)
+    cursor.execute(f'''
+        SELECT c.id, u.username, c.content, c.timestamp, u.pfp
+        FROM {prefix}comments c
+        JOIN users u ON u.id = c.user_id
+        WHERE c.post_id = ? {keyset}
+        ORDER BY c.timestamp DESC, c.id DESC
+        LIMIT ?
+    ''', params)
+    comments = [_comment(row) for row in cursor.fetchall()]
+    next_before = comments[-1]['id'] if len(comments) == limit else None
+    return comments, next_before
+
+
+'''
+comment_page(conn, post_id, before_id=None):
+returns what /comments/<post_id> answers with: one page of the post's comments and
+its comment count, from the post's archive if it is no longer in users.db
+
+params:
+conn - a connection to the users.db database
+post_id - the id of the post
+before_id - optional id of the last comment on the previous page
+returns:
+a dict with comments, next_before and comment_count
+'''
+def comment_page(conn, post_id, before_id=None):
+    cursor = conn.cursor()
+    cursor.execute('SELECT comment_count FROM posts WHERE id = ?', (post_id,))
+    row = cursor.fetchone()
+    period = archive.locate(conn, post_id) if row is None else None
+    if period is None:
+        comments, next_before = list_comments(cursor, post_id, before_id)
+    else:
+        with archive.attached(conn, period) as schema:
+            comments, next_before = list_comments(cursor, post_id, before_id, schema=schema)
+            row = cursor.execute(f'SELECT comment_count FROM {schema}.posts WHERE id = ?', (post_id,)).fetchall()[0]
+    return {'comments': comments, 'next_before': next_before, 'comment_count': row[0] if row else 0}
+
+
+'''
+previews(cursor, post_ids, per_post=PREVIEW_SIZE):
+returns the newest comments and the comment count of several posts
+
+params:
+cursor - a cursor on the users.db database
+post_ids - ids of the posts (at most MAX_PREVIEW_POSTS are used)
+per_post - the number of comments returned per post
+returns:
+{post_id: {'comment_count': n, 'comments': [...]}} for each of [post_ids] that
+exists; the comments are dicts like list_comments() returns, newest first
+'''
+def previews(cursor, post_ids, per_post=PREVIEW_SIZE):
+    post_ids = list(dict.fromkeys(post_ids))[:MAX_PREVIEW_POSTS]
+    if not post_ids:
+        return {}
+    placeholders = ', '.join('?' * len(post_ids))
+    cursor.execute(f'''
+        SELECT p.id, p.comment_count, c.id, u.username, c.content, c.timestamp, u.pfp
+        FROM posts p
+        LEFT JOIN comments c ON c.id IN (
+            SELECT id FROM comments WHERE post_id = p.id ORDER BY timestamp DESC, id DESC LIMIT ?
+        )
+        LEFT JOIN users u ON u.id = c.user_id
+        WHERE p.id IN ({placeholders})
+        ORDER BY p.id, c.timestamp DESC, c.id DESC
+    ''', [per_post] + post_ids)
+    result = {}
+    for row in cursor.fetchall():
+        post = result.setdefault(row[0], {'comment_count': row[1], 'comments': []})
+        # Comments by deleted users are left out, like in list_comments()
+        if row[2] is not None and row[3] is not None:
+            post['comments'].append(_comment(row[2:]))
+    return result
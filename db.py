@@ -0,0 +1,87 @@
+import os
+import sqlite3
+
+from flask import g
+
+import instrument
+
+# Define the path to the SQLite database file (QUAD_DATABASE points it elsewhere, e.g. a bench.py database)
+DATABASE_PATH = os.environ.get('QUAD_DATABASE', os.path.join(os.getcwd(), 'users.db'))
+
+# How long a connection waits on a locked database before giving up
+BUSY_TIMEOUT_MS = 5000
+
+# Pragmas applied to every connection we open.
+# WAL lets readers keep going while a write is in progress, NORMAL sync is safe
+# under WAL, and busy_timeout makes writers wait for the lock instead of failing
+# straight away with "database is locked".
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -20000),       # negative value = KiB, so ~20MB of page cache
+    ('mmap_size', 268435456),     # 256MB memory-mapped I/O window
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('temp_store', 'MEMORY'),
+)
+
+# Optional callable that receives every SQL statement run on new connections
+# (see migrations.explain)
+TRACE_CALLBACK = None
+
+'''
+create_connection()
+function to create a tuned connection to the users.db database
+use this outside of a request (scripts, migrations); routes should use get_db()
+
+returns:
+conn - a connection to the users.db database
+'''
+def create_connection():
+    """Create a connection to the SQLite database."""
+    conn = None
+    try:
+        # instrument times the statements run on the connection during a request
+        conn = sqlite3.connect(DATABASE_PATH, timeout=BUSY_TIMEOUT_MS / 1000,
+                               factory=instrument.connection_factory())
+        # One script, so connection setup is not counted as a request's statements (see instrument)
+        conn.executescript(''.join(f'PRAGMA {name} = {value};' for name, value in PRAGMAS))
+        if TRACE_CALLBACK is not None:
+            conn.set_trace_callback(TRACE_CALLBACK)
+    except sqlite3.Error as e:
+        print(e)
+    return conn
+
+
+'''
+get_db()
+returns the connection for the current request, opening it on first use
+the connection is closed automatically when the app context is torn down
+
+returns:
+conn - a connection to the users.db database
+'''
+def get_db():
+    """Return the per-request database connection."""
+    if 'db' not in g:
+        g.db = create_connection()
+    return g.db
+
+
+'''
+close_db(e=None)
+closes the connection for the current request if one was opened
+'''
+def close_db(e=None):
+    """Close the per-request database connection."""
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+
+
+'''
+init_app(app)
+registers the connection teardown with a Flask app
+'''
+def init_app(app):
+    """Tie the connection lifetime to the Flask app context."""
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,100 @@
+'''
+friends.py
+the mutual-friend graph
+
+friendships holds one row per "add friend" in each direction; once both users
+have added each other the pair is materialized into the friends table as two
+directed edges (user_id -> friend_id), so "are A and B friends", "list A's
+friends" and "count A's friends" are primary key lookups and range scans that
+never touch the rest of the graph
+'''
+
+'''
+add_friend_request(cursor, user_id, friend_id):
+records that [user_id] added [friend_id]; if [friend_id] had already added
+[user_id] back, both requests are accepted and the friendship is materialized
+the caller commits
+
+params:
+cursor - a cursor on the users.db database
+user_id - id of the user adding a friend
+friend_id - id of the user being added
+returns:
+'exists' if this request was already made, 'friends' if the pair is now mutual,
+otherwise 'pending'
+'''
+def add_friend_request(cursor, user_id, friend_id):
+    cursor.execute('SELECT 1 FROM friendships WHERE user1_id = ? AND user2_id = ?', (user_id, friend_id))
+    if cursor.fetchone():
+        return 'exists'
+    cursor.execute('INSERT INTO friendships (user1_id, user2_id) VALUES (?, ?)', (user_id, friend_id))
+    if user_id == friend_id:
+        return 'pending'
+    cursor.execute('SELECT 1 FROM friendships WHERE user1_id = ? AND user2_id = ?', (friend_id, user_id))
+    if not cursor.fetchone():
+        return 'pending'
+    cursor.execute('''
+        UPDATE friendships SET status = 'accepted'
+        WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)
+    ''', (user_id, friend_id, friend_id, user_id))
+    cursor.executemany('INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)',
+                       [(user_id, friend_id), (friend_id, user_id)])
+    return 'friends'
+
+
+'''
+are_friends(cursor, user_id, other_id):
+checks whether two users are mutual friends
+
+returns:
+True if both users have added each other
+'''
+def are_friends(cursor, user_id, other_id):
+    cursor.execute('SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?', (user_id, other_id))
+    return cursor.fetchone() is not None
+
+
+'''
+friend_status(cursor, user_id, other_id):
+describes the relationship from [user_id]'s side, as shown on the search page
+
+returns:
+'friends' if the friendship is mutual, 'pending' if only [user_id] has added
+[other_id], otherwise None
+'''
+def friend_status(cursor, user_id, other_id):
+    if are_friends(cursor, user_id, other_id):
+        return 'friends'
+    cursor.execute('SELECT 1 FROM friendships WHERE user1_id = ? AND user2_id = ?', (user_id, other_id))
+    if cursor.fetchone():
+        return 'pending'
+    return None
+
+
+'''
+list_friends(cursor, user_id):
+lists the mutual friends of a user
+
+returns:
+a list of dicts with the id, name, username and pfp of each friend, by name
+'''
+def list_friends(cursor, user_id):
+    cursor.execute('''
+        SELECT u.id, u.name, u.username, u.pfp FROM friends f
+        JOIN users u ON u.id = f.friend_id
+        WHERE f.user_id = ?
+        ORDER BY u.name
+    ''', (user_id,))
+    return [{'id': r[0], 'name': r[1], 'username': r[2], 'pfp': r[3]} for r in cursor.fetchall()]
+
+
+'''
+count_friends(cursor, user_id):
+counts the mutual friends of a user
+
+returns:
+the number of friends
+'''
+def count_friends(cursor, user_id):
+    cursor.execute('SELECT COUNT(*) FROM friends WHERE user_id = ?', (user_id,))
+    return cursor.fetchone()[0]
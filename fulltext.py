@@ -0,0 +1,163 @@
+'''
+fulltext.py
+ranked search backed by the FTS5 indexes built in migrations.py
+
+users_fts is a trigram index over username, name and college, so any substring
+of three or more characters is an index lookup rather than a LIKE '%q%' scan;
+shorter queries fall back to a prefix range on the username index
+
+posts_fts is a word index over post content; post results only include posts
+the searching user could see on the author's profile. matches in archived posts
+(see archive.py) come after every match still in users.db, newest archive first,
+and are only searched once a search has run out of matches in users.db
+'''
+import re
+
+from markupsafe import escape
+
+import archive
+
+# Results per page for search endpoints
+SEARCH_PAGE_SIZE = 20
+# bm25 weights for the username, name and college columns of users_fts
+USER_RANK_WEIGHTS = (10.0, 4.0, 1.0)
+
+
+def _fts_phrase(text):
+    # Quote the query so FTS5 treats it as a literal phrase, not query syntax
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _like_prefix(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+'''
+search_users(cursor, query, page=0, page_size=SEARCH_PAGE_SIZE):
+finds users whose username, name or college contains [query]
+exact and prefix username matches rank first, then bm25 relevance
+
+params:
+cursor - a cursor on the users.db database
+query - the text typed so far
+page - zero-based page number
+page_size - results per page
+returns:
+(results, has_more) - a list of dicts with id, username, name, college and pfp,
+and whether another page exists
+'''
+def search_users(cursor, query, page=0, page_size=SEARCH_PAGE_SIZE):
+    query = (query or '').strip()
+    if not query:
+        return [], False
+    offset = page * page_size
+    if len(query) < 3:
+        # Trigrams need three characters; use the username index for short prefixes
+        cursor.execute('''
+            SELECT id, username, name, college, pfp FROM users
+            WHERE username LIKE ? ESCAPE '\\'
+            ORDER BY username
+            LIMIT ? OFFSET ?
+        ''', (_like_prefix(query), page_size + 1, offset))
+    else:
+        cursor.execute(f'''
+            SELECT u.id, u.username, u.name, u.college, u.pfp FROM users_fts
+            JOIN users u ON u.id = users_fts.rowid
+            WHERE users_fts MATCH ?
+            ORDER BY u.username = ? COLLATE NOCASE DESC,
+                     u.username LIKE ? ESCAPE '\\' DESC,
+                     bm25(users_fts, {', '.join(str(w) for w in USER_RANK_WEIGHTS)})
+            LIMIT ? OFFSET ?
+        ''', (_fts_phrase(query), query, _like_prefix(query), page_size + 1, offset))
+    rows = cursor.fetchall()
+    results = [{'id': r[0], 'username': r[1], 'name': r[2], 'college': r[3], 'pfp': r[4]}
+               for r in rows[:page_size]]
+    return results, len(rows) > page_size
+
+
+# Private-use characters that mark matches in snippets until the text is escaped
+_MATCH_START = '\ue000'
+_MATCH_END = '\ue001'
+
+
+def _fts_words(text):
+    # Every word must appear; the last one may still be being typed, so match it as a prefix
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(_fts_phrase(w) for w in words) + '*'
+
+
+_POST_COLUMNS = f'''
+    p.id, u.username, datetime(p.created_at, 'unixepoch'), p.like_count, p.comment_count,
+    snippet(posts_fts, 0, '{_MATCH_START}', '{_MATCH_END}', '…', 16)
+'''
+
+
+def _posts_sql(prefix, columns, paged=True):
+    # [prefix] is '' for users.db or an attached archive's schema; users and friends always come from users.db
+    return f'''
+        SELECT {columns}
+        FROM {prefix}posts_fts
+        JOIN {prefix}posts p ON p.id = posts_fts.rowid
+        JOIN users u ON u.id = p.author_id
+        WHERE posts_fts MATCH ?
+          AND (u.id = ? OR EXISTS (SELECT 1 FROM friends f WHERE f.user_id = ? AND f.friend_id = u.id))
+        {'ORDER BY bm25(posts_fts) LIMIT ? OFFSET ?' if paged else ''}
+    '''
+
+
+def _archived_matches(conn, user_id, match, skip, limit):
+    # [skip] matches are on earlier pages; archives that hold no more than that are skipped whole
+    rows = []
+    for period in archive.search_periods(conn, user_id):
+        with archive.attached(conn, period) as schema:
+            if skip:
+                found = conn.execute(_posts_sql(f'{schema}.', 'COUNT(*)', paged=False),
+                                     (match, user_id, user_id)).fetchall()[0][0]
+                if found <= skip:
+                    skip -= found
+                    continue
+            rows += conn.execute(_posts_sql(f'{schema}.', _POST_COLUMNS),
+                                 (match, user_id, user_id, limit - len(rows), skip)).fetchall()
+            skip = 0
+        if len(rows) >= limit:
+            break
+    return rows
+
+'''
+search_posts(cursor, user_id, query, page=0, page_size=SEARCH_PAGE_SIZE):
+finds posts containing the words in [query] that [user_id] is allowed to see
+(their own posts and posts by mutual friends), best matches first
+
+params:
+cursor - a cursor on the users.db database
+user_id - id of the user searching
+query - the search text
+page - zero-based page number
+page_size - results per page
+returns:
+(results, has_more) - a list of dicts with id, username, timestamp, like_count,
+comment_count and an HTML-safe snippet with matches in <mark>, and whether
+another page exists
+'''
+def search_posts(cursor, user_id, query, page=0, page_size=SEARCH_PAGE_SIZE):
+    match = _fts_words(query or '')
+    if match is None:
+        return [], False
+    offset = page * page_size
+    cursor.execute(_posts_sql('', _POST_COLUMNS), (match, user_id, user_id, page_size + 1, offset))
+    rows = cursor.fetchall()
+    if len(rows) <= page_size:
+        # users.db has no more matches, carry on into the archives
+        skip = 0
+        if not rows and offset:
+            cursor.execute(_posts_sql('', 'COUNT(*)', paged=False), (match, user_id, user_id))
+            skip = max(0, offset - cursor.fetchone()[0])
+        rows += _archived_matches(cursor.connection, user_id, match, skip, page_size + 1 - len(rows))
+    results = []
+    for r in rows[:page_size]:
+        snippet = str(escape(r[5])).replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
+        results.append({'id': r[0], 'username': r[1], 'timestamp': r[2], 'like_count': r[3],
+                        'comment_count': r[4], 'snippet': snippet})
+    return results, len(rows) > page_size
@@ -0,0 +1,233 @@
+'''
+httpcache.py
+ETags, conditional GETs and a rendered-fragment cache for the home feed,
+profiles and comment lists
+
+every user and every post has an in-process version counter; the write paths
+bump them after their transaction commits (a user's counter covers their posts,
+the likes and comments on them and their friendships, a post's counter covers
+its comments), so an ETag built from the versions a page depends on changes
+exactly when the page could have changed
+
+a conditional GET whose If-None-Match still matches gets a 304 without touching
+the database or Jinja; otherwise the rendered body is looked up by ETag in an
+LRU bounded by both entries and total size, and only rendered on a miss
+
+counters live in this process, so run one app process (asgi.py says the same);
+the boot token in every ETag makes a restarted server re-validate everything, and
+the archive epoch (archive.epoch()) does the same after posts have been archived
+by the separate archive process
+'''
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import make_response, request
+
+import archive
+
+# Maximum number of rendered pages / JSON bodies kept
+FRAGMENT_CACHE_SIZE = 2048
+# Maximum total size of the kept bodies (characters, QUAD_FRAGMENT_CACHE_BYTES)
+FRAGMENT_CACHE_BYTES = int(os.environ.get('QUAD_FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+# Bodies larger than this are sent but not kept (nor buffered while they stream)
+FRAGMENT_MAX_BYTES = 256 * 1024
+
+BOOT = os.urandom(8).hex()
+
+
+class FragmentCache:
+    """LRU of rendered response bodies keyed by ETag, bounded by entries and, optionally, total length."""
+
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE, maxbytes=None, max_item_bytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.max_item_bytes = max_item_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.too_large = 0
+
+    def get(self, key):
+        """Return the cached value for [key], or None."""
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        with self._lock:
+            if self.max_item_bytes is not None and size > self.max_item_bytes:
+                self.too_large += 1
+                return
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._items[key] = value
+            self.bytes += size
+            while len(self._items) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+
+fragments = FragmentCache(maxbytes=FRAGMENT_CACHE_BYTES, max_item_bytes=FRAGMENT_MAX_BYTES)
+
+# Friend ids of each feed reader or profile user, keyed by (user_id, version)
+friend_lists = FragmentCache()
+
+_versions = {}
+_versions_lock = threading.Lock()
+_stats = {'not_modified': 0}
+
+
+'''
+bump(*keys):
+marks users or posts as changed, e.g. bump('user:3', 'post:12'); call it after
+the write has committed (see writequeue.on_commit)
+'''
+def bump(*keys):
+    with _versions_lock:
+        for key in keys:
+            _versions[key] = _versions.get(key, 0) + 1
+
+
+'''
+version(key):
+returns the current version counter of a user or post
+'''
+def version(key):
+    return _versions.get(key, 0)
+
+
+'''
+etag(*parts):
+builds an ETag from the given parts (viewer id, versions, query arguments...),
+the boot token and the archive epoch
+
+returns:
+a short hex string that changes whenever any part does
+'''
+def etag(*parts):
+    return hashlib.blake2b(repr((BOOT, archive.epoch()) + parts).encode('utf-8'), digest_size=12).hexdigest()
+
+
+'''
+feed_tag(conn, user_id, before_id):
+builds the ETag of one page of a user's home feed from their own version and
+the versions of all of their friends; the friend list itself is cached per
+version of [user_id], so a repeat view does not query the database
+
+params:
+conn - a connection to the users.db database, used when the friend list is not cached
+user_id - the id of the user reading the feed
+before_id - the page's keyset cursor
+'''
+def feed_tag(conn, user_id, before_id):
+    own = version(f'user:{user_id}')
+    return etag('feed', user_id, before_id, own, _friend_versions(conn, user_id, own))
+
+
+'''
+profile_tag(conn, viewer_id, user_id, before_id):
+builds the ETag of one page of [user_id]'s profile as seen by [viewer_id] from
+the profile user's version and the versions of the friends it lists (their names
+and avatars are on the page), the same way as feed_tag()
+'''
+def profile_tag(conn, viewer_id, user_id, before_id):
+    own = version(f'user:{user_id}')
+    return etag('profile', viewer_id, user_id, before_id, own, _friend_versions(conn, user_id, own))
+
+
+def _friend_versions(conn, user_id, own):
+    # A friendship bumps both users, so the friend list is cached per version of [user_id]
+    friend_ids = friend_lists.get((user_id, own))
+    if friend_ids is None:
+        friend_ids = tuple(row[0] for row in conn.execute('SELECT friend_id FROM friends WHERE user_id = ?', (user_id,)))
+        friend_lists.put((user_id, own), friend_ids)
+    return tuple(version(f'user:{f}') for f in friend_ids)
+
+
+def _store_when_done(tag, chunks):
+    # Passes a streamed body through and caches it once it has been sent in full;
+    # stops buffering once it is too large to be cached
+    parts = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if parts is not None:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > fragments.max_item_bytes:
+                    parts = None
+                    fragments.too_large += 1
+            yield chunk
+        if parts is not None:
+            fragments.put(tag, ''.join(parts))
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+'''
+respond(tag, render, mimetype='text/html'):
+answers the current Flask request from the cache when possible
+
+params:
+tag - the ETag of the response the request would get
+render - a function returning the response body, only called on a cache miss;
+         it may also return an iterator of str chunks (e.g. from
+         stream_template), which is sent as it renders and cached once complete
+mimetype - the body's content type
+returns:
+a 304 if the client already has [tag], otherwise a 200 with the cached or
+freshly rendered body; both carry the ETag and must be revalidated
+'''
+def respond(tag, render, mimetype='text/html'):
+    if tag in request.if_none_match:
+        _stats['not_modified'] += 1
+        response = make_response('', 304)
+    else:
+        body = fragments.get(tag)
+        if body is None:
+            body = render()
+            if not isinstance(body, (str, bytes)):
+                # A stream of chunks: sent as it renders, cached once complete
+                body = _store_when_done(tag, body)
+            else:
+                fragments.put(tag, body)
+        response = make_response(body)
+        response.mimetype = mimetype
+    response.set_etag(tag)
+    # Pages differ per logged-in user; browsers may keep them but must revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+'''
+metrics():
+returns fragment cache hits, misses, entries, total size, bodies too large to
+keep and the number of 304s sent
+'''
+def metrics():
+    result = dict(_stats)
+    result['hits'] = fragments.hits
+    result['misses'] = fragments.misses
+    result['size'] = len(fragments._items)
+    result['bytes'] = fragments.bytes
+    result['too_large'] = fragments.too_large
+    result['friend_lists'] = len(friend_lists._items)
+    result['versions'] = len(_versions)
+    return result
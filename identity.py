@@ -0,0 +1,96 @@
+'''
+identity.py
+in-process cache of user identity rows (id, name, username, age, college, pfp)
+
+almost every route needs to turn a username into a user id, so rows are kept in
+a bounded LRU with a time-to-live; signup and profile edits call invalidate()
+so a changed row is never served after the write that changed it
+'''
+import threading
+import time
+from collections import OrderedDict
+
+# Maximum number of users kept in the cache
+USER_CACHE_SIZE = 4096
+# Seconds before a cached row is re-read from the database
+USER_CACHE_TTL = 300
+
+USER_COLUMNS = ('id', 'name', 'username', 'age', 'college', 'pfp')
+
+
+class UserCache:
+    """Bounded LRU of user rows keyed by lower-cased username, with a TTL."""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn, username):
+        """Return the user row for [username] as a dict, or None if there is no such user."""
+        if not username:
+            return None
+        key = username.lower()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._rows.get(key)
+            if entry is not None and entry[0] > now:
+                self._rows.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {", ".join(USER_COLUMNS)} FROM users WHERE username = ? COLLATE NOCASE', (username,))
+        row = cursor.fetchone()
+        if row is None:
+            # Misses are not cached, a signup could create the user at any time
+            return None
+        user = dict(zip(USER_COLUMNS, row))
+        with self._lock:
+            self._rows[key] = (now + self.ttl, user)
+            self._rows.move_to_end(key)
+            while len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+        return user
+
+    def invalidate(self, username):
+        """Drop the cached row for [username] after it has been written."""
+        if username:
+            with self._lock:
+                self._rows.pop(username.lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+
+user_cache = UserCache()
+
+
+'''
+lookup_user(conn, username):
+resolves a username (case-insensitively) to its identity row through the cache
+
+params:
+conn - a connection to the users.db database, used on a cache miss
+username - a string of a username
+returns:
+a dict with the keys in USER_COLUMNS, or None if the user does not exist
+'''
+def lookup_user(conn, username):
+    return user_cache.get(conn, username)
+
+
+'''
+invalidate_user(username):
+removes a user from the cache, call after any write to that user's row
+
+params:
+username - a string of a username
+'''
+def invalidate_user(username):
+    user_cache.invalidate(username)
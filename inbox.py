@@ -0,0 +1,203 @@
+'''
+inbox.py
+paginated notifications, unread counts and retention
+
+users.unread_notifications is kept up to date by triggers on notifications
+(see migrations.py), so the unread badge is a single row read; marking read is
+one UPDATE for any number of notifications, and read notifications older than
+NOTIFICATION_RETENTION_DAYS are deleted so the table does not grow without limit
+
+notifications record who caused them (actor_id) and the post they are about;
+likes on a post are folded into one notification per post ("alice and 12 others
+liked your post.") that is updated in place, timestamp included, so pages are
+cut by id, which never changes; notified_likes makes sure each user's like of a
+post is only counted once; its rows go when the notification
+does (pruned or archived), so it only holds the likers of live notifications
+
+usage:
+python inbox.py prune    delete old read notifications for every user
+'''
+import sys
+
+from db import create_connection
+
+# Notifications shown per page
+NOTIFICATIONS_PAGE_SIZE = 30
+# Read notifications older than this are deleted
+NOTIFICATION_RETENTION_DAYS = 30
+# Rows deleted per transaction when pruning
+PRUNE_BATCH_SIZE = 1000
+
+
+'''
+notify(cursor, user_id, type, actor_id, message, post_id=None):
+adds a notification; the caller commits
+
+params:
+cursor - a cursor on the users.db database
+user_id - id of the user being notified
+type - 'friend_request', 'comment' or 'like'
+actor_id - id of the user who caused the notification
+message - the text shown to [user_id]
+post_id - optional id of the post the notification is about
+'''
+def notify(cursor, user_id, type, actor_id, message, post_id=None):
+    cursor.execute('INSERT INTO notifications (user_id, type, actor_id, post_id, message) VALUES (?, ?, ?, ?, ?)',
+                   (user_id, type, actor_id, post_id, message))
+
+
+'''
+notify_like(cursor, author_id, post_id, actor_id, username):
+counts a like in the author's notification for the post, creating it for the
+first like and otherwise updating it in place and marking it unread again;
+users who were already counted for this post are ignored; the caller commits
+
+params:
+cursor - a cursor on the users.db database
+author_id - id of the post's author
+post_id - id of the liked post
+actor_id, username - the user who liked the post
+returns:
+the notification's message, or None if it was left unchanged
+'''
+def notify_like(cursor, author_id, post_id, actor_id, username):
+    if author_id is None or author_id == actor_id:
+        return None
+    cursor.execute('INSERT OR IGNORE INTO notified_likes (post_id, user_id) VALUES (?, ?)', (post_id, actor_id))
+    if cursor.rowcount == 0:
+        return None
+    # actor_count on the right-hand side is the number of earlier likers
+    cursor.execute('''
+        INSERT INTO notifications (user_id, type, actor_id, post_id, message)
+        VALUES (?, 'like', ?, ?, ? || ' liked your post.')
+        ON CONFLICT (user_id, post_id) WHERE type = 'like' DO UPDATE SET
+            actor_id = excluded.actor_id,
+            actor_count = actor_count + 1,
+            message = ? || ' and ' || actor_count || (CASE WHEN actor_count = 1 THEN ' other' ELSE ' others' END)
+                      || ' liked your post.',
+            is_read = 0,
+            timestamp = CURRENT_TIMESTAMP
+        RETURNING message
+    ''', (author_id, actor_id, post_id, username, username))
+    return cursor.fetchone()[0]
+
+
+'''
+list_notifications(cursor, user_id, before_id=None, limit=NOTIFICATIONS_PAGE_SIZE):
+returns one page of a user's notifications, newest first by id; like notifications
+updated since keep their place, so a page boundary never moves between requests
+
+params:
+cursor - a cursor on the users.db database
+user_id - id of the user
+before_id - optional id of the last notification on the previous page
+limit - the maximum number of notifications to return
+returns:
+a list of dicts with id, type, message, is_read and timestamp
+'''
+def list_notifications(cursor, user_id, before_id=None, limit=NOTIFICATIONS_PAGE_SIZE):
+    keyset = ''
+    params = [user_id]
+    if before_id is not None:
+        keyset = 'AND id < ?'
+        params.append(before_id)
+    params.append(limit)
+    cursor.execute(f'''
+        SELECT id, type, message, is_read, timestamp, actor_id, post_id, actor_count FROM notifications
+        WHERE user_id = ? {keyset}
+        ORDER BY id DESC
+        LIMIT ?
+    ''', params)
+    return [{'id': r[0], 'type': r[1], 'message': r[2], 'is_read': bool(r[3]), 'timestamp': r[4],
+             'actor_id': r[5], 'post_id': r[6], 'actor_count': r[7]}
+            for r in cursor.fetchall()]
+
+
+'''
+unread_count(cursor, user_id):
+returns the number of unread notifications for a user
+'''
+def unread_count(cursor, user_id):
+    cursor.execute('SELECT unread_notifications FROM users WHERE id = ?', (user_id,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+'''
+mark_read(cursor, user_id, ids=None, up_to_id=None):
+marks notifications as read in one statement, then prunes the user's old read
+notifications; with neither [ids] nor [up_to_id] every notification is marked
+the caller commits
+
+params:
+cursor - a cursor on the users.db database
+user_id - id of the user, only their notifications are touched
+ids - optional list of notification ids
+up_to_id - optional id; it and every notification listed after it are marked
+returns:
+the user's unread count afterwards
+'''
+def mark_read(cursor, user_id, ids=None, up_to_id=None):
+    if ids:
+        ids = list(ids)
+        # Stay under SQLite's bound parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            cursor.execute(f'UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0 AND id IN ({placeholders})',
+                           [user_id] + chunk)
+    elif up_to_id is not None:
+        cursor.execute('''
+            UPDATE notifications SET is_read = 1
+            WHERE user_id = ? AND is_read = 0
+              AND id <= ?
+        ''', (user_id, up_to_id))
+    else:
+        cursor.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0', (user_id,))
+    prune_user(cursor, user_id)
+    return unread_count(cursor, user_id)
+
+
+'''
+prune_user(cursor, user_id):
+deletes one user's read notifications older than the retention period
+'''
+def prune_user(cursor, user_id):
+    cursor.execute('''
+        DELETE FROM notifications
+        WHERE user_id = ? AND is_read = 1 AND timestamp < datetime('now', ?)
+    ''', (user_id, f'-{NOTIFICATION_RETENTION_DAYS} days'))
+
+
+'''
+prune(conn):
+deletes read notifications older than the retention period for all users,
+PRUNE_BATCH_SIZE rows per transaction
+
+returns:
+the number of notifications deleted
+'''
+def prune(conn):
+    deleted = 0
+    while True:
+        cursor = conn.execute('''
+            DELETE FROM notifications WHERE id IN (
+                SELECT id FROM notifications
+                WHERE is_read = 1 AND timestamp < datetime('now', ?)
+                LIMIT ?
+            )
+        ''', (f'-{NOTIFICATION_RETENTION_DAYS} days', PRUNE_BATCH_SIZE))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < PRUNE_BATCH_SIZE:
+            return deleted
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'prune':
+        conn = create_connection()
+        print(f"Deleted {prune(conn)} old notification(s)")
+        conn.close()
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,373 @@
+'''
+instrument.py
+per-request SQL profiling and Prometheus metrics
+
+db.create_connection() opens InstrumentedConnection objects; while a request is
+being profiled (see init_app) every statement run on them, including the
+request's writes on the write queue's thread, is timed and counted against it
+
+each response gets X-Query-Count, X-DB-Time-Ms and Server-Timing headers; a
+statement run N_PLUS_ONE_THRESHOLD or more times in one request is reported as
+an N+1 pattern, and statements slower than SLOW_STATEMENT_MS are logged with
+their parameters; in debug mode ?profile=1 adds a panel listing the request's
+statements to HTML pages
+
+/metrics renders per-route latency histograms and query counters in the
+Prometheus text format
+'''
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import g, request
+from markupsafe import escape
+
+# Set QUAD_PROFILE=0 to open plain connections with no per-statement overhead
+PROFILING_ENABLED = os.environ.get('QUAD_PROFILE', '1') != '0'
+# Statements slower than this are logged with their parameters (milliseconds)
+SLOW_STATEMENT_MS = 100
+# The same statement run this many times in one request is an N+1 pattern
+N_PLUS_ONE_THRESHOLD = 5
+# Slowest statements kept per request for the debug panel
+SLOWEST_PER_REQUEST = 5
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('quad_request_profile', default=None)
+_whitespace = re.compile(r'\s+')
+
+
+class RequestProfile:
+    """The statements run while handling one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_seconds = 0.0
+        # normalised sql -> [count, seconds]
+        self.statements = {}
+        # (seconds, sql, params), slowest first
+        self.slowest = []
+        self._lock = threading.Lock()
+
+    def record(self, sql, params, seconds):
+        key = _whitespace.sub(' ', sql).strip()
+        with self._lock:
+            self.query_count += 1
+            self.db_seconds += seconds
+            entry = self.statements.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            self._keep_slowest(seconds, key, params)
+        if seconds * 1000 >= SLOW_STATEMENT_MS:
+            logger.warning('slow statement (%.1f ms): %s %r', seconds * 1000, key, params)
+        return key
+
+    def add_time(self, key, seconds):
+        # Time spent fetching the rows of an already recorded statement
+        with self._lock:
+            self.db_seconds += seconds
+            self.statements[key][1] += seconds
+
+    def _keep_slowest(self, seconds, key, params):
+        if len(self.slowest) < SLOWEST_PER_REQUEST or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, key, params))
+            self.slowest.sort(key=lambda s: s[0], reverse=True)
+            del self.slowest[SLOWEST_PER_REQUEST:]
+
+    def n_plus_one(self):
+        """Return (sql, count) for every statement repeated N_PLUS_ONE_THRESHOLD or more times."""
+        return [(sql, entry[0]) for sql, entry in self.statements.items() if entry[0] >= N_PLUS_ONE_THRESHOLD]
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor that times its statements (and row fetches) against the current request."""
+
+    _key = None
+
+    def execute(self, sql, parameters=()):
+        profile = _current.get()
+        if profile is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._key = profile.record(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = _current.get()
+        if profile is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._key = profile.record(sql, '(executemany)', time.perf_counter() - start)
+
+    def _timed_fetch(self, fetch, *args):
+        profile = _current.get()
+        if profile is None or self._key is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            profile.add_time(self._key, time.perf_counter() - start)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose cursors are InstrumentedCursors."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute does not go through cursor(), so route it there
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+'''
+connection_factory():
+returns the sqlite3.connect() factory to use for new connections
+'''
+def connection_factory():
+    return InstrumentedConnection if PROFILING_ENABLED else sqlite3.Connection
+
+
+'''
+start():
+starts profiling the current request (or any unit of work); statements run in
+this context, and in writes it queues, are recorded
+
+returns:
+(profile, token) to pass to finish()
+'''
+def start():
+    profile = RequestProfile()
+    return profile, _current.set(profile)
+
+
+'''
+current():
+returns the RequestProfile being recorded in this context, or None
+'''
+def current():
+    return _current.get()
+
+
+'''
+finish(profile, token, route, seconds):
+stops profiling and adds the request to the per-route metrics
+'''
+def finish(profile, token, route, seconds):
+    _current.reset(token)
+    observe(route, seconds, profile)
+
+
+_routes = {}
+_routes_lock = threading.Lock()
+
+
+'''
+observe(route, seconds, profile=None):
+adds one request to the per-route latency histogram and query counters
+'''
+def observe(route, seconds, profile=None):
+    with _routes_lock:
+        stats = _routes.get(route)
+        if stats is None:
+            stats = _routes[route] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0,
+                                      'queries': 0, 'db_seconds': 0.0, 'n_plus_one': 0}
+        stats['count'] += 1
+        stats['sum'] += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+        if profile is not None:
+            stats['queries'] += profile.query_count
+            stats['db_seconds'] += profile.db_seconds
+            if profile.n_plus_one():
+                stats['n_plus_one'] += 1
+
+
+def _panel(profile):
+    rows = ''.join(
+        f'<tr><td>{entry[0]}</td><td>{entry[1] * 1000:.2f}</td><td><code>{escape(sql)}</code></td></tr>'
+        for sql, entry in sorted(profile.statements.items(), key=lambda s: s[1][1], reverse=True))
+    slowest = ''.join(f'<li>{s * 1000:.2f} ms <code>{escape(sql)}</code> {escape(repr(params))}</li>'
+                      for s, sql, params in profile.slowest)
+    repeated = ''.join(f'<li>{count}x <code>{escape(sql)}</code></li>' for sql, count in profile.n_plus_one())
+    return (
+        '<div id="quad-profile" style="position:fixed;bottom:0;left:0;right:0;max-height:40%;overflow:auto;'
+        'background:#111;color:#ddd;font:12px monospace;padding:8px;z-index:99999;border-top:2px solid #1f6feb;">'
+        f'<strong>{profile.query_count} statements, {profile.db_seconds * 1000:.2f} ms in SQLite</strong>'
+        + (f'<p style="color:#f85149;">N+1 patterns:</p><ul>{repeated}</ul>' if repeated else '')
+        + f'<p>Slowest:</p><ol>{slowest}</ol>'
+        + f'<table><tr><th>runs</th><th>ms</th><th>statement</th></tr>{rows}</table></div>'
+    )
+
+
+'''
+init_app(app):
+profiles every request handled by a Flask app and adds the profiling headers;
+for a streamed response the headers can only count the statements run before
+the body, but the metrics include the ones run while it streams
+'''
+def init_app(app):
+    @app.before_request
+    def start_profile():
+        g._profile = start()
+
+    @app.after_request
+    def add_profile_headers(response):
+        started = g.pop('_profile', None)
+        if started is None:
+            return response
+        profile, token = started
+        elapsed = time.perf_counter() - profile.started
+        response.headers.extend(headers(profile, elapsed))
+        route, path = _route(), request.path
+        if response.is_streamed:
+            # The body (e.g. the home feed's posts query) runs after this; keep
+            # recording it and add the request to the metrics once it is sent
+            _current.reset(token)
+            response.response = _profiled(response.response, profile)
+
+            def finish_streamed():
+                _warn_n_plus_one(profile, route, path)
+                observe(route, time.perf_counter() - profile.started, profile)
+            response.call_on_close(finish_streamed)
+            return response
+        _warn_n_plus_one(profile, route, path)
+        if app.debug and request.args.get('profile') == '1' and response.mimetype == 'text/html' \
+                and response.status_code == 200:
+            body = response.get_data(as_text=True)
+            index = body.rfind('</body>')
+            response.set_data(body[:index] + _panel(profile) + body[index:] if index != -1 else body + _panel(profile))
+        finish(profile, token, route, elapsed)
+        return response
+
+    @app.teardown_request
+    def end_profile(error=None):
+        # after_request is skipped when the view raised; still stop profiling
+        started = g.pop('_profile', None)
+        if started is not None:
+            profile, token = started
+            finish(profile, token, _route(), time.perf_counter() - profile.started)
+
+
+def _warn_n_plus_one(profile, route, path):
+    repeated = profile.n_plus_one()
+    if repeated:
+        logger.warning('N+1 in %s (%s): %s', route, path, '; '.join(f'{count}x {sql}' for sql, count in repeated))
+
+
+def _profiled(chunks, profile):
+    # Records the statements run while each chunk of a streamed body is produced
+    chunks = iter(chunks)
+    try:
+        while True:
+            token = _current.set(profile)
+            try:
+                chunk = next(chunks, _END)
+            finally:
+                _current.reset(token)
+            if chunk is _END:
+                return
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+_END = object()
+
+
+def _route():
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return f'{request.method} {rule}'
+
+
+'''
+headers(profile, seconds):
+returns the profiling response headers for a request that took [seconds] so far
+
+returns:
+a list of (name, value) pairs: X-Query-Count, X-DB-Time-Ms, Server-Timing and,
+when the request had N+1 patterns, X-N-Plus-One
+'''
+def headers(profile, seconds):
+    db_ms = f'{profile.db_seconds * 1000:.2f}'
+    result = [
+        ('X-Query-Count', str(profile.query_count)),
+        ('X-DB-Time-Ms', db_ms),
+        ('Server-Timing', f'db;dur={db_ms}, app;dur={seconds * 1000:.2f}'),
+    ]
+    repeated = profile.n_plus_one()
+    if repeated:
+        result.append(('X-N-Plus-One', str(len(repeated))))
+    return result
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+'''
+prometheus(gauges=None):
+renders the per-route metrics, plus any extra gauges, in the Prometheus text format
+
+params:
+gauges - optional {prefix: {name: number}} of extra values, e.g. {'passwords': passwords.metrics()}
+returns:
+the text of the exposition
+'''
+def prometheus(gauges=None):
+    lines = [
+        '# HELP quad_request_duration_seconds Request latency by route.',
+        '# TYPE quad_request_duration_seconds histogram',
+    ]
+    with _routes_lock:
+        routes = {route: dict(stats, buckets=list(stats['buckets'])) for route, stats in _routes.items()}
+    for route, stats in sorted(routes.items()):
+        label = f'route="{_label(route)}"'
+        for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+            lines.append(f'quad_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(f'quad_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+        lines.append(f'quad_request_duration_seconds_sum{{{label}}} {stats["sum"]:.6f}')
+        lines.append(f'quad_request_duration_seconds_count{{{label}}} {stats["count"]}')
+    for name, key, help_text in (
+            ('quad_sql_statements_total', 'queries', 'SQL statements run, by route.'),
+            ('quad_sql_seconds_total', 'db_seconds', 'Time spent in SQLite, by route.'),
+            ('quad_n_plus_one_requests_total', 'n_plus_one', 'Requests with an N+1 statement pattern, by route.')):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for route, stats in sorted(routes.items()):
+            lines.append(f'{name}{{route="{_label(route)}"}} {stats[key]}')
+    for prefix, values in (gauges or {}).items():
+        for name, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f'# TYPE quad_{prefix}_{name} gauge')
+            lines.append(f'quad_{prefix}_{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,780 @@
+'''
+migrations.py
+versioned schema migrations for the users.db database
+
+every migration has a version number and is applied exactly once, inside its own
+transaction; the versions that have been applied are recorded in the
+schema_migrations table, so this can be run against an existing users.db at any
+time without losing data
+
+usage:
+python migrations.py                    apply any pending migrations
+python migrations.py status             print the applied and pending migrations
+python migrations.py explain <username> print EXPLAIN QUERY PLAN for every query each route runs
+python migrations.py reconcile          recompute the like/comment, unread notification and timeline counters
+python migrations.py rebuild-post-index rebuild the full-text index over post content
+python migrations.py backfill-posts     fill in author ids and epoch times of posts from before migration 11
+                                        and clear their legacy username and timestamp
+'''
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db
+from db import create_connection
+
+MIGRATIONS = []
+
+
+'''
+migration(version, description):
+decorator that registers a function as a schema migration
+
+params:
+version - integer version number, migrations are applied in increasing order
+description - a short description stored in schema_migrations
+'''
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+@migration(1, 'create base tables')
+def create_base_tables(cursor):
+    """Create the users, posts, friendships, notifications, likes and comments tables."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        username TEXT UNIQUE COLLATE NOCASE,
+        password TEXT,
+        age INTEGER,
+        college TEXT,
+        pfp TEXT DEFAULT ''
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT,
+        post_content TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS friendships (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user1_id INTEGER,
+        user2_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        FOREIGN KEY(user1_id) REFERENCES users(id),
+        FOREIGN KEY(user2_id) REFERENCES users(id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        type TEXT,
+        message TEXT,
+        is_read INTEGER DEFAULT 0,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS likes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        UNIQUE(user_id, post_id),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(post_id) REFERENCES posts(id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS comments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        content TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(post_id) REFERENCES posts(id)
+    )
+    ''')
+
+
+@migration(2, 'add indexes on hot lookup columns')
+def add_lookup_indexes(cursor):
+    """Add the indexes behind the feed, profile, like, comment and notification queries."""
+    # feed and profile: a user's posts, newest first
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_username_timestamp ON posts(username, timestamp, id)')
+    # mutual friend checks go through the pair in both directions
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_friendships_pair ON friendships(user1_id, user2_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_friendships_reverse ON friendships(user2_id, user1_id)')
+    # like counts per post (the UNIQUE(user_id, post_id) index covers liked-by-me)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_post ON likes(post_id, user_id)')
+    # comment counts and comment lists per post
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_comments_post_timestamp ON comments(post_id, timestamp)')
+    # a user's notifications, newest first
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user_timestamp ON notifications(user_id, timestamp)')
+
+
+@migration(3, 'store like and comment counts on posts')
+def add_post_counters(cursor):
+    """Denormalize like/comment counts onto posts and keep them in sync with triggers."""
+    cursor.execute('ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0')
+    # Triggers fire for every write path, including ones added later
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS likes_after_insert AFTER INSERT ON likes BEGIN
+        UPDATE posts SET like_count = like_count + 1 WHERE id = NEW.post_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS likes_after_delete AFTER DELETE ON likes BEGIN
+        UPDATE posts SET like_count = like_count - 1 WHERE id = OLD.post_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS comments_after_insert AFTER INSERT ON comments BEGIN
+        UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS comments_after_delete AFTER DELETE ON comments BEGIN
+        UPDATE posts SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+    END
+    ''')
+    reconcile_counters(cursor)
+
+
+@migration(4, 'materialize mutual friendships')
+def add_friends_table(cursor):
+    """Create the friends edge table and fill it from existing mutual friendships."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS friends (
+        user_id INTEGER NOT NULL,
+        friend_id INTEGER NOT NULL,
+        since DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, friend_id),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(friend_id) REFERENCES users(id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO friends (user_id, friend_id)
+        SELECT f1.user1_id, f1.user2_id FROM friendships f1
+        JOIN friendships f2 ON f2.user1_id = f1.user2_id AND f2.user2_id = f1.user1_id
+        WHERE f1.user1_id != f1.user2_id
+    ''')
+    # add_friend() never set this before, so mark the mutual pairs now
+    cursor.execute('''
+        UPDATE friendships SET status = 'accepted'
+        WHERE EXISTS (SELECT 1 FROM friends WHERE user_id = friendships.user1_id AND friend_id = friendships.user2_id)
+    ''')
+
+
+@migration(5, 'add fan-out timelines')
+def add_timeline_tables(cursor):
+    """Create the per-user timeline of post ids used when fan-out-on-write is enabled."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS timeline (
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, post_id),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(post_id) REFERENCES posts(id)
+    ) WITHOUT ROWID
+    ''')
+    # High-degree authors whose posts are pulled at read time instead of fanned out
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS timeline_pull_authors (
+        user_id INTEGER PRIMARY KEY,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+
+
+@migration(6, 'add trigram search index over users')
+def add_user_search_index(cursor):
+    """Index usernames, display names and colleges for type-ahead search."""
+    # External-content table: the text lives in users, the index only holds trigrams
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, name, college,
+        content='users', content_rowid='id', tokenize='trigram'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_fts_after_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, name, college)
+        VALUES (NEW.id, NEW.username, NEW.name, NEW.college);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_fts_after_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, name, college)
+        VALUES ('delete', OLD.id, OLD.username, OLD.name, OLD.college);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_fts_after_update AFTER UPDATE OF username, name, college ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, name, college)
+        VALUES ('delete', OLD.id, OLD.username, OLD.name, OLD.college);
+        INSERT INTO users_fts (rowid, username, name, college)
+        VALUES (NEW.id, NEW.username, NEW.name, NEW.college);
+    END
+    ''')
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+@migration(7, 'add full-text index over post content')
+def add_post_search_index(cursor):
+    """Index post content for full-text search and keep it in sync with triggers."""
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+        post_content,
+        content='posts', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS posts_fts_after_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts (rowid, post_content) VALUES (NEW.id, NEW.post_content);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS posts_fts_after_delete AFTER DELETE ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, post_content) VALUES ('delete', OLD.id, OLD.post_content);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS posts_fts_after_update AFTER UPDATE OF post_content ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, post_content) VALUES ('delete', OLD.id, OLD.post_content);
+        INSERT INTO posts_fts (rowid, post_content) VALUES (NEW.id, NEW.post_content);
+    END
+    ''')
+    cursor.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+
+
+@migration(8, 'add unread notification counter')
+def add_unread_notification_counter(cursor):
+    """Store each user's unread notification count and keep it current with triggers."""
+    cursor.execute('ALTER TABLE users ADD COLUMN unread_notifications INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS notifications_after_insert AFTER INSERT ON notifications
+    WHEN NEW.is_read = 0 BEGIN
+        UPDATE users SET unread_notifications = unread_notifications + 1 WHERE id = NEW.user_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS notifications_after_delete AFTER DELETE ON notifications
+    WHEN OLD.is_read = 0 BEGIN
+        UPDATE users SET unread_notifications = unread_notifications - 1 WHERE id = OLD.user_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS notifications_after_update AFTER UPDATE OF is_read ON notifications
+    WHEN OLD.is_read != NEW.is_read BEGIN
+        UPDATE users SET unread_notifications = unread_notifications + (CASE WHEN NEW.is_read = 0 THEN 1 ELSE -1 END)
+        WHERE id = NEW.user_id;
+    END
+    ''')
+    reconcile_unread(cursor)
+
+
+@migration(9, 'add structured notification columns and aggregate like notifications')
+def add_structured_notifications(cursor):
+    """Give notifications actor/post columns, one row per liked post, and a like dedup table."""
+    cursor.execute('ALTER TABLE notifications ADD COLUMN actor_id INTEGER REFERENCES users(id)')
+    cursor.execute('ALTER TABLE notifications ADD COLUMN post_id INTEGER REFERENCES posts(id)')
+    cursor.execute('ALTER TABLE notifications ADD COLUMN actor_count INTEGER NOT NULL DEFAULT 1')
+    # Older notifications only have the message; it always starts with the actor's username
+    cursor.execute('''
+        UPDATE notifications SET actor_id = (
+            SELECT u.id FROM users u WHERE u.username = substr(notifications.message, 1, instr(notifications.message, ' ') - 1)
+        )
+        WHERE actor_id IS NULL
+    ''')
+    # One like notification per post for its author, updated as more people like it
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_like_post
+        ON notifications(user_id, post_id) WHERE type = 'like'
+    ''')
+    # Users whose like of a post has already been notified, so unlike/like again stays quiet
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notified_likes (
+        post_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (post_id, user_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO notified_likes (post_id, user_id) SELECT post_id, user_id FROM likes')
+
+
+@migration(10, 'index comments by author')
+def add_comment_author_index(cursor):
+    """Find the posts a user commented on (their comment lists show the user's avatar)."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_comments_user_post ON comments(user_id, post_id)')
+
+
+@migration(11, 'key posts by author id and epoch time')
+def add_post_author_ids(cursor):
+    """Add integer author ids and creation times to posts; existing rows are filled by backfill_posts()."""
+    # Adding columns only touches the schema, so this is instant however many posts there are
+    cursor.execute('ALTER TABLE posts ADD COLUMN author_id INTEGER REFERENCES users(id)')
+    cursor.execute('ALTER TABLE posts ADD COLUMN created_at INTEGER')
+    # feed and profile: a user's posts, newest first, on integers instead of text
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_author_created ON posts(author_id, created_at, id)')
+    # the posts the backfill still has to fill; rows drop out of it as they are filled
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_unfilled ON posts(id) WHERE created_at IS NULL')
+    cursor.execute('DROP INDEX IF EXISTS idx_posts_username_timestamp')
+    # Writers that still insert by username and text timestamp get the new columns filled in
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS posts_fill_author AFTER INSERT ON posts
+    WHEN NEW.author_id IS NULL OR NEW.created_at IS NULL BEGIN
+        UPDATE posts SET
+            author_id = COALESCE(NEW.author_id, (SELECT id FROM users WHERE username = NEW.username)),
+            created_at = COALESCE(NEW.created_at, CAST(strftime('%s', NEW.timestamp) AS INTEGER), 0)
+        WHERE id = NEW.id;
+    END
+    ''')
+
+
+@migration(12, 'add archive catalog')
+def add_archive_catalog(cursor):
+    """Record which archive databases hold whose posts, and index posts by age for archive.py."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive_periods (
+        period TEXT PRIMARY KEY,
+        first_post_id INTEGER,
+        last_post_id INTEGER,
+        posts INTEGER NOT NULL DEFAULT 0,
+        notifications INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive_authors (
+        author_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        posts INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (author_id, period),
+        FOREIGN KEY(author_id) REFERENCES users(id)
+    ) WITHOUT ROWID
+    ''')
+    # the oldest posts first, for archive.py to move out
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_created ON posts(created_at, id)')
+
+
+@migration(13, 'clear legacy post columns')
+def clear_legacy_post_columns(cursor):
+    """Stop storing posts.username and the text posts.timestamp; existing rows are cleared by backfill_posts()."""
+    # the posts the backfill still has to fill or clear
+    cursor.execute('DROP INDEX IF EXISTS idx_posts_unfilled')
+    cursor.execute('CREATE INDEX idx_posts_unfilled ON posts(id) WHERE created_at IS NULL OR timestamp IS NOT NULL')
+    # Writers that still insert by username (or get the DEFAULT timestamp) have the
+    # new columns filled in and the old ones cleared; the username is kept only when
+    # it matches no user, so the post's author is not lost
+    cursor.execute('DROP TRIGGER IF EXISTS posts_fill_author')
+    cursor.execute('''
+    CREATE TRIGGER posts_fill_author AFTER INSERT ON posts
+    WHEN NEW.author_id IS NULL OR NEW.created_at IS NULL OR NEW.timestamp IS NOT NULL BEGIN
+        UPDATE posts SET
+            author_id = COALESCE(NEW.author_id, (SELECT id FROM users WHERE username = NEW.username)),
+            created_at = COALESCE(NEW.created_at, CAST(strftime('%s', NEW.timestamp) AS INTEGER), 0),
+            username = CASE WHEN COALESCE(NEW.author_id, (SELECT id FROM users WHERE username = NEW.username)) IS NULL
+                            THEN NEW.username END,
+            timestamp = NULL
+        WHERE id = NEW.id;
+    END
+    ''')
+
+
+@migration(14, 'forget likers with their like notification')
+def forget_likers_with_notification(cursor):
+    """Keep notified_likes only as long as the like notification it deduplicates."""
+    # A like notification deleted by retention (inbox.prune) or archiving takes its
+    # likers with it, so notified_likes no longer grows as fast as likes
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS notifications_forget_likers AFTER DELETE ON notifications
+    WHEN OLD.type = 'like' AND OLD.post_id IS NOT NULL BEGIN
+        DELETE FROM notified_likes WHERE post_id = OLD.post_id;
+    END
+    ''')
+    cursor.execute('''
+        DELETE FROM notified_likes WHERE NOT EXISTS (
+            SELECT 1 FROM posts p JOIN notifications n ON n.user_id = p.author_id AND n.post_id = p.id AND n.type = 'like'
+            WHERE p.id = notified_likes.post_id
+        )
+    ''')
+
+
+@migration(15, 'count timeline entries per user')
+def add_timeline_counter(cursor):
+    """Store the size of each user's fan-out timeline and keep it current with triggers."""
+    # fan_out() trims a timeline once this passes the cap, without counting its rows
+    cursor.execute('ALTER TABLE users ADD COLUMN timeline_entries INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS timeline_after_insert AFTER INSERT ON timeline BEGIN
+        UPDATE users SET timeline_entries = timeline_entries + 1 WHERE id = NEW.user_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS timeline_after_delete AFTER DELETE ON timeline BEGIN
+        UPDATE users SET timeline_entries = timeline_entries - 1 WHERE id = OLD.user_id;
+    END
+    ''')
+    reconcile_timelines(cursor)
+
+
+@migration(16, 'index notifications by user and id')
+def add_notification_id_index(cursor):
+    """Page notifications by id, which an in-place update of a like notification leaves alone."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user_id ON notifications(user_id, id)')
+
+
+'''
+backfill_posts(conn, batch_size=1000):
+fills posts.author_id and posts.created_at for the posts written before migration
+11 and clears their legacy username and text timestamp (migration 13), [batch_size]
+posts per transaction, so other connections can keep reading and writing between
+batches instead of waiting for one long update of the whole table
+
+params:
+conn - a connection to the users.db database
+batch_size - number of posts filled per transaction
+returns:
+the number of posts filled
+'''
+def backfill_posts(conn, batch_size=1000):
+    filled = 0
+    while True:
+        # idx_posts_unfilled holds only the rows left to do, so each batch is found without a scan
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM posts WHERE created_at IS NULL OR timestamp IS NOT NULL ORDER BY id LIMIT ?', (batch_size,))]
+        if not ids:
+            break
+        # The username is kept only for posts whose author no longer exists
+        conn.execute('''
+            UPDATE posts SET
+                author_id = COALESCE(author_id, (SELECT id FROM users WHERE username = posts.username)),
+                created_at = COALESCE(created_at, CAST(strftime('%s', timestamp) AS INTEGER), 0),
+                username = CASE WHEN COALESCE(author_id, (SELECT id FROM users WHERE username = posts.username)) IS NULL
+                                THEN username END,
+                timestamp = NULL
+            WHERE id BETWEEN ? AND ? AND (created_at IS NULL OR timestamp IS NOT NULL)
+        ''', (ids[0], ids[-1]))
+        conn.commit()
+        filled += len(ids)
+    return filled
+
+'''
+rebuild_post_index(conn, batch_size=1000):
+rebuilds posts_fts from the posts table, streaming the rows in id order and
+committing every [batch_size] posts so the whole table is never held in memory
+or in one long write transaction
+
+params:
+conn - a connection to the users.db database
+batch_size - number of posts indexed per transaction
+returns:
+the number of posts indexed
+'''
+def rebuild_post_index(conn, batch_size=1000):
+    conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('delete-all')")
+    conn.commit()
+    last_id = 0
+    indexed = 0
+    while True:
+        rows = conn.execute('SELECT id, post_content FROM posts WHERE id > ? ORDER BY id LIMIT ?',
+                            (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        conn.executemany('INSERT INTO posts_fts (rowid, post_content) VALUES (?, ?)', rows)
+        conn.commit()
+        last_id = rows[-1][0]
+        indexed += len(rows)
+    conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')")
+    conn.commit()
+    return indexed
+
+
+'''
+reconcile_counters(cursor):
+recomputes posts.like_count and posts.comment_count from the likes and comments tables
+
+params:
+cursor - a cursor on the users.db database, the caller commits
+returns:
+the number of posts whose counts were wrong and have been fixed
+'''
+def reconcile_counters(cursor):
+    cursor.execute('''
+        UPDATE posts SET
+            like_count = (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id),
+            comment_count = (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id)
+        WHERE like_count != (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id)
+           OR comment_count != (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id)
+    ''')
+    return cursor.rowcount
+
+
+
+'''
+reconcile_unread(cursor):
+recomputes users.unread_notifications from the notifications table
+
+params:
+cursor - a cursor on the users.db database
+returns:
+the number of users whose count was wrong
+'''
+def reconcile_unread(cursor):
+    cursor.execute('''
+        UPDATE users SET unread_notifications = (
+            SELECT COUNT(*) FROM notifications n WHERE n.user_id = users.id AND n.is_read = 0
+        )
+        WHERE unread_notifications != (
+            SELECT COUNT(*) FROM notifications n WHERE n.user_id = users.id AND n.is_read = 0
+        )
+    ''')
+    return cursor.rowcount
+
+
+'''
+reconcile_timelines(cursor):
+recomputes users.timeline_entries from the timeline table
+
+params:
+cursor - a cursor on the users.db database
+returns:
+the number of users whose count was wrong
+'''
+def reconcile_timelines(cursor):
+    cursor.execute('''
+        UPDATE users SET timeline_entries = (SELECT COUNT(*) FROM timeline t WHERE t.user_id = users.id)
+        WHERE timeline_entries != (SELECT COUNT(*) FROM timeline t WHERE t.user_id = users.id)
+    ''')
+    return cursor.rowcount
+
+'''
+applied_versions(conn):
+returns the set of migration versions already applied to a database
+
+params:
+conn - a connection to the users.db database
+returns:
+a set of integer versions
+'''
+def applied_versions(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    return {row[0] for row in conn.execute('SELECT version FROM schema_migrations')}
+
+
+'''
+migrate(conn=None):
+applies every pending migration in version order, one transaction each, then
+fills in any posts still missing their author id (see backfill_posts())
+
+params:
+conn - optional connection to use, a new one is opened (and closed) if not given
+returns:
+the list of versions that were applied
+'''
+def migrate(conn=None):
+    """Bring the database schema up to date."""
+    own_conn = conn is None
+    if own_conn:
+        conn = create_connection()
+    isolation_level = conn.isolation_level
+    # Manage transactions ourselves so DDL and data changes commit together
+    conn.isolation_level = None
+    applied = []
+    try:
+        done = applied_versions(conn)
+        for version, description, func in MIGRATIONS:
+            if version in done:
+                continue
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                func(cursor)
+                cursor.execute('INSERT INTO schema_migrations (version, description) VALUES (?, ?)',
+                               (version, description))
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            applied.append(version)
+            print(f"Applied migration {version}: {description}")
+        # Each batch commits on its own, so this runs after (not inside) the migrations
+        filled = backfill_posts(conn)
+        if filled:
+            print(f"Backfilled {filled} post(s)")
+    finally:
+        conn.isolation_level = isolation_level
+        if own_conn:
+            conn.close()
+    return applied
+
+
+'''
+status():
+prints which migrations have been applied and which are pending
+'''
+def status():
+    conn = create_connection()
+    done = applied_versions(conn)
+    conn.close()
+    for version, description, _ in MIGRATIONS:
+        state = 'applied' if version in done else 'pending'
+        print(f"{version:>4}  {state:<8} {description}")
+
+
+'''
+explain(username):
+runs each route against a scratch copy of users.db as [username], records every
+statement it executes and prints the EXPLAIN QUERY PLAN of each one
+full table and index scans are flagged so they can be indexed away
+
+params:
+username - a string of a username that is in the user.db database
+returns:
+the number of full scans found across all plans
+'''
+def explain(username):
+    scratch_dir = tempfile.mkdtemp()
+    scratch_path = os.path.join(scratch_dir, 'users.db')
+    source = create_connection()
+    target = sqlite3.connect(scratch_path)
+    source.backup(target)
+    target.close()
+
+    real_path = db.DATABASE_PATH
+    db.DATABASE_PATH = scratch_path
+    try:
+        migrate()
+        conn = create_connection()
+        user = conn.execute('SELECT id, username FROM users WHERE username = ? COLLATE NOCASE', (username,)).fetchone()
+        if not user:
+            print(f"No user named {username}")
+            return 0
+        row = conn.execute('SELECT id FROM posts ORDER BY id DESC LIMIT 1').fetchone()
+        post_id = row[0] if row else 1
+
+        # Imported here so this module does not depend on the app at import time
+        import app as quad
+        requests = [
+            ('GET', '/home', None),
+            ('GET', f'/home?before={post_id}', None),
+            ('GET', f'/profile/{user[1]}', None),
+            ('GET', f'/profile/{user[1]}?before={post_id}', None),
+            ('GET', f'/search?search_username={user[1]}', None),
+            ('GET', f'/search/users?q={user[1][:2]}', None),
+            ('GET', f'/search/users?q={user[1][:4]}', None),
+            ('GET', '/search/posts?q=hello', None),
+            ('GET', '/notifications', None),
+            ('GET', '/notifications?before=1', None),
+            ('GET', f'/comments/{post_id}', None),
+            ('GET', f'/comments/{post_id}?before=1', None),
+            ('GET', f'/comments/preview?posts={post_id},1', None),
+            ('POST', '/check_username', {'username': user[1]}),
+            ('POST', '/like_post', {'post_id': post_id, 'action': 'like'}),
+            ('POST', '/like_post', {'post_id': post_id, 'action': 'unlike'}),
+            ('POST', '/add_comment', {'post_id': post_id, 'content': 'explain'}),
+            ('POST', '/notifications/mark_read', {'ids': '1,2'}),
+            ('POST', '/notifications/mark_read', {'up_to': 1}),
+            ('POST', '/post', {'post': 'explain', 'username': user[1]}),
+        ]
+
+        statements = []
+        db.TRACE_CALLBACK = statements.append
+        client = quad.app.test_client()
+        with client.session_transaction() as sess:
+            sess['username'] = user[1]
+
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        scans = 0
+        for method, path, data in requests:
+            statements.clear()
+            response = client.open(path, method=method, data=data)
+            # Streamed pages (the home feed) only query as their body is read
+            response.get_data()
+            response.close()
+            print(f"\n=== {method} {path} ({len(statements)} statements)")
+            seen = set()
+            for sql in statements:
+                text = ' '.join(sql.split())
+                if text in seen or not text.upper().startswith(('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')):
+                    continue
+                seen.add(text)
+                # only scans of real tables count; CTEs and subqueries hold already-filtered rows
+                real = set()
+                for name, alias in re.findall(r'(?:FROM|JOIN)\s+(\w+)(?:\s+(\w+))?', text, re.IGNORECASE):
+                    if name in tables:
+                        real |= {name, alias}
+                print(f"\n  {text}")
+                for plan in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+                    detail = plan[3]
+                    flag = ''
+                    name = detail.split()[1] if detail.startswith('SCAN ') else None
+                    # virtual tables (FTS5) report their own index use as a SCAN
+                    if name in real and 'VIRTUAL TABLE' not in detail:
+                        flag = '   <-- full scan'
+                        scans += 1
+                    print(f"    {detail}{flag}")
+        conn.close()
+        print(f"\n{scans} full table scan(s) found")
+        return scans
+    finally:
+        db.TRACE_CALLBACK = None
+        db.DATABASE_PATH = real_path
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command == 'migrate':
+        start = time.perf_counter()
+        applied = migrate()
+        print(f"{len(applied)} migration(s) applied in {time.perf_counter() - start:.2f}s")
+    elif command == 'status':
+        status()
+    elif command == 'explain' and len(sys.argv) > 2:
+        explain(sys.argv[2])
+    elif command == 'reconcile':
+        conn = create_connection()
+        fixed = reconcile_counters(conn.cursor())
+        unread = reconcile_unread(conn.cursor())
+        timelines = reconcile_timelines(conn.cursor())
+        conn.commit()
+        conn.close()
+        print(f"{fixed} post(s) had stale counters")
+        print(f"{unread} user(s) had a stale unread count")
+        print(f"{timelines} user(s) had a stale timeline size")
+    elif command == 'rebuild-post-index':
+        conn = create_connection()
+        print(f"Indexed {rebuild_post_index(conn)} post(s)")
+        conn.close()
+    elif command == 'backfill-posts':
+        conn = create_connection()
+        print(f"Backfilled {backfill_posts(conn)} post(s)")
+        conn.close()
+    else:
+        print(__doc__)
+        sys.exit(1)
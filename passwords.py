@@ -0,0 +1,200 @@
+'''
+passwords.py
+bcrypt hashing off the request thread
+
+hashes and checks run in a small process pool so a burst of logins cannot stall
+every other request on the worker; work is admitted through a bounded queue and
+at most PER_KEY_LIMIT operations per client IP and per username run at once
+stored hashes whose cost factor differs from BCRYPT_ROUNDS are re-hashed on the
+next successful login
+'''
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+import bcrypt
+
+# bcrypt cost factor for new hashes; changing it re-hashes users as they log in
+BCRYPT_ROUNDS = int(os.environ.get('QUAD_BCRYPT_ROUNDS', 12))
+# Number of worker processes doing the hashing
+HASH_WORKERS = int(os.environ.get('QUAD_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+# Maximum hashes running or waiting at once before new ones are turned away
+MAX_PENDING = HASH_WORKERS * 8
+# Maximum concurrent hashes for a single IP address or username
+PER_KEY_LIMIT = 2
+# Seconds to wait for a worker before giving up (the hash keeps its slot until it finishes)
+HASH_TIMEOUT = 10
+
+
+class PasswordBusy(Exception):
+    """Raised when the hashing queue, or a client's share of it, is full, or a hash takes too long."""
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_state_lock = threading.Lock()
+_pending = 0
+_per_key = {}
+_stats = {
+    'hashes': 0,
+    'checks': 0,
+    'rehashes': 0,
+    'rejected': 0,
+    'timeouts': 0,
+    'seconds_total': 0.0,
+    'seconds_max': 0.0,
+}
+_recent = deque(maxlen=1000)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+            atexit.register(_executor.shutdown, wait=False)
+        return _executor
+
+
+def _admit(keys):
+    global _pending
+    keys = [k for k in keys if k]
+    with _state_lock:
+        if _pending >= MAX_PENDING or any(_per_key.get(k, 0) >= PER_KEY_LIMIT for k in keys):
+            _stats['rejected'] += 1
+            raise PasswordBusy()
+        _pending += 1
+        for k in keys:
+            _per_key[k] = _per_key.get(k, 0) + 1
+    return keys
+
+
+def _release(keys, kind, elapsed):
+    global _pending
+    with _state_lock:
+        _pending -= 1
+        for k in keys:
+            if _per_key[k] <= 1:
+                del _per_key[k]
+            else:
+                _per_key[k] -= 1
+        _stats[kind] += 1
+        _stats['seconds_total'] += elapsed
+        _stats['seconds_max'] = max(_stats['seconds_max'], elapsed)
+        _recent.append(elapsed)
+
+
+def _run(kind, keys, func, *args):
+    keys = _admit(keys)
+    start = time.perf_counter()
+    try:
+        future = _get_executor().submit(func, *args)
+    except BaseException:
+        _release(keys, kind, time.perf_counter() - start)
+        raise
+    # Released when the worker is done rather than when we stop waiting, so a hash that
+    # outlives HASH_TIMEOUT still counts against the queue and the client's limit
+    future.add_done_callback(lambda _: _release(keys, kind, time.perf_counter() - start))
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except FutureTimeout:
+        with _state_lock:
+            _stats['timeouts'] += 1
+        raise PasswordBusy()
+
+
+def _as_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+'''
+hash_password(password, ip=None, username=None):
+hashes a password with the configured cost factor in the worker pool
+
+params:
+password - the plain text password
+ip, username - the client making the request, used for the concurrency limits
+returns:
+the bcrypt hash as bytes
+raises:
+PasswordBusy if too much hashing is already in progress or it takes longer than HASH_TIMEOUT
+'''
+def hash_password(password, ip=None, username=None):
+    return _run('hashes', ['ip:' + ip if ip else None, 'user:' + username.lower() if username else None],
+                _hashpw, _as_bytes(password), BCRYPT_ROUNDS)
+
+
+'''
+check_password(password, hashed, ip=None, username=None):
+checks a password against a stored bcrypt hash in the worker pool
+
+returns:
+True if the password matches
+raises:
+PasswordBusy if too much hashing is already in progress or it takes longer than HASH_TIMEOUT
+'''
+def check_password(password, hashed, ip=None, username=None):
+    return _run('checks', ['ip:' + ip if ip else None, 'user:' + username.lower() if username else None],
+                _checkpw, _as_bytes(password), _as_bytes(hashed))
+
+
+'''
+needs_rehash(hashed):
+checks whether a stored hash was made with a different cost factor than BCRYPT_ROUNDS
+
+returns:
+True if the password should be hashed again
+'''
+def needs_rehash(hashed):
+    hashed = _as_bytes(hashed)
+    try:
+        # $2b$12$... -> 12
+        return int(hashed.split(b'$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+'''
+rehash_password(cursor, user_id, password, ip=None):
+stores a fresh hash of a just-verified password; the caller commits
+
+raises:
+PasswordBusy like hash_password(); the login has already succeeded, so callers skip the rehash
+'''
+def rehash_password(cursor, user_id, password, ip=None):
+    hashed = hash_password(password, ip)
+    cursor.execute('UPDATE users SET password = ? WHERE id = ?', (hashed, user_id))
+    with _state_lock:
+        _stats['rehashes'] += 1
+
+
+'''
+metrics():
+returns hashing latency and queue statistics
+
+returns:
+a dict of counters, latency figures in seconds and the current queue depth
+'''
+def metrics():
+    with _state_lock:
+        recent = sorted(_recent)
+        result = dict(_stats)
+        result['pending'] = _pending
+        result['max_pending'] = MAX_PENDING
+        result['workers'] = HASH_WORKERS
+        result['rounds'] = BCRYPT_ROUNDS
+    if recent:
+        result['seconds_p50'] = recent[len(recent) // 2]
+        result['seconds_p95'] = recent[min(len(recent) - 1, int(len(recent) * 0.95))]
+    return result
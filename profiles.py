@@ -0,0 +1,119 @@
+'''
+profiles.py
+loads everything the profile page shows in a fixed number of queries
+
+the profile's user comes from the identity cache, the friend list is one query
+(and tells us whether the viewer is a friend, so that needs no query of its
+own), and one page of posts with their stored like/comment counts and whether
+the viewer liked each one is a single keyset-paginated query, however many
+posts the user has
+
+a page that runs past the user's oldest post in users.db carries on into the
+archive databases holding their older posts (see archive.py), newest first
+'''
+import archive
+import friends as friend_graph
+from identity import lookup_user
+
+# Posts shown per page of a profile
+PROFILE_PAGE_SIZE = 20
+
+# One page of a user's posts; {prefix} is '' for users.db or an attached archive's schema
+POSTS_SQL = '''
+    SELECT p.id, p.post_content, datetime(p.created_at, 'unixepoch'), p.like_count, p.comment_count,
+           ml.user_id IS NOT NULL
+    FROM {prefix}posts p
+    LEFT JOIN {prefix}likes ml ON ml.post_id = p.id AND ml.user_id = ?
+    WHERE p.author_id = ? {keyset}
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+
+'''
+load_profile(conn, username, viewer_id, before_id=None, limit=PROFILE_PAGE_SIZE):
+gathers the data for one page of a user's profile as seen by [viewer_id]
+
+params:
+conn - a connection to the users.db database
+username - the profile's username (any case)
+viewer_id - id of the logged-in user viewing the profile
+before_id - optional id of the last post on the previous page
+limit - the maximum number of posts to return
+returns:
+None if there is no such user, otherwise a dict with
+  user - the identity row of the profile's user
+  friends - their mutual friends (dicts with id, name, username and pfp), by name
+  is_friend - whether the viewer is one of those friends
+  posts - the page of posts (dicts with id, username, post_content, timestamp,
+          like_count, comment_count and liked), newest first, or None if the
+          viewer may not see them
+  next_before - the cursor for the next page, or None on the last page
+'''
+def load_profile(conn, username, viewer_id, before_id=None, limit=PROFILE_PAGE_SIZE):
+    user = lookup_user(conn, username)
+    if not user:
+        return None
+    cursor = conn.cursor()
+    friends = friend_graph.list_friends(cursor, user['id'])
+    is_friend = any(friend['id'] == viewer_id for friend in friends)
+    profile = {'user': user, 'friends': friends, 'is_friend': is_friend, 'posts': None, 'next_before': None}
+    # Only show posts to mutual friends and to the user themselves
+    if not (is_friend or viewer_id == user['id']):
+        return profile
+
+    keyset = ''
+    params = [viewer_id, user['id']]
+    if before_id is not None:
+        keyset = 'AND (p.created_at, p.id) < (SELECT created_at, id FROM posts WHERE id = ?)'
+        params.append(before_id)
+    params.append(limit)
+    cursor.execute(POSTS_SQL.format(prefix='', keyset=keyset), params)
+    rows = cursor.fetchall()
+    if len(rows) < limit:
+        rows += archived_posts(conn, user['id'], viewer_id, rows[-1][0] if rows else before_id, limit - len(rows))
+    profile['posts'] = [
+        {'id': r[0], 'username': user['username'], 'post_content': r[1], 'timestamp': r[2],
+         'like_count': r[3], 'comment_count': r[4], 'liked': bool(r[5])}
+        for r in rows
+    ]
+    if len(profile['posts']) == limit:
+        profile['next_before'] = profile['posts'][-1]['id']
+    return profile
+
+
+'''
+archived_posts(conn, author_id, viewer_id, before_id, limit):
+continues a profile's posts in the archive databases, attaching only the ones
+that hold posts of [author_id]
+
+params:
+conn - a connection to the users.db database
+author_id - the profile's user
+viewer_id - the user looking at the profile, for liked-by-me
+before_id - optional id of the last post already shown (in users.db or an archive)
+limit - the maximum number of posts to return
+returns:
+rows in the same columns as POSTS_SQL, newest first
+'''
+def archived_posts(conn, author_id, viewer_id, before_id, limit):
+    periods = archive.author_periods(conn, author_id)
+    if not periods:
+        return []
+    last = None
+    if before_id is not None:
+        last = archive.position(conn, before_id)
+        if last is None:
+            return []
+    rows = []
+    for period in periods:
+        # Every post in the period is at least period_start() old, so none is older than [last]
+        if last is not None and last[0] <= archive.period_start(period):
+            continue
+        with archive.attached(conn, period) as schema:
+            keyset = 'AND (p.created_at, p.id) < (?, ?)' if last is not None else ''
+            params = [viewer_id, author_id] + (list(last) if last is not None else []) + [limit - len(rows)]
+            rows += conn.execute(POSTS_SQL.format(prefix=f'{schema}.', keyset=keyset), params).fetchall()
+        if len(rows) >= limit:
+            break
+    return rows
@@ -0,0 +1,230 @@
+'''
+pushhub.py
+in-process publish/subscribe hub behind the /events Server-Sent Events stream
+
+writes publish small events (a post's new like count, a new comment, a user's
+new unread count) to topics such as 'post:12' or 'user:3' once they have
+committed; every open /events connection subscribes to its user's topic and to
+the posts on the page it is showing, so clients update in place instead of
+reloading the feed or re-fetching comments
+
+event ids are '<boot>-<sequence>'; the last REPLAY_BUFFER events are kept so a
+client that reconnects with Last-Event-ID gets what it missed, as long as the
+server has not restarted and the events are still buffered
+
+stream() blocks a thread per client (WSGI); astream() waits on the event loop
+instead, so the ASGI server (asgi.py) can hold thousands of idle streams
+'''
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+# Number of recent events kept for Last-Event-ID resume
+REPLAY_BUFFER = 2000
+# Events a slow client may fall behind by before it is disconnected
+SUBSCRIBER_QUEUE = 256
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_SECONDS = 15
+# Maximum open event streams per process (QUAD_MAX_SUBSCRIBERS); an idle stream on the
+# ASGI server costs a queue and a socket, so the limit is usually the open file limit
+MAX_SUBSCRIBERS = int(os.environ.get('QUAD_MAX_SUBSCRIBERS', 10000))
+# Maximum posts one stream may follow
+MAX_POST_TOPICS = 200
+
+BOOT = format(int(time.time()), 'x')
+
+
+class HubFull(Exception):
+    """Raised when MAX_SUBSCRIBERS streams are already open."""
+
+
+class Subscription:
+    """One open event stream: the topics it follows and the events waiting for it."""
+
+    def __init__(self, topics):
+        self.topics = frozenset(topics)
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        self.overflowed = False
+        # Called (from the publishing thread) after events are queued
+        self.wakeup = None
+
+
+_lock = threading.Lock()
+_subscribers = set()
+# topic -> the subscriptions following it, so publish only visits its own streams
+_index = {}
+_recent = deque(maxlen=REPLAY_BUFFER)
+_sequence = 0
+_stats = {'published': 0, 'delivered': 0, 'dropped': 0}
+
+
+def _parse_id(event_id):
+    # '<boot>-<sequence>' -> sequence, or None if it belongs to another run
+    boot, _, seq = (event_id or '').partition('-')
+    if boot != BOOT or not seq.isdigit():
+        return None
+    return int(seq)
+
+
+'''
+publish(topic, event, data):
+sends an event to every stream following [topic]; call it only after the
+write the event describes has committed
+
+params:
+topic - e.g. 'post:12' or 'user:3'
+event - the SSE event name, e.g. 'like', 'comment' or 'notification'
+data - a JSON-serialisable dict
+'''
+def publish(topic, event, data):
+    global _sequence
+    wakeups = []
+    with _lock:
+        _sequence += 1
+        item = (_sequence, topic, event, json.dumps(data))
+        _recent.append(item)
+        _stats['published'] += 1
+        for sub in _index.get(topic, ()):
+            if sub.overflowed:
+                continue
+            try:
+                sub.queue.put_nowait(item)
+                _stats['delivered'] += 1
+            except queue.Full:
+                # Too far behind; the stream ends and the client reconnects with Last-Event-ID
+                sub.overflowed = True
+                _stats['dropped'] += 1
+            if sub.wakeup is not None:
+                wakeups.append(sub.wakeup)
+    # Outside the lock, so subscribe/unsubscribe and other publishers are not held up
+    for wakeup in wakeups:
+        try:
+            wakeup()
+        except RuntimeError:
+            pass  # its event loop has already closed
+
+
+'''
+subscribe(topics, last_event_id=None):
+opens a subscription and queues any buffered events after [last_event_id]
+
+params:
+topics - the topics to follow
+last_event_id - the Last-Event-ID sent by a reconnecting client
+returns:
+a Subscription; pass it to unsubscribe() when the stream closes
+raises:
+HubFull if MAX_SUBSCRIBERS streams are already open
+'''
+def subscribe(topics, last_event_id=None):
+    sub = Subscription(topics)
+    after = _parse_id(last_event_id)
+    with _lock:
+        if len(_subscribers) >= MAX_SUBSCRIBERS:
+            raise HubFull()
+        if after is not None:
+            for item in _recent:
+                if item[0] > after and item[1] in sub.topics:
+                    try:
+                        sub.queue.put_nowait(item)
+                    except queue.Full:
+                        break
+        _subscribers.add(sub)
+        for topic in sub.topics:
+            _index.setdefault(topic, set()).add(sub)
+    return sub
+
+
+'''
+unsubscribe(sub):
+closes a subscription
+'''
+def unsubscribe(sub):
+    with _lock:
+        if sub not in _subscribers:
+            return
+        _subscribers.discard(sub)
+        for topic in sub.topics:
+            followers = _index.get(topic)
+            if followers is not None:
+                followers.discard(sub)
+                if not followers:
+                    del _index[topic]
+
+
+'''
+format_event(item):
+serialises a queued event in the text/event-stream wire format
+'''
+def format_event(item):
+    seq, _, event, data = item
+    return f'id: {BOOT}-{seq}\nevent: {event}\ndata: {data}\n\n'
+
+
+'''
+stream(sub, initial=()):
+yields the text/event-stream body for a subscription until the client goes
+away or falls too far behind, sending a keep-alive comment when idle
+
+params:
+sub - a Subscription from subscribe()
+initial - (event, data) pairs sent first without an id, e.g. the current unread count
+'''
+def stream(sub, initial=()):
+    try:
+        yield 'retry: 3000\n\n'
+        for event, data in initial:
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+        while not sub.overflowed:
+            try:
+                yield format_event(sub.queue.get(timeout=HEARTBEAT_SECONDS))
+            except queue.Empty:
+                yield ': ping\n\n'
+    finally:
+        unsubscribe(sub)
+
+
+'''
+astream(sub, initial=()):
+async version of stream() for the ASGI server; yields the same chunks but waits
+on the event loop instead of blocking a thread while the stream is idle
+'''
+async def astream(sub, initial=()):
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    # Anything queued before this is found by the first check below
+    sub.wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+    try:
+        yield 'retry: 3000\n\n'
+        for event, data in initial:
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+        while not sub.overflowed:
+            # Clear before looking, so an event queued after the check still wakes us
+            ready.clear()
+            try:
+                yield format_event(sub.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            try:
+                await asyncio.wait_for(ready.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': ping\n\n'
+    finally:
+        unsubscribe(sub)
+
+
+'''
+metrics():
+returns hub counters, the number of open streams and of topics they follow
+'''
+def metrics():
+    with _lock:
+        result = dict(_stats)
+        result['subscribers'] = len(_subscribers)
+        result['topics'] = len(_index)
+    return result
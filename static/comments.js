@@ -1,4 +1,56 @@
 document.addEventListener('DOMContentLoaded', function() {
+  function renderComment(c) {
+    const div = document.createElement('div');
+    div.dataset.commentId = c.id;
+    div.style.borderBottom = '1px solid #222';
+    div.style.padding = '8px 0';
+    const header = document.createElement('div');
+    header.style.display = 'flex';
+    header.style.justifyContent = 'space-between';
+    header.style.alignItems = 'center';
+    // left: avatar + username link
+    const left = document.createElement('div');
+    left.style.display = 'flex';
+    left.style.alignItems = 'center';
+    const avatar = document.createElement('div');
+    avatar.className = 'avatar-badge';
+    if (c.avatar) {
+      // 64px thumbnail for the 36px badge, sharp on 2x screens
+      const img = document.createElement('img');
+      img.className = 'avatar-img';
+      img.src = c.avatar;
+      img.width = 36;
+      img.height = 36;
+      img.alt = '';
+      img.loading = 'lazy';
+      avatar.appendChild(img);
+    } else {
+      const initials = (c.username || '').trim().slice(0,2).toUpperCase();
+      avatar.textContent = initials || '?';
+    }
+    const userLink = document.createElement('a');
+    userLink.href = '/profile/' + encodeURIComponent(c.username);
+    userLink.textContent = c.username;
+    userLink.style.color = '#9fd4ff';
+    userLink.style.textDecoration = 'none';
+    userLink.style.fontWeight = '600';
+    left.appendChild(avatar);
+    left.appendChild(userLink);
+    const ts = document.createElement('small');
+    ts.style.color = '#9aa0a6';
+    ts.style.fontSize = '0.85rem';
+    ts.textContent = c.timestamp;
+    header.appendChild(left);
+    header.appendChild(ts);
+    const contentDiv = document.createElement('div');
+    contentDiv.textContent = c.content; // safe insertion
+    contentDiv.style.color = '#ddd';
+    contentDiv.style.marginTop = '6px';
+    div.appendChild(header);
+    div.appendChild(contentDiv);
+    return div;
+  }
+
   function openComments(postId) {
     const modal = document.getElementById('comments-modal');
     const postIdInput = document.getElementById('comment-post-id');
@@ -23,63 +75,88 @@ document.addEventListener('DOMContentLoaded', function() {
       });
     }
 
-    fetch(`/comments/${postId}`)
+    loadComments(postId, null);
+  }
+
+  // Loads one page of comments into the modal; before=null starts from the newest
+  function loadComments(postId, before) {
+    const list = document.getElementById('comments-list');
+    const url = `/comments/${postId}` + (before ? `?before=${before}` : '');
+    return fetch(url, {credentials: 'same-origin'})
       .then(r => {
         if (!r.ok) throw new Error('Network response was not ok');
         return r.json();
       })
       .then(data => {
-        list.innerHTML = '';
+        if (String(document.getElementById('comment-post-id').value) !== String(postId)) return data;
+        if (!before) list.innerHTML = '';
         if (data.comments && data.comments.length) {
-          data.comments.forEach(c => {
-            const div = document.createElement('div');
-            div.style.borderBottom = '1px solid #222';
-            div.style.padding = '8px 0';
-            const header = document.createElement('div');
-            header.style.display = 'flex';
-            header.style.justifyContent = 'space-between';
-            header.style.alignItems = 'center';
-            // left: avatar + username link
-            const left = document.createElement('div');
-            left.style.display = 'flex';
-            left.style.alignItems = 'center';
-            const avatar = document.createElement('div');
-            avatar.className = 'avatar-badge';
-            // Always render initials for privacy and consistency
-            const initials = (c.username || '').trim().slice(0,2).toUpperCase();
-            avatar.textContent = initials || '?';
-            const userLink = document.createElement('a');
-            userLink.href = '/profile/' + encodeURIComponent(c.username);
-            userLink.textContent = c.username;
-            userLink.style.color = '#9fd4ff';
-            userLink.style.textDecoration = 'none';
-            userLink.style.fontWeight = '600';
-            left.appendChild(avatar);
-            left.appendChild(userLink);
-            const ts = document.createElement('small');
-            ts.style.color = '#9aa0a6';
-            ts.style.fontSize = '0.85rem';
-            ts.textContent = c.timestamp;
-            header.appendChild(left);
-            header.appendChild(ts);
-            const contentDiv = document.createElement('div');
-            contentDiv.textContent = c.content; // safe insertion
-            contentDiv.style.color = '#ddd';
-            contentDiv.style.marginTop = '6px';
-            list.appendChild(div);
-            div.appendChild(header);
-            div.appendChild(contentDiv);
-          });
-        } else {
+          data.comments.forEach(c => list.appendChild(renderComment(c)));
+        } else if (!before) {
           list.innerHTML = '<p style="color:#666;">No comments yet. Be the first to comment!</p>';
         }
+        if (data.next_before) {
+          const more = document.createElement('button');
+          more.type = 'button';
+          more.className = 'comments-more';
+          more.textContent = 'Load older comments';
+          more.style.cssText = 'background:transparent; color:#9fd4ff; border:none; padding:8px 0; cursor:pointer;';
+          more.addEventListener('click', function() {
+            more.remove();
+            loadComments(postId, data.next_before);
+          });
+          list.appendChild(more);
+        }
+        return data;
       })
       .catch(err => {
         console.error('Failed to load comments', err);
-        list.innerHTML = '<p style="color:#900">Could not load comments. Please try again.</p>';
+        if (!before) list.innerHTML = '<p style="color:#900">Could not load comments. Please try again.</p>';
       });
   }
 
+  function renderPreviewLine(c) {
+    const line = document.createElement('div');
+    const name = document.createElement('strong');
+    name.textContent = c.username + ' ';
+    line.appendChild(name);
+    line.appendChild(document.createTextNode(c.content)); // safe insertion
+    return line;
+  }
+
+  function renderPreview(postId, preview) {
+    const btn = document.querySelector('.comment-btn[data-post-id="' + postId + '"]');
+    if (!btn) return;
+    const badge = document.getElementById('comment-count-' + postId);
+    if (badge) badge.textContent = preview.comment_count;
+    let box = document.querySelector('.comment-preview[data-post-id="' + postId + '"]');
+    if (!box) {
+      box = document.createElement('div');
+      box.className = 'comment-preview';
+      box.dataset.postId = postId;
+      box.style.cssText = 'font-size:0.85rem; color:#bbb; margin-top:6px; cursor:pointer;';
+      // Clicking a preview opens the full list
+      box.addEventListener('click', () => openComments(postId));
+      btn.parentElement.appendChild(box);
+    }
+    box.innerHTML = '';
+    preview.comments.forEach(c => box.appendChild(renderPreviewLine(c)));
+  }
+
+  // Comment previews for the given posts, fetched in one request per 100 posts
+  function loadPreviews(ids) {
+    for (let i = 0; i < ids.length; i += 100) {
+      fetch('/comments/preview?posts=' + ids.slice(i, i + 100).join(','), {credentials: 'same-origin'})
+        .then(r => r.ok ? r.json() : Promise.reject(r.status))
+        .then(data => Object.keys(data.posts || {}).forEach(id => renderPreview(id, data.posts[id])))
+        .catch(err => console.error('Failed to load comment previews', err));
+    }
+  }
+  loadPreviews(Array.from(document.querySelectorAll('.comment-btn[data-post-id]'))
+    .map(b => b.getAttribute('data-post-id')));
+  // Posts appended by feed.js infinite scroll
+  document.addEventListener('quad:posts', e => loadPreviews(e.detail));
+
   function closeComments() {
     const modal = document.getElementById('comments-modal');
     const content = modal.querySelector('.comments-modal-content');
@@ -108,6 +185,23 @@ document.addEventListener('DOMContentLoaded', function() {
     }
   });
 
+  // New comments pushed by live.js; newest first, like /comments/<id>
+  document.addEventListener('quad:comment', function(e) {
+    const c = e.detail;
+    const box = document.querySelector('.comment-preview[data-post-id="' + c.post_id + '"]');
+    if (box) {
+      box.insertBefore(renderPreviewLine(c), box.firstChild);
+      while (box.children.length > 3) box.removeChild(box.lastChild);
+    }
+    const modal = document.getElementById('comments-modal');
+    const list = document.getElementById('comments-list');
+    if (!modal || modal.style.display === 'none' || !list) return;
+    if (String(document.getElementById('comment-post-id').value) !== String(c.post_id)) return;
+    if (list.querySelector('[data-comment-id="' + c.id + '"]')) return;
+    if (!list.querySelector('[data-comment-id]')) list.innerHTML = '';
+    list.insertBefore(renderComment(c), list.firstChild);
+  });
+
   const closeBtn = document.getElementById('close-comments');
   if (closeBtn) closeBtn.addEventListener('click', closeComments);
 
@@ -134,63 +228,11 @@ document.addEventListener('DOMContentLoaded', function() {
       .then(data => {
         if (data.success) {
           document.getElementById('comment-content').value = '';
-          // refresh comments
-          fetch(`/comments/${postId}`, {credentials: 'same-origin'})
-            .then(r => {
-              if (!r.ok) throw new Error('Failed to fetch comments');
-              return r.json();
-            })
-            .then(data => {
-              const list = document.getElementById('comments-list');
-              list.innerHTML = '';
-              if (data.comments && data.comments.length) {
-                data.comments.forEach(c => {
-                  const div = document.createElement('div');
-                  div.style.borderBottom = '1px solid #222';
-                  div.style.padding = '8px 0';
-                  const header = document.createElement('div');
-                  header.style.display = 'flex';
-                  header.style.justifyContent = 'space-between';
-                  header.style.alignItems = 'center';
-                  // left: avatar + username link
-                  const left = document.createElement('div');
-                  left.style.display = 'flex';
-                  left.style.alignItems = 'center';
-                  const avatar = document.createElement('div');
-                  avatar.className = 'avatar-badge';
-                  // Always render initials for privacy and consistency
-                  const initials = (c.username || '').trim().slice(0,2).toUpperCase();
-                  avatar.textContent = initials || '?';
-                  const userLink = document.createElement('a');
-                  userLink.href = '/profile/' + encodeURIComponent(c.username);
-                  userLink.textContent = c.username;
-                  userLink.style.color = '#9fd4ff';
-                  userLink.style.textDecoration = 'none';
-                  userLink.style.fontWeight = '600';
-                  left.appendChild(avatar);
-                  left.appendChild(userLink);
-                  const ts = document.createElement('small');
-                  ts.style.color = '#9aa0a6';
-                  ts.style.fontSize = '0.85rem';
-                  ts.textContent = c.timestamp;
-                  header.appendChild(left);
-                  header.appendChild(ts);
-                  const contentDiv = document.createElement('div');
-                  contentDiv.textContent = c.content;
-                  contentDiv.style.color = '#ddd';
-                  contentDiv.style.marginTop = '6px';
-                  div.appendChild(header);
-                  div.appendChild(contentDiv);
-                  list.appendChild(div);
-                });
-              }
-              // update comment count badge if exists
-              const badge = document.getElementById('comment-count-' + postId);
-              if (badge) {
-                badge.textContent = data.comments ? data.comments.length : 0;
-              }
-            })
-            .catch(err => console.error('Failed to refresh comments', err));
+          // refresh the first page of comments and the count badge
+          loadComments(postId, null).then(data => {
+            const badge = document.getElementById('comment-count-' + postId);
+            if (badge && data) badge.textContent = data.comment_count;
+          });
         } else if (data.error) {
           alert(data.error || 'Could not post comment');
         }
@@ -0,0 +1,107 @@
+// Home feed: like buttons and infinite scroll through /feed.
+document.addEventListener('DOMContentLoaded', function() {
+  const list = document.getElementById('feed-posts');
+  const template = document.getElementById('post-template');
+
+  // Delegated, so posts added by infinite scroll work too
+  document.body.addEventListener('click', function(e) {
+    const btn = e.target.closest && e.target.closest('.like-btn');
+    if (!btn) return;
+    const postId = btn.getAttribute('data-post-id');
+    const liked = btn.classList.contains('liked');
+    const action = liked ? 'unlike' : 'like';
+    // optimistic UI: toggle immediately for snappy feel
+    btn.classList.toggle('liked', action === 'like');
+    btn.setAttribute('aria-pressed', action === 'like' ? 'true' : 'false');
+    const heart = btn.querySelector('.heart');
+    if (heart) {
+      heart.classList.add('pop');
+      setTimeout(() => heart.classList.remove('pop'), 200);
+    }
+
+    fetch('/like_post', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/x-www-form-urlencoded',
+      },
+      body: `post_id=${postId}&action=${action}`
+    })
+    .then(response => response.json())
+    .then(data => {
+      if (data.like_count !== undefined) {
+        // update count
+        document.getElementById('like-count-' + postId).textContent = data.like_count;
+        // ensure final state matches server
+        btn.classList.toggle('liked', data.liked || action === 'like');
+        btn.setAttribute('aria-pressed', btn.classList.contains('liked') ? 'true' : 'false');
+      }
+    })
+    .catch(() => {
+      // revert optimistic toggle on error
+      btn.classList.toggle('liked', liked);
+      btn.setAttribute('aria-pressed', liked ? 'true' : 'false');
+    });
+  });
+
+  // One post, built from the same markup the server renders (home.html's post_item)
+  function renderPost(p) {
+    const frag = template.content.cloneNode(true);
+    const details = frag.querySelector('.post-details');
+    const name = details.querySelector('strong');
+    name.textContent = p.username;
+    details.querySelector('.date-time').textContent = p.timestamp;
+    frag.querySelector('p').textContent = p.post_content;
+    if (p.avatar) {
+      const badge = document.createElement('span');
+      badge.className = 'avatar-badge';
+      const img = document.createElement('img');
+      img.className = 'avatar-img';
+      img.src = p.avatar;
+      img.width = 36;
+      img.height = 36;
+      img.alt = '';
+      img.loading = 'lazy';
+      badge.appendChild(img);
+      details.insertBefore(badge, name);
+    }
+    const like = frag.querySelector('.like-btn');
+    like.setAttribute('data-post-id', p.id);
+    like.classList.toggle('liked', p.liked);
+    like.setAttribute('aria-pressed', p.liked ? 'true' : 'false');
+    const likeCount = frag.querySelector('.like-count');
+    likeCount.id = 'like-count-' + p.id;
+    likeCount.textContent = p.like_count;
+    frag.querySelector('.comment-btn').setAttribute('data-post-id', p.id);
+    const commentCount = frag.querySelector('.comment-count');
+    commentCount.id = 'comment-count-' + p.id;
+    commentCount.textContent = p.comment_count;
+    return frag;
+  }
+
+  // The "Older posts" link still works without JS; with it, the next page is
+  // appended as the link scrolls into view
+  const more = document.getElementById('older-posts');
+  if (!list || !template || !more || !('IntersectionObserver' in window)) return;
+  let loading = false;
+  const observer = new IntersectionObserver(entries => {
+    if (loading || !entries.some(entry => entry.isIntersecting)) return;
+    loading = true;
+    fetch('/feed?before=' + more.dataset.before, {credentials: 'same-origin'})
+      .then(r => r.ok ? r.json() : Promise.reject(r.status))
+      .then(data => {
+        data.posts.forEach(p => list.appendChild(renderPost(p)));
+        // live.js and comments.js follow the new posts too
+        document.dispatchEvent(new CustomEvent('quad:posts', {detail: data.posts.map(p => String(p.id))}));
+        if (data.next_before) {
+          more.dataset.before = data.next_before;
+          more.href = '/home?before=' + data.next_before;
+        } else {
+          observer.disconnect();
+          more.remove();
+        }
+      })
+      .catch(err => console.error('Failed to load older posts', err))
+      .finally(() => { loading = false; });
+  }, {rootMargin: '600px'});
+  observer.observe(more);
+});
@@ -0,0 +1,88 @@
+// Live updates over /events: unread badge, like counts and new comments.
+document.addEventListener('DOMContentLoaded', function() {
+  if (!window.EventSource) return;
+  // The server follows at most this many posts per stream (pushhub.MAX_POST_TOPICS)
+  const MAX_POSTS = 200;
+  // Posts this close to the viewport count as on screen, so they are followed before they scroll in
+  const MARGIN = '1500px 0px';
+  // Let scrolling settle before the stream is replaced
+  const RECONNECT_DELAY = 1000;
+  // One element per post: its like button
+  const onScreen = new Set();
+  let followed = new Set();
+  let source = null;
+  let lastEventId = '';
+  let pending = null;
+
+  function visibleIds() {
+    return Array.from(new Set(Array.from(onScreen, el => el.getAttribute('data-post-id')))).slice(-MAX_POSTS);
+  }
+
+  function connect() {
+    clearTimeout(pending);
+    pending = null;
+    if (source) source.close();
+    followed = new Set(visibleIds());
+    // Replay whatever was published while the old stream was being replaced
+    const resume = lastEventId ? '&last_event_id=' + encodeURIComponent(lastEventId) : '';
+    source = new EventSource('/events?posts=' + Array.from(followed).join(',') + resume);
+    listen(source);
+  }
+
+  // Only the posts on (or near) the screen are followed, so the URL stays short however
+  // far the feed is scrolled; a new stream is opened once a post the current one does
+  // not follow comes into view
+  function changed() {
+    if (!source) return connect();
+    if (pending || visibleIds().every(id => followed.has(id))) return;
+    pending = setTimeout(connect, RECONNECT_DELAY);
+  }
+
+  const observer = window.IntersectionObserver ? new IntersectionObserver(entries => {
+    entries.forEach(e => e.isIntersecting ? onScreen.add(e.target) : onScreen.delete(e.target));
+    changed();
+  }, {rootMargin: MARGIN}) : null;
+
+  function watch(elements) {
+    elements.forEach(el => observer ? observer.observe(el) : onScreen.add(el));
+  }
+
+  // Posts added to the page later (feed.js infinite scroll)
+  document.addEventListener('quad:posts', e => {
+    watch(e.detail.map(id => document.querySelector('.like-btn[data-post-id="' + id + '"]')).filter(Boolean));
+    if (!observer) changed();
+  });
+
+  function setUnread(count) {
+    const badge = document.getElementById('unread-badge');
+    if (!badge) return;
+    badge.textContent = count;
+    badge.style.display = count > 0 ? 'inline' : 'none';
+  }
+
+  function listen(source) {
+    ['unread', 'notification', 'like', 'comment'].forEach(type =>
+      source.addEventListener(type, e => { if (e.lastEventId) lastEventId = e.lastEventId; }));
+    source.addEventListener('unread', e => setUnread(JSON.parse(e.data).unread));
+    source.addEventListener('notification', e => setUnread(JSON.parse(e.data).unread));
+
+    source.addEventListener('like', e => {
+      const data = JSON.parse(e.data);
+      const count = document.getElementById('like-count-' + data.post_id);
+      if (count) count.textContent = data.like_count;
+    });
+
+    source.addEventListener('comment', e => {
+      const data = JSON.parse(e.data);
+      const count = document.getElementById('comment-count-' + data.post_id);
+      if (count) count.textContent = data.comment_count;
+      // comments.js appends it if the post's comments are open
+      document.dispatchEvent(new CustomEvent('quad:comment', {detail: data}));
+    });
+  }
+
+  const posts = Array.from(document.querySelectorAll('.like-btn[data-post-id]'));
+  watch(posts);
+  // With an observer the first stream opens on its first report; pages without posts connect now
+  if (!observer || !posts.length) connect();
+});
@@ -0,0 +1,179 @@
+'''
+timeline.py
+optional fan-out-on-write home feed
+
+when FANOUT_ENABLED is set, create_post() pushes each new post id into the
+timeline of every friend of its author, and the home feed becomes a single range
+scan over (user_id, post_id) in the timeline table; each timeline keeps about
+TIMELINE_CAP entries, trimmed back to the cap once users.timeline_entries (kept by
+triggers, see migrations.py) passes it by TIMELINE_TRIM_SLACK
+
+authors with more than FANOUT_MAX_FRIENDS friends are not fanned out (one post
+would mean that many writes); they are recorded in timeline_pull_authors and
+their posts are pulled at read time and merged with the timeline
+
+enabling fan-out on a database that already has posts needs a one-off rebuild:
+python timeline.py rebuild
+'''
+import os
+import sys
+
+from db import create_connection
+
+# Off by default; set QUAD_FANOUT=1 to serve the home feed from timelines
+FANOUT_ENABLED = os.environ.get('QUAD_FANOUT') == '1'
+# Number of post ids kept per user timeline
+TIMELINE_CAP = 800
+# Authors with more friends than this are pulled at read time instead
+FANOUT_MAX_FRIENDS = 1000
+# Entries a timeline may hold beyond the cap before it is trimmed back to it
+TIMELINE_TRIM_SLACK = 50
+
+
+'''
+fan_out(cursor, author_id, post_id):
+pushes a new post into the timelines of its author's friends
+does nothing when fan-out is disabled; the caller commits
+
+params:
+cursor - a cursor on the users.db database
+author_id - id of the user who wrote the post
+post_id - id of the new post
+'''
+def fan_out(cursor, author_id, post_id):
+    if not FANOUT_ENABLED:
+        return
+    cursor.execute('SELECT 1 FROM timeline_pull_authors WHERE user_id = ?', (author_id,))
+    if cursor.fetchone():
+        return
+    cursor.execute('''
+        INSERT OR IGNORE INTO timeline (user_id, post_id)
+        SELECT friend_id, ? FROM friends WHERE user_id = ?
+    ''', (post_id, author_id))
+    # Each timeline is trimmed once its own size passes the cap, however rarely it receives posts
+    cursor.execute('''
+        SELECT u.id FROM friends f JOIN users u ON u.id = f.friend_id
+        WHERE f.user_id = ? AND u.timeline_entries > ?
+    ''', (author_id, TIMELINE_CAP + TIMELINE_TRIM_SLACK))
+    for (friend_id,) in cursor.fetchall():
+        trim(cursor, friend_id)
+
+
+'''
+trim(cursor, user_id):
+drops the oldest entries of a timeline beyond TIMELINE_CAP
+'''
+def trim(cursor, user_id):
+    cursor.execute('''
+        DELETE FROM timeline WHERE user_id = ? AND post_id <= (
+            SELECT post_id FROM timeline WHERE user_id = ?
+            ORDER BY post_id DESC LIMIT 1 OFFSET ?
+        )
+    ''', (user_id, user_id, TIMELINE_CAP))
+
+
+'''
+backfill(cursor, user_id, friend_id):
+copies the most recent posts of [friend_id] into the timeline of [user_id]
+'''
+def backfill(cursor, user_id, friend_id):
+    cursor.execute('''
+        INSERT OR IGNORE INTO timeline (user_id, post_id)
+        SELECT ?, p.id FROM posts p
+        WHERE p.author_id = ?
+        ORDER BY p.id DESC LIMIT ?
+    ''', (user_id, friend_id, TIMELINE_CAP))
+    trim(cursor, user_id)
+
+
+'''
+on_new_friendship(cursor, user_id, friend_id):
+keeps timelines right after two users become mutual friends: each gets the
+other's recent posts, and anyone who just crossed FANOUT_MAX_FRIENDS switches
+to being pulled at read time; the caller commits
+'''
+def on_new_friendship(cursor, user_id, friend_id):
+    for a in (user_id, friend_id):
+        cursor.execute('SELECT COUNT(*) FROM friends WHERE user_id = ?', (a,))
+        if cursor.fetchone()[0] > FANOUT_MAX_FRIENDS:
+            cursor.execute('INSERT OR IGNORE INTO timeline_pull_authors (user_id) VALUES (?)', (a,))
+    if not FANOUT_ENABLED:
+        return
+    backfill(cursor, user_id, friend_id)
+    backfill(cursor, friend_id, user_id)
+
+
+'''
+page_query(user_id, before_id, limit):
+builds the SELECT that returns one page of post ids for a user's home feed:
+a range scan of the timeline merged with the posts of friends who are pulled
+
+params:
+user_id - the id of the user reading the feed
+before_id - optional id of the last post on the previous page
+limit - the maximum number of posts to return
+returns:
+(sql, params) for a query with a single post_id column, newest first
+'''
+def page_query(user_id, before_id, limit):
+    older = '' if before_id is None else 'AND post_id < ?'
+    older_pulled = '' if before_id is None else 'AND p.id < ?'
+    cursor_params = [] if before_id is None else [before_id]
+    sql = f'''
+        SELECT post_id FROM (
+            SELECT post_id FROM timeline WHERE user_id = ? {older}
+            ORDER BY post_id DESC LIMIT ?
+        )
+        UNION
+        SELECT post_id FROM (
+            SELECT p.id AS post_id FROM timeline_pull_authors pa
+            JOIN friends f ON f.user_id = ? AND f.friend_id = pa.user_id
+            JOIN posts p ON p.author_id = pa.user_id
+            WHERE 1 {older_pulled}
+            ORDER BY p.id DESC LIMIT ?
+        )
+        ORDER BY post_id DESC LIMIT ?
+    '''
+    params = [user_id] + cursor_params + [limit, user_id] + cursor_params + [limit, limit]
+    return sql, params
+
+
+'''
+rebuild(conn):
+refills every user's timeline from the friends and posts tables, one user per
+transaction; run once after turning fan-out on for an existing database
+
+returns:
+the number of timelines rebuilt
+'''
+def rebuild(conn):
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    for user_id in user_ids:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM timeline WHERE user_id = ?', (user_id,))
+        cursor.execute('''
+            INSERT OR IGNORE INTO timeline (user_id, post_id)
+            SELECT ?, p.id FROM friends f
+            JOIN posts p ON p.author_id = f.friend_id
+            WHERE f.user_id = ?
+              AND f.friend_id NOT IN (SELECT user_id FROM timeline_pull_authors)
+            ORDER BY p.id DESC LIMIT ?
+        ''', (user_id, user_id, TIMELINE_CAP))
+        conn.commit()
+    return len(user_ids)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild':
+        conn = create_connection()
+        # Pull authors first so rebuild() knows whose posts to leave out
+        conn.execute('''
+            INSERT OR IGNORE INTO timeline_pull_authors (user_id)
+            SELECT user_id FROM friends GROUP BY user_id HAVING COUNT(*) > ?
+        ''', (FANOUT_MAX_FRIENDS,))
+        conn.commit()
+        print(f"Rebuilt {rebuild(conn)} timeline(s)")
+        conn.close()
+    else:
+        print(__doc__)
+        sys.exit(1)
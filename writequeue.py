@@ -0,0 +1,170 @@
+'''
+writequeue.py
+write-behind batching for small, hot writes (likes, comments, notifications)
+
+request threads hand a write function to a single writer thread and wait for its
+result; the writer collects whatever arrives within BATCH_WINDOW seconds (up to
+BATCH_MAX writes) and applies them in one transaction, so a burst of likes costs
+one commit and one trip through the SQLite writer lock instead of one each
+
+writes are applied in the order they were submitted, so one user's writes
+never overtake each other; each write runs inside its own savepoint, so a
+failing write is rolled back and reported to its caller without affecting the
+rest of the batch, and results are only handed back after the batch commits;
+work that must wait for the commit (e.g. pushing events to clients) is
+registered with on_commit()
+'''
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import db
+
+# How long the writer waits for more writes to join a batch (seconds)
+BATCH_WINDOW = 0.002
+# Maximum number of writes committed together
+BATCH_MAX = 256
+# How long a request waits for its write before giving up (seconds)
+WRITE_TIMEOUT = 10
+
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+_stats = {'writes': 0, 'batches': 0, 'failed': 0, 'callback_errors': 0}
+_local = threading.local()
+
+
+def _connect():
+    conn = db.create_connection()
+    # The writer issues BEGIN/COMMIT itself
+    conn.isolation_level = None
+    return conn, db.DATABASE_PATH
+
+
+def _collect():
+    batch = [_queue.get()]
+    deadline = time.monotonic() + BATCH_WINDOW
+    while len(batch) < BATCH_MAX:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _apply(conn, batch):
+    cursor = conn.cursor()
+    results = []
+    callbacks = []
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        for func, args, future, context in batch:
+            cursor.execute('SAVEPOINT write')
+            _local.callbacks = []
+            try:
+                # Run in the submitter's context so the write counts towards its request's profile
+                results.append((future, True, context.run(func, cursor, *args)))
+                cursor.execute('RELEASE write')
+                callbacks.extend(_local.callbacks)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO write')
+                cursor.execute('RELEASE write')
+                results.append((future, False, e))
+            finally:
+                _local.callbacks = None
+        cursor.execute('COMMIT')
+    except Exception as e:
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        for _, _, future, _ in batch:
+            future.set_exception(e)
+        _stats['failed'] += len(batch)
+        return
+    for callback, args in callbacks:
+        try:
+            callback(*args)
+        except Exception:
+            _stats['callback_errors'] += 1
+    for future, ok, value in results:
+        if ok:
+            future.set_result(value)
+        else:
+            _stats['failed'] += 1
+            future.set_exception(value)
+    _stats['writes'] += len(batch)
+    _stats['batches'] += 1
+
+
+def _run():
+    conn, path = _connect()
+    while True:
+        batch = _collect()
+        if path != db.DATABASE_PATH:
+            # The database was switched (e.g. migrations.explain uses a scratch copy)
+            conn.close()
+            conn, path = _connect()
+        _apply(conn, batch)
+
+
+def _ensure_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_run, name='quad-writer', daemon=True)
+            _writer.start()
+
+
+'''
+submit(func, *args):
+queues a write to run on the writer thread as func(cursor, *args)
+
+params:
+func - a function taking a cursor and [args]; it must not commit
+returns:
+a Future that resolves to func's return value once its batch has committed
+'''
+def submit(func, *args):
+    _ensure_writer()
+    future = Future()
+    _queue.put((func, args, future, contextvars.copy_context()))
+    return future
+
+
+'''
+write(func, *args):
+queues a write and waits for it to commit
+
+returns:
+func's return value; any exception it raised is re-raised here
+'''
+def write(func, *args):
+    return submit(func, *args).result(timeout=WRITE_TIMEOUT)
+
+
+'''
+on_commit(func, *args):
+called from inside a queued write; runs func(*args) on the writer thread once
+the write's batch has committed, or never if the write fails
+outside a queued write func runs straight away
+'''
+def on_commit(func, *args):
+    callbacks = getattr(_local, 'callbacks', None)
+    if callbacks is None:
+        func(*args)
+    else:
+        callbacks.append((func, args))
+
+
+'''
+metrics():
+returns writer counters and the number of writes waiting to be applied
+'''
+def metrics():
+    result = dict(_stats)
+    result['queued'] = _queue.qsize()
+    return result